@@ -0,0 +1,400 @@
+#!/usr/bin/env python3
+"""
+Cold-history archive: months-old points moved out of Postgres into one
+compact NumPy file per device per month.
+
+For every whole month that ended more than ARCHIVE_AFTER_DAYS ago the job
+takes each device's location_history rows and parsed GPS/Network log rows
+(the same point set /history builds), writes them to
+
+    ARCHIVE_DIR/<device id>/<YYYY-MM>.npy
+
+and then deletes those rows. A file is a sorted array of 17-byte records:
+wall-clock time in µs (as Postgres shows the timestamp), lat/lon in
+microdegrees and a source code (see sources.json next to the files). That is
+about a tenth of the row plus index size in Postgres. Files are read with
+mmap: /history maps the month, binary-searches the window and touches only
+those pages, so a cold month costs nothing until a window reaches into it.
+
+Each month is written atomically before its rows are deleted, and a re-run
+merges whatever is still in Postgres into the existing file, so an
+interrupted run is simply repeated. manifest.json records the boundary
+(archived_before) the API uses to decide whether to look at the files at
+all. ARCHIVE_DIR must be the same directory for the job and every API worker.
+
+    python archive.py --once                 # archive everything past the cutoff
+    python archive.py --interval 86400       # keep doing it daily
+    python archive.py --list 123             # months on disk for device id 123
+"""
+import argparse
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import psycopg2
+from dotenv import load_dotenv
+
+import log_points
+import movement
+
+ARCHIVE_DIR = os.getenv('ARCHIVE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'archive'))
+ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', 90))
+
+POINT_DTYPE = np.dtype([('t', '<i8'), ('lat', '<i4'), ('lon', '<i4'), ('src', 'u1')])
+EPOCH = datetime(1970, 1, 1)
+# Rollup bucket lengths in record time units (µs)
+PERIOD_US = {'hour': 3_600_000_000, 'day': 86_400_000_000}
+# Codes below LOG_SOURCES are log points by provider; the rest are
+# location_history sources, appended to sources.json as they show up
+LOG_SOURCES = ('gps', 'network', 'log')
+
+# Log points are read with the shared log_points rules, as in /history
+MONTH_POINTS_SQL = f"""
+    WITH logs AS (
+        SELECT l.id, l.createtime, l.message,
+               {log_points.MATCH_COLUMNS}
+        FROM plugin_devicelog_log l
+        WHERE l.deviceid = %(device)s
+          AND l.createtime >= %(start_ms)s AND l.createtime < %(end_ms)s
+          AND {log_points.MESSAGE_FILTER}
+    )
+    SELECT 'log' AS kind, id,
+           (EXTRACT(EPOCH FROM {log_points.AT}) * 1000000)::bigint AS t,
+           {log_points.LAT} AS lat,
+           {log_points.LON} AS lon,
+           {log_points.PROVIDER} AS source
+    FROM logs
+    WHERE {log_points.HAS_FIX}
+    UNION ALL
+    SELECT 'history', id, (EXTRACT(EPOCH FROM recorded_at) * 1000000)::bigint, lat, lon,
+           COALESCE(source, 'history')
+    FROM location_history
+    WHERE device_id = %(device)s AND recorded_at >= %(start)s AND recorded_at < %(end)s
+"""
+
+OLDEST_SQL = """
+    SELECT LEAST(
+        (SELECT MIN(recorded_at) FROM location_history),
+        (SELECT to_timestamp(MIN(createtime) / 1000.0)::timestamp FROM plugin_devicelog_log
+         WHERE message ILIKE '%%location update%%'))
+"""
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Files
+# ──────────────────────────────────────────────────────────────────────────────
+def month_start(dt):
+    return datetime(dt.year, dt.month, 1)
+
+
+def next_month(dt):
+    return datetime(dt.year + dt.month // 12, dt.month % 12 + 1, 1)
+
+
+def month_path(device_id, month, root=None):
+    return os.path.join(root or ARCHIVE_DIR, str(device_id), f'{month:%Y-%m}.npy')
+
+
+def to_micros(dt):
+    return (dt - EPOCH) // timedelta(microseconds=1)
+
+
+def _write_json(path, value):
+    tmp = f'{path}.tmp{os.getpid()}'
+    with open(tmp, 'w') as f:
+        json.dump(value, f)
+    os.replace(tmp, path)
+
+
+def _read_json(path, default):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+
+
+class Archive:
+    """Reader (and, for the job, writer) of one ARCHIVE_DIR."""
+
+    def __init__(self, root=None):
+        self.root = root or ARCHIVE_DIR
+        self._lock = threading.Lock()
+        self._sources = None
+        self._manifest = (None, None)      # (mtime, archived_before)
+
+    # Source codes ----------------------------------------------------------
+    def sources(self, reload=False):
+        with self._lock:
+            if self._sources is None or reload:
+                self._sources = _read_json(os.path.join(self.root, 'sources.json'), list(LOG_SOURCES) + ['history'])
+            return self._sources
+
+    def source_code(self, source):
+        sources = self.sources()
+        if source not in sources:
+            if len(sources) >= 256:
+                source = 'history'
+            else:
+                sources.append(source)
+                os.makedirs(self.root, exist_ok=True)
+                _write_json(os.path.join(self.root, 'sources.json'), sources)
+        return sources.index(source)
+
+    # Boundary --------------------------------------------------------------
+    def archived_before(self):
+        """Everything older than this (naive wall-clock datetime) is on disk; None if nothing is."""
+        path = os.path.join(self.root, 'manifest.json')
+        try:
+            mtime = os.stat(path).st_mtime
+        except FileNotFoundError:
+            return None
+        if self._manifest[0] != mtime:
+            value = _read_json(path, {}).get('archived_before')
+            self._manifest = (mtime, datetime.fromisoformat(value) if value else None)
+        return self._manifest[1]
+
+    def set_archived_before(self, dt):
+        os.makedirs(self.root, exist_ok=True)
+        _write_json(os.path.join(self.root, 'manifest.json'), {'archived_before': dt.isoformat()})
+
+    # Points ----------------------------------------------------------------
+    def load_month(self, device_id, month):
+        """Memory-mapped records of one device-month, or None."""
+        try:
+            return np.load(month_path(device_id, month, self.root), mmap_mode='r')
+        except FileNotFoundError:
+            return None
+
+    def write_month(self, device_id, month, records):
+        """Merge records into the device-month file (sorted, de-duplicated), atomically."""
+        existing = self.load_month(device_id, month)
+        if existing is not None and len(existing):
+            records = np.concatenate([np.asarray(existing), records])
+        order = np.lexsort((records['src'], records['lon'], records['lat'], records['t']))
+        records = records[order]
+        keep = np.ones(len(records), dtype=bool)
+        if len(records) > 1:
+            same = ((records['t'][1:] == records['t'][:-1]) & (records['lat'][1:] == records['lat'][:-1])
+                    & (records['lon'][1:] == records['lon'][:-1]))
+            keep[1:] = ~same
+        records = records[keep]
+
+        path = month_path(device_id, month, self.root)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f'{path}.tmp{os.getpid()}'
+        with open(tmp, 'wb') as f:
+            np.save(f, records)
+        os.replace(tmp, path)
+        return len(records)
+
+    def records(self, device_id, start, end=None):
+        """
+        device_id's archived records in [start, end) (naive wall-clock
+        datetimes; end defaults to archived_before), oldest first.
+        """
+        end = end or self.archived_before()
+        if end is None or start >= end:
+            return np.empty(0, dtype=POINT_DTYPE)
+        start_us, end_us = to_micros(start), to_micros(end)
+        chunks = []
+        month = month_start(start)
+        while month < end:
+            records = self.load_month(device_id, month)
+            month = next_month(month)
+            if records is None:
+                continue
+            t = records['t']
+            lo, hi = np.searchsorted(t, start_us), np.searchsorted(t, end_us)
+            if lo < hi:
+                chunks.append(records[lo:hi])
+        if not chunks:
+            return np.empty(0, dtype=POINT_DTYPE)
+        return chunks[0] if len(chunks) == 1 else np.concatenate(chunks)
+
+    def read_points(self, device_id, start, end=None):
+        """/history items for device_id's archived points in [start, end), oldest first."""
+        chunk = self.records(device_id, start, end)
+        if not len(chunk):
+            return []
+        sources = self.sources()
+        if int(chunk['src'].max()) >= len(sources):
+            sources = self.sources(reload=True)
+        times = chunk['t'].astype('datetime64[us]').astype(datetime)
+        lats = (chunk['lat'] / 1e6).tolist()
+        lons = (chunk['lon'] / 1e6).tolist()
+        return [{
+            'lat': lat,
+            'lon': lon,
+            'time': when.isoformat(),
+            'type': 'log' if src < len(LOG_SOURCES) else 'history',
+            'provider': sources[src] if src < len(sources) else 'history',
+        } for when, lat, lon, src in zip(times, lats, lons, chunk['src'].tolist())]
+
+    def rollup_rows(self, device_id, start, end=None, period='hour'):
+        """
+        location_rollups-shaped rows (see rollups.ROLLUPS_SQL) bucketed from
+        device_id's archived points in [start, end), for windows served from
+        rollups that reach into archived months.
+        """
+        chunk = self.records(device_id, start, end)
+        if not len(chunk):
+            return []
+        t = chunk['t']
+        lat, lon = chunk['lat'] / 1e6, chunk['lon'] / 1e6
+        bucket = t // PERIOD_US[period]
+        firsts = np.flatnonzero(np.r_[True, bucket[1:] != bucket[:-1]])
+        lasts = np.r_[firsts[1:], len(t)] - 1
+        counts = lasts - firsts + 1
+        # A bucket's distance includes the hop from the previous bucket's last point
+        hops = np.r_[0.0, movement.haversine_m(lat[:-1], lon[:-1], lat[1:], lon[1:])]
+        distance = np.add.reduceat(hops, firsts)
+        lat_sum, lon_sum = np.add.reduceat(lat, firsts), np.add.reduceat(lon, firsts)
+        times = t.astype('datetime64[us]').astype(datetime)
+        starts = (bucket[firsts] * PERIOD_US[period]).astype('datetime64[us]').astype(datetime)
+        return [{
+            'bucket_start': starts[i],
+            'first_at': times[first], 'first_lat': float(lat[first]), 'first_lon': float(lon[first]),
+            'last_at': times[last], 'last_lat': float(lat[last]), 'last_lon': float(lon[last]),
+            'lat': float(lat_sum[i] / counts[i]), 'lon': float(lon_sum[i] / counts[i]),
+            'point_count': int(counts[i]),
+            'distance_m': float(distance[i]),
+        } for i, (first, last) in enumerate(zip(firsts.tolist(), lasts.tolist()))]
+
+    def months(self, device_id):
+        """[(YYYY-MM, points)] on disk for a device."""
+        directory = os.path.join(self.root, str(device_id))
+        try:
+            names = sorted(n for n in os.listdir(directory) if n.endswith('.npy'))
+        except FileNotFoundError:
+            return []
+        return [(n[:-4], len(np.load(os.path.join(directory, n), mmap_mode='r'))) for n in names]
+
+
+def merge_points(archived, points):
+    """archived + live /history points in time order, dropping points stored in both."""
+    if not archived:
+        return points
+    seen = {(p['time'], round(p['lat'], 6), round(p['lon'], 6)) for p in archived}
+    rest = [p for p in points if (p['time'], round(p['lat'], 6), round(p['lon'], 6)) not in seen]
+    merged = archived + rest
+    if rest and rest[0]['time'] < archived[-1]['time']:
+        merged.sort(key=lambda p: p['time'])
+    return merged
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Job
+# ──────────────────────────────────────────────────────────────────────────────
+def cutoff(after_days=None, now=None):
+    """Start of the month containing now - after_days: months before it are archived."""
+    now = now or datetime.now()
+    return month_start(now - timedelta(days=ARCHIVE_AFTER_DAYS if after_days is None else after_days))
+
+
+def archive_month(conn, store, month):
+    """Move one month of every device to disk; returns (devices, points)."""
+    end = next_month(month)
+    cur = conn.cursor()
+    # Log bounds are the month's wall-clock edges in the session time zone
+    start_ms, end_ms = log_points.ms_bounds(cur, month, end)
+    params = {'start': month, 'end': end, 'start_ms': start_ms, 'end_ms': end_ms}
+    # One index range per device and table beats scanning the month of logs
+    cur.execute("SELECT id FROM devices ORDER BY id")
+    devices = [r[0] for r in cur.fetchall()]
+
+    archived = total = 0
+    for device in devices:
+        cur.execute(MONTH_POINTS_SQL, dict(params, device=device))
+        rows = cur.fetchall()
+        if not rows:
+            conn.commit()
+            continue
+        records = np.empty(len(rows), dtype=POINT_DTYPE)
+        records['t'] = [r[2] for r in rows]
+        records['lat'] = np.round(np.array([r[3] for r in rows]) * 1e6).astype('<i4')
+        records['lon'] = np.round(np.array([r[4] for r in rows]) * 1e6).astype('<i4')
+        records['src'] = [store.source_code(r[5]) for r in rows]
+        store.write_month(device, month, records)
+        total += len(rows)
+        archived += 1
+        # The file is on disk before the rows go; a crash in between only
+        # leaves rows the next run merges again
+        cur.execute("DELETE FROM plugin_devicelog_log WHERE id = ANY(%s)",
+                    ([r[1] for r in rows if r[0] == 'log'],))
+        cur.execute("DELETE FROM location_history WHERE id = ANY(%s)",
+                    ([r[1] for r in rows if r[0] == 'history'],))
+        conn.commit()
+    cur.close()
+    return archived, total
+
+
+def run_job(conn, store=None, after_days=None):
+    """Archive every whole month before the cutoff; returns points moved."""
+    store = store or Archive()
+    boundary = cutoff(after_days)
+    # Months before the previous boundary are done (a crashed run never moved it)
+    start = store.archived_before()
+    if start is None:
+        cur = conn.cursor()
+        cur.execute(OLDEST_SQL)
+        oldest = cur.fetchone()[0]
+        cur.close()
+        conn.commit()
+        start = month_start(oldest) if oldest else boundary
+
+    moved = 0
+    month = start
+    while month < boundary:
+        started = time.time()
+        devices, points = archive_month(conn, store, month)
+        moved += points
+        if points:
+            print(f"{datetime.now()}: archived {month:%Y-%m}: {points} points from {devices} devices "
+                  f"in {time.time() - started:.1f}s")
+        month = next_month(month)
+
+    previous = store.archived_before()
+    if previous is None or boundary > previous:
+        store.set_archived_before(boundary)
+    return moved
+
+
+def main():
+    load_dotenv()
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--once', action='store_true', help='archive once and exit')
+    ap.add_argument('--interval', type=float, default=86400.0, help='seconds between runs')
+    ap.add_argument('--after-days', type=int, default=ARCHIVE_AFTER_DAYS, help='archive whole months older than this')
+    ap.add_argument('--dir', default=ARCHIVE_DIR, help='archive directory (ARCHIVE_DIR)')
+    ap.add_argument('--list', metavar='DEVICE_ID', type=int, help='show archived months of a device and exit')
+    args = ap.parse_args()
+
+    store = Archive(args.dir)
+    if args.list is not None:
+        print(f"archived before: {store.archived_before()}")
+        for month, points in store.months(args.list):
+            print(f"{month}  {points} points")
+        return
+
+    conn = psycopg2.connect(
+        host=os.getenv('DB_HOST', 'localhost'),
+        port=int(os.getenv('DB_PORT', 5432)),
+        database=os.getenv('DB_NAME', 'hmdm'),
+        user=os.getenv('DB_USER', 'hmdm'),
+        password=os.getenv('DB_PASSWORD', 'topsecret'),
+    )
+    while True:
+        started = time.time()
+        moved = run_job(conn, store, args.after_days)
+        print(f"{datetime.now()}: archived {moved} points in {time.time() - started:.1f}s")
+        if args.once:
+            return
+        time.sleep(args.interval)
+
+
+if __name__ == '__main__':
+    main()
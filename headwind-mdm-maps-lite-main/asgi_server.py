@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+"""
+ASGI variant of the read API on asyncpg:
+
+    GET /api/locations
+    GET /api/devices
+    GET /api/device/<number>/history?days=N[&detail=1]
+
+Only the queries run here; SQL, row shaping, the archive merge, freshness
+tracking, the shared cache and authentication all come from server_history.py,
+so the responses match the Flask app's and a user logged in there can call
+these endpoints with the same session cookie (or the same X-API-KEY). Blocking
+work from server_history (cache and archive I/O) runs in the default executor,
+off the event loop. Serve it next to the Flask app, e.g. behind the same proxy:
+
+    uvicorn asgi_server:app --host 0.0.0.0 --port 5004 --workers 4
+"""
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+
+import asyncpg
+from itsdangerous import BadSignature
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+import queries
+import rollups
+import server_history as sh
+
+
+# The registry's statements in $n form; asyncpg prepares and caches them per
+# connection and decodes results in binary
+SQL = {name: queries.REGISTRY[name].numbered
+       for name in ('locations', 'devices', 'history', 'device_lookup', 'rollup_state', 'rollups',
+                    'snapshot_insert')}
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Auth (reads the Flask-Login session cookie written by server_history.py)
+# ──────────────────────────────────────────────────────────────────────────────
+_session_serializer = sh.app.session_interface.get_signing_serializer(sh.app)
+_session_max_age = int(sh.app.permanent_session_lifetime.total_seconds())
+USER_CHECK_TTL = 30  # seconds a verified user id is trusted without a DB hit
+_known_users = {}    # user_id -> (exists, checked_at)
+
+
+async def _user_exists(pool, user_id):
+    hit = _known_users.get(user_id)
+    if hit and time.monotonic() - hit[1] < USER_CHECK_TTL:
+        return hit[0]
+    try:
+        exists = await pool.fetchval("SELECT 1 FROM map_users WHERE id = $1", int(user_id)) is not None
+    except (ValueError, asyncpg.PostgresError):
+        exists = False
+    _known_users[user_id] = (exists, time.monotonic())
+    return exists
+
+
+async def is_authenticated(request):
+    """Same rule as server_history.api_key_auth: logged-in user or valid API key."""
+    if sh.API_KEY and request.headers.get('x-api-key') == sh.API_KEY:
+        return True
+    cookie = request.cookies.get(sh.app.config['SESSION_COOKIE_NAME'])
+    if not cookie or _session_serializer is None:
+        return False
+    try:
+        session = _session_serializer.loads(cookie, max_age=_session_max_age)
+    except BadSignature:
+        return False
+    user_id = session.get('_user_id')
+    if not user_id:
+        return False
+    return await _user_exists(request.app.state.pool, user_id)
+
+
+def api_endpoint(fn):
+    async def wrapper(request):
+        if not await is_authenticated(request):
+            return JSONResponse({"error": "Unauthorized"}, status_code=401)
+        try:
+            return await fn(request)
+        except Exception as e:
+            return JSONResponse({"error": str(e)}, status_code=500)
+    return wrapper
+
+
+async def run_sync(fn, *args):
+    """Run a blocking server_history helper in the default executor."""
+    return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+
+
+_flights = {}
+
+
+async def cached(key, ttl, compute):
+    """
+    Async twin of server_history.cached (same keys, same backend). Concurrent
+    misses on a key await one shared task, for at most COALESCE_TIMEOUT_S.
+    """
+    entry = await run_sync(sh.cache.get, key)
+    if entry is not None:
+        return entry.value
+
+    async def load():
+        try:
+            value = await compute()
+            if value is not None:
+                await run_sync(sh.cache.set, key, value, ttl)
+            return value
+        finally:
+            _flights.pop(key, None)
+
+    task = _flights.get(key)
+    if task is None:
+        task = _flights[key] = asyncio.ensure_future(load())
+        # shield: a request that goes away must not cancel the shared query
+        return await asyncio.shield(task)
+    try:
+        return await asyncio.wait_for(asyncio.shield(task), sh.COALESCE_TIMEOUT_S)
+    except asyncio.TimeoutError:
+        value = await compute()
+        if value is not None:
+            await run_sync(sh.cache.set, key, value, ttl)
+        return value
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# APIs
+# ──────────────────────────────────────────────────────────────────────────────
+@api_endpoint
+async def get_locations(request):
+    pool = request.app.state.pool
+
+    async def load():
+        rows = await pool.fetch(SQL['locations'])
+        return await run_sync(sh.locations_from_rows, rows)
+
+    return JSONResponse(await cached('locations', sh.CACHE_TTL['locations'], load))
+
+
+@api_endpoint
+async def get_devices(request):
+    pool = request.app.state.pool
+
+    async def load():
+        rows = await pool.fetch(SQL['devices'])
+        return [sh.device_from_row(d) for d in rows]
+
+    return JSONResponse(await cached('devices', sh.CACHE_TTL['devices'], load))
+
+
+async def persist_current(conn, device, current):
+    """Async twin of server_history.persist_current."""
+    cur_lat, cur_lon, cur_dt = current
+    try:
+        status = await conn.execute(SQL['snapshot_insert'],
+                                    device['id'], cur_lat, cur_lon, cur_dt, 'snapshot',
+                                    device['id'], cur_dt)
+        await run_sync(sh.current_persisted, device, cur_dt, int(status.split()[-1]))
+    except asyncpg.PostgresError as _e:
+        print(f"[history snapshot insert skipped] {str(_e)}")
+
+
+@api_endpoint
+async def get_device_history(request):
+    pool = request.app.state.pool
+    device_number = request.path_params['device_number']
+    days = int(request.query_params.get('days', 7))
+    period = None if request.query_params.get('detail') == '1' else rollups.period_for(days)
+
+    async def load_rollups():
+        _, window_start = sh.history_window(days)
+        rollup_from = await run_sync(sh.rollup_from, window_start)
+        async with pool.acquire() as conn:
+            boundary, boundary_ms = await conn.fetchrow(SQL['rollup_state'], window_start, period)
+            tail = await conn.fetch(SQL['history'], device_number, boundary_ms, boundary)
+            device, raw, current = sh.history_from_rows(tail, boundary)
+            if not device:
+                return None
+            rows = await conn.fetch(SQL['rollups'], device['id'], period, window_start, rollup_from, boundary)
+            if current:
+                await persist_current(conn, device, current)
+        return await run_sync(sh.rollup_result, device, raw, rows, period, window_start)
+
+    async def load():
+        async with pool.acquire() as conn:
+            since_ms, window_start = sh.history_window(days)
+            rows = await conn.fetch(SQL['history'], device_number, since_ms, window_start)
+            device, points, current = sh.history_from_rows(rows, window_start)
+            if not device:
+                return None
+
+            if current:
+                await persist_current(conn, device, current)
+
+        return await run_sync(sh.history_result, device, points, window_start)
+
+    if period:
+        payload = await cached(f'history:{device_number}:{days}:{period}', sh.CACHE_TTL['history'], load_rollups)
+    else:
+        payload = await cached(f'history:{device_number}:{days}', sh.CACHE_TTL['history'], load)
+    if payload is None:
+        return JSONResponse({"error": "Device not found"}, status_code=404)
+    return JSONResponse(payload)
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# App
+# ──────────────────────────────────────────────────────────────────────────────
+@asynccontextmanager
+async def lifespan(app):
+    app.state.pool = await asyncpg.create_pool(
+        min_size=int(os.getenv('ASYNC_DB_POOL_MIN', 2)),
+        max_size=int(os.getenv('ASYNC_DB_POOL_MAX', 20)),
+        # Replica routing is only done by the Flask app (db.py)
+        **{k: v for k, v in sh.DB_CONFIG.items() if k != 'replicas'}
+    )
+    try:
+        yield
+    finally:
+        await app.state.pool.close()
+
+
+app = Starlette(
+    routes=[
+        Route('/api/locations', get_locations),
+        Route('/api/devices', get_devices),
+        Route('/api/device/{device_number}/history', get_device_history),
+    ],
+    lifespan=lifespan,
+)
+
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, host=os.getenv('APP_HOST', '0.0.0.0'), port=int(os.getenv('ASGI_PORT', 5004)))
@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+"""
+Bulk backfill of location_history from CSV, NDJSON or device-log dumps.
+
+    python backfill.py points.csv                  # device,time,lat,lon[,source] (export.py's CSV works)
+    python backfill.py points.ndjson --format ndjson
+    python backfill.py devicelog.csv --format log  # deviceid|device,createtime,message rows
+    python backfill.py --list                      # jobs and their progress
+
+Three phases, each restartable:
+  1. load   the file is streamed with COPY FROM STDIN into an UNLOGGED staging
+            table (rows that don't parse are counted and skipped)
+  2. resolve device numbers are mapped to devices.id in one UPDATE
+  3. merge  staging rows move into location_history in --batch sized ranges,
+            dropping rows whose (device, time) is already stored or repeated
+            in the file. Each batch commits together with the job's progress,
+            so re-running the same command after a crash resumes where it
+            stopped without inserting anything twice.
+
+A job is identified by the file's absolute path and size. Afterwards run
+`python trips.py --rebuild` if trips are in use, since segments before a
+device's last processed point are final. Rollups pick the merged rows up by
+themselves (their hours are rolled up again on the next run); `python
+rollups.py --rebuild` recomputes everything if that is quicker.
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+import psycopg2
+from dotenv import load_dotenv
+
+import log_points
+from generate_fleet import LineStream
+
+SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS location_backfill_jobs (
+    id            SERIAL PRIMARY KEY,
+    path          TEXT NOT NULL,
+    size          BIGINT NOT NULL,
+    format        VARCHAR(16) NOT NULL,
+    status        VARCHAR(16) NOT NULL DEFAULT 'loading',   -- loading | loaded | merging | done
+    loaded_rows   BIGINT NOT NULL DEFAULT 0,
+    skipped_rows  BIGINT NOT NULL DEFAULT 0,
+    unknown_rows  BIGINT NOT NULL DEFAULT 0,
+    merged_upto   BIGINT NOT NULL DEFAULT 0,
+    inserted_rows BIGINT NOT NULL DEFAULT 0,
+    created_at    TIMESTAMP NOT NULL DEFAULT NOW(),
+    finished_at   TIMESTAMP,
+    UNIQUE (path, size)
+);
+
+CREATE UNLOGGED TABLE IF NOT EXISTS location_backfill_staging (
+    job_id        INT NOT NULL,
+    seq           BIGINT NOT NULL,
+    device_number VARCHAR(100),
+    device_id     INT,
+    lat           DOUBLE PRECISION NOT NULL,
+    lon           DOUBLE PRECISION NOT NULL,
+    recorded_at   TIMESTAMP NOT NULL,
+    source        VARCHAR(32) NOT NULL,
+    PRIMARY KEY (job_id, seq)
+);
+"""
+
+MERGE_SQL = """
+    INSERT INTO location_history (device_id, lat, lon, recorded_at, source)
+    SELECT DISTINCT ON (s.device_id, s.recorded_at) s.device_id, s.lat, s.lon, s.recorded_at, s.source
+    FROM location_backfill_staging s
+    WHERE s.job_id = %s AND s.seq > %s AND s.seq <= %s
+      AND s.device_id IS NOT NULL
+      AND NOT EXISTS (
+        SELECT 1 FROM location_history h
+        WHERE h.device_id = s.device_id AND h.recorded_at = s.recorded_at
+      )
+    ORDER BY s.device_id, s.recorded_at, s.seq
+"""
+
+
+def parse_time(value):
+    """ISO-8601 string or epoch milliseconds -> naive local datetime."""
+    if isinstance(value, (int, float)) or (isinstance(value, str) and value.isdigit()):
+        return datetime.fromtimestamp(int(value) / 1000.0)
+    value = value.strip().replace('Z', '+00:00')
+    dt = datetime.fromisoformat(value)
+    return dt.astimezone().replace(tzinfo=None) if dt.tzinfo else dt
+
+
+def _device(row):
+    """(device_number, device_id) from whichever column the dump has."""
+    for key in ('device_id', 'deviceid'):
+        if row.get(key) not in (None, ''):
+            return None, int(row[key])
+    return str(row.get('device') or row.get('number') or ''), None
+
+
+def point_from_row(row):
+    """(device_number, device_id, lat, lon, time, source) from a CSV/NDJSON record."""
+    number, device_id = _device(row)
+    return (number, device_id, float(row['lat']), float(row['lon']),
+            parse_time(row.get('time') or row.get('recorded_at') or row['ts']), row.get('source') or 'backfill')
+
+
+def point_from_log_row(row, parse_message):
+    """Same from a plugin_devicelog_log row; None if the message has no fix."""
+    lat, lon = parse_message(row.get('message') or '')
+    if lat is None or lon is None:
+        return None
+    number, device_id = _device(row)
+    msg = row['message'].lower()
+    source = 'gps' if 'gps' in msg else 'network' if 'network' in msg else 'log'
+    return number, device_id, float(lat), float(lon), parse_time(row['createtime']), source
+
+
+def read_records(f, fmt):
+    if fmt == 'ndjson':
+        return (line for line in f if line.strip())
+    return csv.DictReader(f)
+
+
+class Progress:
+    def __init__(self, label, total=None):
+        self.label, self.total = label, total
+        self.started = self.last = time.time()
+
+    def update(self, done, extra='', force=False):
+        now = time.time()
+        if not force and now - self.last < 2:
+            return
+        self.last = now
+        rate = done / max(now - self.started, 1e-6)
+        line = f"\r{self.label}: {done:,}"
+        if self.total:
+            eta = (self.total - done) / rate if rate else 0
+            line += f"/{self.total:,} ({done * 100 / self.total:.1f}%, ETA {eta:.0f}s)"
+        print(f"{line} {rate:,.0f}/s {extra}", end='', file=sys.stderr, flush=True)
+
+    def done(self, done, extra=''):
+        self.update(done, extra, force=True)
+        print(file=sys.stderr)
+
+
+def _copy_text(value):
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', ' ').replace('\n', ' ')
+
+
+def load(conn, job_id, records, convert):
+    """Phase 1: COPY converted records into staging."""
+    cur = conn.cursor()
+    cur.execute("DELETE FROM location_backfill_staging WHERE job_id = %s", (job_id,))
+    counts = {'loaded': 0, 'skipped': 0}
+    progress = Progress('load')
+
+    def lines():
+        for record in records:
+            try:
+                point = convert(record)
+            except (ValueError, KeyError, TypeError) as e:
+                point = None
+                if counts['skipped'] < 5:
+                    print(f"\nskipping row: {e!r}", file=sys.stderr)
+            if point is None:
+                counts['skipped'] += 1
+                continue
+            number, device_id, lat, lon, at, source = point
+            counts['loaded'] += 1
+            if counts['loaded'] % 100000 == 0:
+                progress.update(counts['loaded'])
+            yield (f"{job_id}\t{counts['loaded']}\t{_copy_text(number)}\t{_copy_text(device_id)}\t"
+                   f"{lat!r}\t{lon!r}\t{at.isoformat()}\t{_copy_text(source[:32])}\n")
+
+    cur.copy_expert("COPY location_backfill_staging (job_id, seq, device_number, device_id, lat, lon, "
+                    "recorded_at, source) FROM STDIN", LineStream(lines()))
+    progress.done(counts['loaded'], f"({counts['skipped']:,} skipped)")
+    cur.execute("UPDATE location_backfill_jobs SET status='loaded', loaded_rows=%s, skipped_rows=%s WHERE id=%s",
+                (counts['loaded'], counts['skipped'], job_id))
+    conn.commit()
+    cur.close()
+
+
+def resolve(conn, job_id):
+    """Phase 2: device numbers -> ids, set-wise."""
+    cur = conn.cursor()
+    cur.execute("""
+        UPDATE location_backfill_staging s SET device_id = d.id
+        FROM devices d
+        WHERE s.job_id = %s AND s.device_id IS NULL AND s.device_number = d.number
+    """, (job_id,))
+    cur.execute("""
+        UPDATE location_backfill_staging s SET device_id = NULL
+        WHERE s.job_id = %s AND s.device_id IS NOT NULL
+          AND NOT EXISTS (SELECT 1 FROM devices d WHERE d.id = s.device_id)
+    """, (job_id,))
+    cur.execute("SELECT COUNT(*) FROM location_backfill_staging WHERE job_id = %s AND device_id IS NULL", (job_id,))
+    unknown = cur.fetchone()[0]
+    cur.execute("UPDATE location_backfill_jobs SET status='merging', unknown_rows=%s WHERE id=%s", (unknown, job_id))
+    conn.commit()
+    cur.close()
+    if unknown:
+        print(f"{unknown:,} rows reference unknown devices and will be skipped", file=sys.stderr)
+
+
+def merge(conn, job_id, batch):
+    """Phase 3: staging -> location_history in seq ranges, progress committed with each batch."""
+    cur = conn.cursor()
+    cur.execute("SELECT loaded_rows, merged_upto, inserted_rows FROM location_backfill_jobs WHERE id=%s", (job_id,))
+    total, upto, inserted = cur.fetchone()
+    progress = Progress('merge', total)
+    while upto < total:
+        hi = min(upto + batch, total)
+        cur.execute(MERGE_SQL, (job_id, upto, hi))
+        inserted += cur.rowcount
+        cur.execute("UPDATE location_backfill_jobs SET merged_upto=%s, inserted_rows=%s WHERE id=%s",
+                    (hi, inserted, job_id))
+        conn.commit()
+        upto = hi
+        progress.update(upto, f"({inserted:,} new)")
+    progress.done(upto, f"({inserted:,} new)")
+
+    cur.execute("DELETE FROM location_backfill_staging WHERE job_id = %s", (job_id,))
+    cur.execute("UPDATE location_backfill_jobs SET status='done', finished_at=NOW() WHERE id=%s", (job_id,))
+    conn.commit()
+    cur.close()
+    return inserted
+
+
+def list_jobs(conn):
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT id, status, path, loaded_rows, merged_upto, inserted_rows, skipped_rows, unknown_rows, created_at
+        FROM location_backfill_jobs ORDER BY id
+    """)
+    for r in cur.fetchall():
+        print(f"#{r[0]} {r[1]:<8} {r[2]}  loaded={r[3]:,} merged={r[4]:,} inserted={r[5]:,} "
+              f"skipped={r[6]:,} unknown={r[7]:,}  {r[8]:%Y-%m-%d %H:%M}")
+    cur.close()
+
+
+def main():
+    load_dotenv()
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('file', nargs='?')
+    ap.add_argument('--format', choices=['csv', 'ndjson', 'log'], default='csv')
+    ap.add_argument('--batch', type=int, default=50000, help='staging rows merged per transaction')
+    ap.add_argument('--restart', action='store_true', help='forget previous progress for this file')
+    ap.add_argument('--list', action='store_true', help='show backfill jobs and exit')
+    args = ap.parse_args()
+
+    conn = psycopg2.connect(
+        host=os.getenv('DB_HOST', 'localhost'),
+        port=int(os.getenv('DB_PORT', 5432)),
+        database=os.getenv('DB_NAME', 'hmdm'),
+        user=os.getenv('DB_USER', 'hmdm'),
+        password=os.getenv('DB_PASSWORD', 'topsecret'),
+    )
+    cur = conn.cursor()
+    cur.execute(SCHEMA_SQL)
+    conn.commit()
+
+    if args.list:
+        list_jobs(conn)
+        return
+    if not args.file:
+        ap.error('file is required')
+
+    path = os.path.abspath(args.file)
+    size = os.path.getsize(path)
+    if args.restart:
+        cur.execute("DELETE FROM location_backfill_staging WHERE job_id IN "
+                    "(SELECT id FROM location_backfill_jobs WHERE path=%s AND size=%s)", (path, size))
+        cur.execute("DELETE FROM location_backfill_jobs WHERE path=%s AND size=%s", (path, size))
+    cur.execute("""
+        INSERT INTO location_backfill_jobs (path, size, format) VALUES (%s, %s, %s)
+        ON CONFLICT (path, size) DO UPDATE SET format = location_backfill_jobs.format
+        RETURNING id, status
+    """, (path, size, args.format))
+    job_id, status = cur.fetchone()
+    conn.commit()
+    print(f"job #{job_id}: {path} ({status})", file=sys.stderr)
+
+    if status == 'done':
+        print("already merged; use --restart to load it again", file=sys.stderr)
+        return
+    if status == 'loading':
+        if args.format == 'log':
+            convert = lambda row: point_from_log_row(row, log_points.parse_gps_from_message)
+        elif args.format == 'ndjson':
+            convert = lambda line: point_from_row(json.loads(line))
+        else:
+            convert = point_from_row
+        with io.open(path, newline='', encoding='utf-8') as f:
+            load(conn, job_id, read_records(f, args.format), convert)
+        status = 'loaded'
+    if status == 'loaded':
+        resolve(conn, job_id)
+    inserted = merge(conn, job_id, args.batch)
+    print(f"job #{job_id} done: {inserted:,} rows added to location_history", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""
+Repeatable HTTP benchmark for the maps API.
+
+Runs closed-loop clients against every API route (or --route ones) at each
+--concurrency level and reports throughput and p50/p95/p99 latency. Results
+are appended to bench-results/results.jsonl tagged with the current git
+commit, so runs can be compared across commits (--compare REV).
+
+    # data: python generate_fleet.py --schema --devices 10000 --log-rows 100000000 --bench-user bench:bench
+    python benchmark.py --target sync=http://127.0.0.1:5003 --username bench --password bench \
+        --concurrency 50 --concurrency 200 --duration 20 --compare HEAD~1
+
+    # sync (Flask/gunicorn) vs async (asgi_server.py)
+    python benchmark.py --target sync=http://127.0.0.1:5003 --target async=http://127.0.0.1:5004 \
+        --username bench --password bench --concurrency 100 --concurrency 300
+
+Routes containing {device} get a random device number per request, sampled
+from /api/devices, so the history routes don't just measure one cache entry.
+Run the servers with CACHE_URL=none:// to measure the database path.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import subprocess
+import time
+from datetime import datetime
+
+import httpx
+
+ROUTES = [
+    '/api/locations',
+    '/api/devices',
+    '/api/device/{device}/history?days=1',
+    '/api/device/{device}/history?days=7',
+    '/api/device/{device}/history?days=14',
+]
+
+RESULTS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench-results', 'results.jsonl')
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return float('nan')
+    k = max(0, math.ceil(p / 100.0 * len(sorted_values)) - 1)
+    return sorted_values[k]
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def resolve_commit(rev):
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', rev], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return rev
+
+
+async def login(base_url, username, password):
+    async with httpx.AsyncClient(base_url=base_url) as client:
+        r = await client.post('/login', data={'username': username, 'password': password})
+        if r.status_code != 302 or 'session' not in client.cookies:
+            raise SystemExit(f"Login against {base_url} failed (HTTP {r.status_code})")
+        return dict(client.cookies)
+
+
+async def sample_devices(base_url, cookies, headers, n):
+    async with httpx.AsyncClient(base_url=base_url, cookies=cookies, headers=headers, timeout=120.0) as client:
+        r = await client.get('/api/devices')
+        r.raise_for_status()
+        numbers = [d['number'] for d in r.json() if d.get('gps_count')] or [d['number'] for d in r.json()]
+    random.shuffle(numbers)
+    return numbers[:n]
+
+
+async def run_route(base_url, route, concurrency, duration, cookies, headers, devices):
+    """C workers loop on one route until the deadline; returns a result dict."""
+    latencies, errors, nbytes = [], 0, 0
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, cookies=cookies, headers=headers,
+                                 limits=limits, timeout=60.0) as client:
+        deadline = time.perf_counter() + duration
+
+        async def worker():
+            nonlocal errors, nbytes
+            while time.perf_counter() < deadline:
+                path = route.format(device=random.choice(devices)) if devices else route
+                t0 = time.perf_counter()
+                try:
+                    r = await client.get(path)
+                    body = await r.aread()
+                    ok = r.status_code == 200
+                except httpx.HTTPError:
+                    ok, body = False, b''
+                if ok:
+                    latencies.append(time.perf_counter() - t0)
+                    nbytes += len(body)
+                else:
+                    errors += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': len(latencies) / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'avg_bytes': nbytes / len(latencies) if latencies else 0,
+    }
+
+
+def load_results(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def baseline_for(results, commit):
+    """Latest stored result per (target, route, concurrency) for a commit."""
+    base = {}
+    for r in results:
+        if r['commit'] == commit:
+            base[(r['target'], r['route'], r['concurrency'])] = r
+    return base
+
+
+def fmt_delta(now, before, lower_is_better):
+    if not before or before != before:  # missing or NaN
+        return ''
+    change = (now - before) / before * 100
+    better = change < 0 if lower_is_better else change > 0
+    return f" ({'+' if change >= 0 else ''}{change:.0f}%{'' if abs(change) < 5 else (' ✓' if better else ' ✗')})"
+
+
+def parse_args():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--target', action='append', required=True, metavar='NAME=URL',
+                    help='server to benchmark; repeat for each')
+    ap.add_argument('--route', action='append', help=f'route(s) to run (default: all of {ROUTES})')
+    ap.add_argument('--concurrency', action='append', type=int, help='concurrent clients (repeatable)')
+    ap.add_argument('--duration', type=float, default=15.0, help='seconds per route/concurrency')
+    ap.add_argument('--sample-devices', type=int, default=200, help='devices to draw {device} from')
+    ap.add_argument('--username')
+    ap.add_argument('--password')
+    ap.add_argument('--api-key', help='send X-API-KEY instead of logging in')
+    ap.add_argument('--results', default=RESULTS_FILE, help='JSONL file results are appended to')
+    ap.add_argument('--no-save', action='store_true')
+    ap.add_argument('--compare', metavar='REV', help='show deltas against stored results of this commit')
+    ap.add_argument('--label', default='', help='free-form note stored with the results')
+    return ap.parse_args()
+
+
+async def main():
+    args = parse_args()
+    targets = [t.split('=', 1) for t in args.target]
+    concurrencies = args.concurrency or [100]
+    routes = args.route or ROUTES
+    commit = git_commit()
+
+    cookies, headers = {}, {}
+    if args.api_key:
+        headers['X-API-KEY'] = args.api_key
+    elif args.username:
+        cookies = await login(targets[0][1], args.username, args.password or '')
+
+    devices = []
+    if any('{device}' in r for r in routes):
+        devices = await sample_devices(targets[0][1], cookies, headers, args.sample_devices)
+        if not devices:
+            raise SystemExit("No devices returned by /api/devices")
+
+    baseline = baseline_for(load_results(args.results), resolve_commit(args.compare)) if args.compare else {}
+    run_at = datetime.utcnow().isoformat(timespec='seconds') + 'Z'
+    stored = []
+
+    print(f"commit {commit}" + (f"  (compared with {args.compare})" if args.compare else ''))
+    print(f"{'target':<8} {'route':<40} {'conc':>5} {'req/s':>16} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>16} {'err':>5}")
+    for route in routes:
+        for concurrency in concurrencies:
+            for name, url in targets:
+                r = await run_route(url, route, concurrency, args.duration, cookies, headers, devices)
+                before = baseline.get((name, route, concurrency), {})
+                rps = f"{r['rps']:.1f}{fmt_delta(r['rps'], before.get('rps'), False)}"
+                p99 = f"{r['p99_ms']:.1f}{fmt_delta(r['p99_ms'], before.get('p99_ms'), True)}"
+                print(f"{name:<8} {route:<40} {concurrency:>5} {rps:>16} "
+                      f"{r['p50_ms']:>9.1f} {r['p95_ms']:>9.1f} {p99:>16} {r['errors']:>5}")
+                stored.append(dict(r, commit=commit, run_at=run_at, target=name, url=url, route=route,
+                                   concurrency=concurrency, duration=args.duration, label=args.label))
+
+    if not args.no_save:
+        os.makedirs(os.path.dirname(args.results), exist_ok=True)
+        with open(args.results, 'a') as f:
+            for r in stored:
+                f.write(json.dumps(r) + '\n')
+        print(f"\nSaved {len(stored)} results to {args.results}")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+"""
+PostgreSQL connection pool for the maps API.
+
+One connection pool per process. Under gunicorn the pool is created in
+each worker after fork (see gunicorn.conf.py); if a pool inherited from the
+master is ever seen in a child it is dropped, never reused, because its
+sockets belong to the parent. When every connection is in use, a request
+waits up to DB_POOL_TIMEOUT_S for one to be returned instead of failing
+straight away (gevent runs far more requests per worker than DB_POOL_MAX).
+
+Optional streaming replicas (DB_CONFIG['replicas'], DSNs) get a pool each.
+connection(readonly=True) borrows from a replica whose replay lag is under
+DB_REPLICA_MAX_LAG_S and falls back to the primary when none qualifies or the
+replica can't be reached; everything else always runs on the primary. A
+pooled replica connection the server already closed (the replica restarted)
+is caught before it is handed out; the replica is then skipped for
+DB_REPLICA_RETRY_S and its other idle connections are dropped.
+"""
+import itertools
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import extensions
+from psycopg2.extras import RealDictCursor
+from psycopg2.pool import PoolError, ThreadedConnectionPool
+
+_config = {}
+_replicas = {}          # name -> connection parameters
+_pools = {}             # 'primary' | replica name -> pool
+_pool_pid = None
+_lock = threading.Lock()
+
+POOL_TIMEOUT_S = float(os.getenv('DB_POOL_TIMEOUT_S', 10))
+REPLICA_MAX_LAG_S = float(os.getenv('DB_REPLICA_MAX_LAG_S', 10))
+# How often a replica's lag is re-read, and how long an unreachable one is skipped
+REPLICA_CHECK_S = float(os.getenv('DB_REPLICA_CHECK_S', 5))
+REPLICA_RETRY_S = float(os.getenv('DB_REPLICA_RETRY_S', 30))
+
+# 0 when the replica has replayed everything it received (an idle primary
+# leaves pg_last_xact_replay_timestamp() behind forever); 0 on a non-replica
+REPLICA_LAG_SQL = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+"""
+
+# Callables hook(statement, params, seconds, rowcount, cursor) run after every
+# statement executed through a pooled connection (metrics, slow-query log).
+QUERY_HOOKS = []
+
+
+class _TimedMixin:
+    def execute(self, query, vars=None):
+        if not QUERY_HOOKS:
+            return super().execute(query, vars)
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            elapsed = time.perf_counter() - start
+            for hook in QUERY_HOOKS:
+                hook(query, vars, elapsed, self.rowcount, self)
+
+
+class Connection(extensions.connection):
+    """
+    Pooled connection; remembers which statements queries.py prepared on it
+    and which replica (None for the primary) it points to.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+        self.replica = None
+
+
+class Cursor(_TimedMixin, extensions.cursor):
+    """Default cursor of pooled connections."""
+
+
+class DictCursor(_TimedMixin, RealDictCursor):
+    """RealDictCursor that reports to QUERY_HOOKS."""
+
+
+class BlockingPool(ThreadedConnectionPool):
+    """
+    ThreadedConnectionPool whose getconn() waits for a free connection
+    (up to timeout seconds) before raising PoolError. minconn connections
+    are opened up front (none with lazy=True); returned connections are kept
+    up to maxconn, so a busy worker doesn't reconnect (and re-PREPARE) after
+    every burst.
+    """
+
+    def __init__(self, minconn, maxconn, *args, lazy=False, **kwargs):
+        super().__init__(0 if lazy else minconn, maxconn, *args, **kwargs)
+        # psycopg2's _putconn closes a returned connection once minconn are idle
+        self.minconn = maxconn
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self.waiting = 0
+
+    def getconn(self, key=None, timeout=None):
+        timeout = POOL_TIMEOUT_S if timeout is None else timeout
+        if not self._slots.acquire(blocking=False):
+            if timeout <= 0:
+                raise PoolError("connection pool exhausted")
+            self.waiting += 1
+            try:
+                if not self._slots.acquire(timeout=timeout):
+                    raise PoolError(f"no DB connection free after {timeout:g}s")
+            finally:
+                self.waiting -= 1
+        try:
+            return super().getconn(key)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn, key=None, close=False):
+        try:
+            super().putconn(conn, key, close)
+        finally:
+            self._slots.release()
+
+    def discard_idle(self):
+        """Close the idle connections; the next getconn() opens fresh ones."""
+        with self._lock:
+            idle, self._pool = self._pool, []
+        for conn in idle:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+
+class _ReplicaState:
+    def __init__(self):
+        self.lag = None
+        self.checked_at = 0.0
+        self.down_until = 0.0
+
+
+_replica_state = {}
+_round_robin = itertools.count()
+
+
+def env_config():
+    """Connection parameters from DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD and DB_REPLICAS."""
+    return {
+        'host': os.getenv('DB_HOST', 'localhost'),
+        'port': int(os.getenv('DB_PORT', 5432)),
+        'database': os.getenv('DB_NAME', 'hmdm'),
+        'user': os.getenv('DB_USER', 'hmdm'),
+        'password': os.getenv('DB_PASSWORD', 'topsecret'),
+        # Streaming replicas for map reads, e.g. postgresql://replica1,host=replica2 port=5433
+        'replicas': [dsn.strip() for dsn in os.getenv('DB_REPLICAS', '').split(',') if dsn.strip()],
+    }
+
+
+def configure(config):
+    """
+    Set the connection parameters (DB_CONFIG) used when the pools are built.
+    config['replicas'] is an optional list of replica DSNs; parameters a DSN
+    leaves out (user, password, database...) are taken from the primary's.
+    """
+    global _config, _replicas
+    config = dict(config)
+    replicas = config.pop('replicas', None) or ()
+    _config = config
+    _replicas = {}
+    for dsn in replicas:
+        parsed = extensions.parse_dsn(dsn)
+        if 'dbname' in parsed:
+            parsed['database'] = parsed.pop('dbname')
+        params = dict(config, **parsed)
+        _replicas[f"{params.get('host', 'localhost')}:{params.get('port', 5432)}"] = params
+    _replica_state.clear()
+    _replica_state.update((name, _ReplicaState()) for name in _replicas)
+
+
+def init_pool():
+    """(Re)create this process's pools. Safe to call from gunicorn's post_fork."""
+    global _pools, _pool_pid
+    with _lock:
+        minconn, maxconn = int(os.getenv('DB_POOL_MIN', 1)), int(os.getenv('DB_POOL_MAX', 10))
+        pools = {'primary': BlockingPool(minconn, maxconn, connection_factory=Connection, **_config)}
+        for name, params in _replicas.items():
+            # Connections are opened lazily, so a replica that is down now doesn't stop startup
+            pools[name] = BlockingPool(minconn, maxconn, lazy=True, connection_factory=Connection, **params)
+        _pools = pools
+        _pool_pid = os.getpid()
+    return _pools['primary']
+
+
+def close_pool():
+    """Close every connection owned by this process (worker_exit / shutdown)."""
+    global _pools, _pool_pid
+    with _lock:
+        if _pool_pid == os.getpid():
+            for pool in _pools.values():
+                pool.closeall()
+        _pools = {}
+        _pool_pid = None
+
+
+def pool_stats(name='primary'):
+    """{'used': n, 'idle': n, 'max': n, 'waiting': n} for one of this process's pools."""
+    pool = _pools.get(name)
+    if pool is None or _pool_pid != os.getpid():
+        return {'used': 0, 'idle': 0, 'max': 0, 'waiting': 0}
+    return {'used': len(pool._used), 'idle': len(pool._pool), 'max': pool.maxconn, 'waiting': pool.waiting}
+
+
+def replica_stats():
+    """{name: {'lag': seconds or None, 'up': bool}} for the configured replicas."""
+    now = time.time()
+    return {name: {'lag': st.lag, 'up': st.down_until <= now} for name, st in _replica_state.items()}
+
+
+def get_pool(name='primary'):
+    if not _pools or _pool_pid != os.getpid():
+        init_pool()
+    return _pools[name]
+
+
+def _replica_lag(conn):
+    cur = conn.cursor()
+    cur.execute(REPLICA_LAG_SQL)
+    lag = float(cur.fetchone()[0])
+    cur.close()
+    conn.rollback()
+    return lag
+
+
+def _alive(conn):
+    """False if the server has closed conn; reads what is already on the socket, no round trip."""
+    try:
+        conn.poll()
+    except psycopg2.Error:
+        return False
+    return not conn.closed
+
+
+def _replica_down(name):
+    """Skip a replica for REPLICA_RETRY_S; its idle connections died with it."""
+    state = _replica_state[name]
+    state.down_until = time.time() + REPLICA_RETRY_S
+    state.lag = None
+    pool = _pools.get(name)
+    if pool is not None and _pool_pid == os.getpid():
+        pool.discard_idle()
+
+
+def _borrow_replica():
+    """A connection to an in-sync replica, or None; tries each replica once, round-robin."""
+    names = list(_replicas)
+    if not names:
+        return None
+    start = next(_round_robin)
+    for name in names[start % len(names):] + names[:start % len(names)]:
+        state = _replica_state[name]
+        now = time.time()
+        if state.down_until > now:
+            continue
+        if state.lag is not None and state.lag > REPLICA_MAX_LAG_S and now - state.checked_at < REPLICA_CHECK_S:
+            continue
+        pool = get_pool(name)
+        try:
+            conn = pool.getconn(timeout=0)
+        except PoolError:
+            continue            # busy, not broken: the primary takes it
+        except psycopg2.Error:
+            _replica_down(name)
+            continue
+        try:
+            if not _alive(conn):
+                raise psycopg2.OperationalError('replica connection closed by the server')
+            if state.lag is None or now - state.checked_at >= REPLICA_CHECK_S:
+                state.lag = _replica_lag(conn)
+                state.checked_at = now
+        except psycopg2.Error:
+            pool.putconn(conn, close=True)
+            _replica_down(name)
+            continue
+        if state.lag > REPLICA_MAX_LAG_S:
+            pool.putconn(conn)
+            continue
+        conn.replica = name
+        return conn
+    return None
+
+
+@contextmanager
+def connection(readonly=False):
+    """
+    Borrow a pooled connection. Any transaction still open when the block
+    exits is rolled back, so callers must commit their own writes.
+
+    readonly=True may hand out a replica connection (conn.replica is its
+    name); use it only for reads that tolerate DB_REPLICA_MAX_LAG_S of lag.
+    """
+    conn = _borrow_replica() if readonly else None
+    pool = get_pool(conn.replica if conn is not None else 'primary')
+    if conn is None:
+        conn = pool.getconn()
+    conn.cursor_factory = Cursor
+    try:
+        yield conn
+    except psycopg2.Error:
+        # Lost mid-request: later reads go to the primary instead of more dead connections
+        if conn.replica is not None and conn.closed:
+            _replica_down(conn.replica)
+        raise
+    finally:
+        if conn.closed:
+            pool.putconn(conn, close=True)
+        else:
+            try:
+                if conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                pool.putconn(conn)
+            except psycopg2.Error:
+                pool.putconn(conn, close=True)
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+"""
+Streaming export of fleet history as CSV, GeoJSON text sequences or GPX.
+
+Points come from location_history and, unless disabled, the GPS/Network log
+messages (coordinates extracted in SQL with the same log_points rules as
+/history; the day bounds are turned into log createtime bounds by the
+database, in its time zone). Both are read through server-side cursors
+ordered by device and time and merged, together with the archive files for
+the part of the range before archived_before (see archive.py), so memory use
+does not depend on the number of rows. Output is produced in
+~64 KB chunks for a streamed HTTP response or a file.
+
+CSV of location_history alone (--no-logs) skips Python entirely and uses
+COPY ... TO STDOUT, unless the range reaches archived months.
+
+    python export.py --from 2025-10-01 --to 2025-11-01 --format csv --out october.csv
+    python export.py --from 2025-10-01 --to 2025-10-02 --device 123 --device 456 --format gpx --out day.gpx
+"""
+import argparse
+import csv
+import heapq
+import io
+import json
+import sys
+from datetime import datetime
+from xml.sax.saxutils import escape
+
+import archive
+import log_points
+
+FORMATS = {
+    'csv': 'text/csv',
+    'geojsonseq': 'application/geo+json-seq',
+    'gpx': 'application/gpx+xml',
+}
+EXTENSIONS = {'csv': 'csv', 'geojsonseq': 'geojsons', 'gpx': 'gpx'}
+CHUNK = 64 * 1024
+ITERSIZE = 20000
+
+HISTORY_EXPORT_SQL = """
+    SELECT {columns}
+    FROM location_history h
+    JOIN devices d ON d.id = h.device_id
+    WHERE h.recorded_at >= %(start)s AND h.recorded_at < %(end)s
+      {device_filter}
+    ORDER BY h.device_id, h.recorded_at
+"""
+
+LOG_EXPORT_SQL = f"""
+    SELECT deviceid, number, {log_points.AT}, {log_points.LAT}, {log_points.LON}, {log_points.PROVIDER}
+    FROM (
+        SELECT l.deviceid, d.number, l.createtime, l.message,
+               {log_points.MATCH_COLUMNS}
+        FROM plugin_devicelog_log l
+        JOIN devices d ON d.id = l.deviceid
+        WHERE {log_points.MESSAGE_FILTER}
+          AND l.createtime >= %(start_ms)s AND l.createtime < %(end_ms)s
+          {{device_filter}}
+    ) m
+    WHERE {log_points.HAS_FIX}
+    ORDER BY deviceid, createtime
+"""
+
+ARCHIVE_DEVICES_SQL = """
+    SELECT d.id, d.number FROM devices d
+    WHERE true {device_filter}
+    ORDER BY d.id
+"""
+
+DEVICE_FILTER = "AND d.number = ANY(%(devices)s)"
+HISTORY_COLUMNS = "h.device_id, d.number, h.recorded_at, h.lat, h.lon, COALESCE(h.source, 'history')"
+HISTORY_COPY_COLUMNS = "d.number AS device, h.recorded_at AS time, h.lat, h.lon, COALESCE(h.source, 'history') AS source"
+
+
+def _params(start, end, devices):
+    return {'start': start, 'end': end, 'devices': list(devices or [])}
+
+
+def _sql(template, devices, columns=HISTORY_COLUMNS):
+    return template.format(device_filter=DEVICE_FILTER if devices else '', columns=columns)
+
+
+def _named(conn, name, sql, params):
+    cur = conn.cursor(name=name)
+    cur.itersize = ITERSIZE
+    cur.execute(sql, params)
+    return cur
+
+
+def _points(cur):
+    # Both queries return (device_id, number, time, lat, lon, source)
+    for device_id, number, at, lat, lon, source in cur:
+        yield device_id, at, number, float(lat), float(lon), source
+
+
+def _archived(conn, store, start, end, devices, logs):
+    """Archived points in [start, end) as _points yields them, device by device."""
+    cur = conn.cursor()
+    cur.execute(_sql(ARCHIVE_DEVICES_SQL, devices), _params(start, end, devices))
+    numbers = cur.fetchall()
+    cur.close()
+    for device_id, number in numbers:
+        chunk = store.records(device_id, start, end)
+        if not logs:
+            chunk = chunk[chunk['src'] >= len(archive.LOG_SOURCES)]
+        if not len(chunk):
+            continue
+        sources = store.sources()
+        if int(chunk['src'].max()) >= len(sources):
+            sources = store.sources(reload=True)
+        times = chunk['t'].astype('datetime64[us]').astype(datetime)
+        for at, lat, lon, src in zip(times, (chunk['lat'] / 1e6).tolist(), (chunk['lon'] / 1e6).tolist(),
+                                     chunk['src'].tolist()):
+            yield device_id, at, number, lat, lon, sources[src] if src < len(sources) else 'history'
+
+
+def reaches_archive(store, start):
+    """True if [start, ...) needs points from store's files."""
+    archived_before = store.archived_before() if store else None
+    return bool(archived_before and start < archived_before)
+
+
+def iter_points(conn, start, end, devices=None, logs=True, store=None):
+    """
+    Yield (device_id, time, number, lat, lon, source) ordered by device and
+    time over [start, end), with log points unless logs is False and with
+    store's archived points before its archived_before. Must run inside a
+    transaction on conn (server-side cursors).
+    """
+    params = _params(start, end, devices)
+    streams = [_points(_named(conn, 'export_history', _sql(HISTORY_EXPORT_SQL, devices), params))]
+    if reaches_archive(store, start):
+        streams.append(_archived(conn, store, start, min(end, store.archived_before()), devices, logs))
+    if logs:
+        cur = conn.cursor()
+        params['start_ms'], params['end_ms'] = log_points.ms_bounds(cur, start, end)
+        cur.close()
+        streams.append(_points(_named(conn, 'export_logs', _sql(LOG_EXPORT_SQL, devices), params)))
+
+    last = None
+    for p in heapq.merge(*streams, key=lambda p: (p[0], p[1])):
+        key = (p[0], p[1], round(p[3], 6), round(p[4], 6))
+        if key == last:
+            continue  # same fix stored by a snapshot writer and in the log
+        last = key
+        yield p
+
+
+def _chunked(pieces):
+    buf, size = [], 0
+    for piece in pieces:
+        buf.append(piece)
+        size += len(piece)
+        if size >= CHUNK:
+            yield ''.join(buf)
+            buf, size = [], 0
+    if buf:
+        yield ''.join(buf)
+
+
+def _csv(points):
+    buf = io.StringIO()
+    writer = csv.writer(buf, lineterminator='\n')
+    writer.writerow(('device', 'time', 'lat', 'lon', 'source'))
+    for _, at, number, lat, lon, source in points:
+        writer.writerow((number, at.isoformat(), f'{lat:.6f}', f'{lon:.6f}', source))
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    yield buf.getvalue()
+
+
+def _geojsonseq(points):
+    # RFC 8142: each text is prefixed with RS and ends with LF
+    for _, at, number, lat, lon, source in points:
+        yield '\x1e' + json.dumps({
+            'type': 'Feature',
+            'geometry': {'type': 'Point', 'coordinates': [round(lon, 6), round(lat, 6)]},
+            'properties': {'device': number, 'time': at.isoformat(), 'source': source},
+        }, separators=(',', ':')) + '\n'
+
+
+def _gpx(points):
+    yield ('<?xml version="1.0" encoding="UTF-8"?>\n'
+           '<gpx version="1.1" creator="headwind-mdm-maps-lite" xmlns="http://www.topografix.com/GPX/1/1">\n')
+    current = None
+    for device_id, at, number, lat, lon, source in points:
+        if device_id != current:
+            if current is not None:
+                yield '</trkseg></trk>\n'
+            yield f'<trk><name>{escape(number)}</name><trkseg>\n'
+            current = device_id
+        yield (f'<trkpt lat="{lat:.6f}" lon="{lon:.6f}"><time>{at.isoformat()}</time>'
+               f'<src>{escape(source)}</src></trkpt>\n')
+    if current is not None:
+        yield '</trkseg></trk>\n'
+    yield '</gpx>\n'
+
+
+WRITERS = {'csv': _csv, 'geojsonseq': _geojsonseq, 'gpx': _gpx}
+
+
+def render(fmt, points):
+    """Chunks of text in the given format."""
+    return _chunked(WRITERS[fmt](points))
+
+
+def copy_history_csv(conn, start, end, devices, out):
+    """location_history-only CSV straight from COPY ... TO STDOUT."""
+    cur = conn.cursor()
+    select = cur.mogrify(_sql(HISTORY_EXPORT_SQL, devices, HISTORY_COPY_COLUMNS),
+                         _params(start, end, devices)).decode('utf-8')
+    cur.copy_expert(f"COPY ({select}) TO STDOUT WITH (FORMAT csv, HEADER)", out)
+    cur.close()
+
+
+def main():
+    import db
+    from dotenv import load_dotenv
+    load_dotenv()
+    db.configure(db.env_config())
+
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--from', dest='start', required=True, help='YYYY-MM-DD (inclusive)')
+    ap.add_argument('--to', dest='end', required=True, help='YYYY-MM-DD (exclusive)')
+    ap.add_argument('--device', action='append', help='device number (repeatable; default all)')
+    ap.add_argument('--format', choices=sorted(FORMATS), default='csv')
+    ap.add_argument('--no-logs', action='store_true', help='location_history only')
+    ap.add_argument('--out', help='output file (default: stdout)')
+    args = ap.parse_args()
+
+    start = datetime.strptime(args.start, '%Y-%m-%d')
+    end = datetime.strptime(args.end, '%Y-%m-%d')
+    out = open(args.out, 'w', newline='', encoding='utf-8') if args.out else sys.stdout
+    try:
+        store = archive.Archive()
+        with db.connection() as conn:
+            if args.format == 'csv' and args.no_logs and not reaches_archive(store, start):
+                copy_history_csv(conn, start, end, args.device, out)
+            else:
+                for chunk in render(args.format, iter_points(conn, start, end, args.device, not args.no_logs,
+                                                             store)):
+                    out.write(chunk)
+    finally:
+        if args.out:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+Fleet-wide daily movement report.
+
+Builds every device's point set with FLEET_POINTS_SQL, the fleet-wide form of
+/history's HISTORY_SQL (the same log_points extraction, the same
+location_history rows, the same de-duplication and order) plus archived
+months, and runs movement.stats_from_points on it, so the numbers match
+/api/device/<n>/stats over the same window. The points are streamed through a
+server-side cursor ordered by device, so memory stays at one device's points.
+
+    python fleet_report.py                          # yesterday, CSV to stdout
+    python fleet_report.py --date 2025-10-07 --days 7 --out week.csv
+    python fleet_report.py --format json --out report.json
+"""
+import argparse
+import csv
+import itertools
+import json
+import sys
+from datetime import datetime, timedelta
+
+from dotenv import load_dotenv
+
+import archive
+import db
+import log_points
+import movement
+from db import DictCursor
+
+# HISTORY_SQL's points part for every device over [start, end)
+FLEET_POINTS_SQL = f"""
+    WITH logs AS (
+        SELECT l.deviceid AS device_id, l.createtime, l.message,
+               {log_points.MATCH_COLUMNS}
+        FROM plugin_devicelog_log l
+        WHERE {log_points.MESSAGE_FILTER}
+          AND l.createtime >= %(start_ms)s AND l.createtime < %(end_ms)s
+    ),
+    points AS (
+        SELECT device_id, {log_points.AT} AS at, 0 AS src, createtime AS ord,
+               {log_points.LAT} AS lat,
+               {log_points.LON} AS lon,
+               'log' AS type,
+               {log_points.PROVIDER} AS provider
+        FROM logs
+        WHERE {log_points.HAS_FIX}
+        UNION ALL
+        SELECT device_id, recorded_at, 1, id, lat, lon, 'history', COALESCE(source, 'history')
+        FROM location_history
+        WHERE recorded_at >= %(start)s AND recorded_at < %(end)s
+    )
+    SELECT device_id, at, lat, lon, type, provider FROM (
+        SELECT DISTINCT ON (device_id, at, round(lat::numeric, 6), round(lon::numeric, 6))
+               device_id, at, src, ord, lat, lon, type, provider
+        FROM points
+        ORDER BY device_id, at, round(lat::numeric, 6), round(lon::numeric, 6), src, ord
+    ) dedup
+    ORDER BY device_id, at, src, ord
+"""
+
+COLUMNS = ['number', 'description', 'points', 'distance_km', 'moving_minutes', 'idle_minutes', 'gap_minutes',
+           'max_speed_kmh', 'avg_speed_kmh', 'spikes', 'jumps', 'first', 'last']
+
+
+def grouped(cur):
+    """Yield (device_id, points) from FLEET_POINTS_SQL rows, points shaped like /history's."""
+    for device_id, rows in itertools.groupby(cur, key=lambda r: r['device_id']):
+        yield device_id, [{'lat': r['lat'], 'lon': r['lon'], 'time': r['at'].isoformat(),
+                           'type': r['type'], 'provider': r['provider']} for r in rows]
+
+
+def fleet_stats(start, end, store=None):
+    """Yield (device, stats) for every device over [start, end)."""
+    store = store or archive.Archive()
+    archived_before = store.archived_before()
+    with db.connection(readonly=True) as conn:
+        cur = conn.cursor(cursor_factory=DictCursor)
+        cur.execute("SELECT id, number, description FROM devices ORDER BY id")
+        devices = cur.fetchall()
+        cur.close()
+
+        cur = conn.cursor()
+        start_ms, end_ms = log_points.ms_bounds(cur, start, end)
+        cur.close()
+        points_cur = conn.cursor(name='fleet_report_points', cursor_factory=DictCursor)
+        points_cur.itersize = 20000
+        points_cur.execute(FLEET_POINTS_SQL, {'start': start, 'end': end, 'start_ms': start_ms, 'end_ms': end_ms})
+
+        groups = grouped(points_cur)
+        pending = next(groups, None)
+        for device in devices:
+            # Skip points of device ids that no longer exist in devices
+            while pending and pending[0] < device['id']:
+                pending = next(groups, None)
+            points = []
+            if pending and pending[0] == device['id']:
+                points, pending = pending[1], next(groups, None)
+            if archived_before and start < archived_before:
+                points = archive.merge_points(
+                    store.read_points(device['id'], start, min(end, archived_before)), points)
+            yield device, movement.stats_from_points(points)
+
+        points_cur.close()
+
+
+def row_for(device, stats):
+    row = dict(stats, number=device['number'], description=device['description'])
+    row['spikes'] = stats['outliers']['spikes']
+    row['jumps'] = stats['outliers']['jumps']
+    return {k: row[k] for k in COLUMNS}
+
+
+def main():
+    load_dotenv()
+    db.configure(db.env_config())
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--date', help='first day, YYYY-MM-DD (default: yesterday)')
+    ap.add_argument('--days', type=int, default=1)
+    ap.add_argument('--format', choices=['csv', 'json'], default='csv')
+    ap.add_argument('--out', help='output file (default: stdout)')
+    ap.add_argument('--active-only', action='store_true', help='skip devices without points')
+    args = ap.parse_args()
+
+    today = datetime.combine(datetime.now().date(), datetime.min.time())
+    start = datetime.strptime(args.date, '%Y-%m-%d') if args.date else today - timedelta(days=1)
+    end = start + timedelta(days=args.days)
+
+    rows = (row_for(d, s) for d, s in fleet_stats(start, end))
+    if args.active_only:
+        rows = (r for r in rows if r['points'])
+
+    out = open(args.out, 'w', newline='') if args.out else sys.stdout
+    try:
+        if args.format == 'csv':
+            writer = csv.DictWriter(out, fieldnames=COLUMNS)
+            writer.writeheader()
+            writer.writerows(rows)
+        else:
+            json.dump({'from': start.isoformat(), 'to': end.isoformat(), 'devices': list(rows)}, out, indent=1)
+            out.write('\n')
+    finally:
+        if args.out:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""
+Location freshness: how old a fix is by the time the map can show it.
+
+Every stage reports the age of a fix (now - location.ts, log createtime or
+recorded_at) at the moment it passes through:
+
+  • locations         a new devices.info fix first appears in /api/locations
+  • history           a device's newest log/history point first appears in /history
+  • snapshot_all      POST /api/snapshot_all stores a fix in location_history
+  • history_snapshot  /history stores the live fix in location_history
+  • auto-save         save-locations.py stores a fix in location_history
+
+Per stage the ages go to the maps_location_freshness_seconds histogram. Per
+device and stage the tracker keeps a count, sum, max, last age and the same
+bucket counts, shown at /admin/freshness. Those are buffered per process and
+merged into the shared cache every FRESHNESS_FLUSH_S seconds (one key per
+stage), so all workers and the poller land on the same page. Device clocks
+ahead of the server count as age 0.
+"""
+import bisect
+import os
+import threading
+import time
+
+import metrics
+
+STAGES = ('locations', 'history', 'snapshot_all', 'history_snapshot', 'auto-save')
+BUCKETS = (5, 10, 15, 30, 60, 120, 180, 300, 600, 900, 1800, 3600, 4 * 3600, 24 * 3600)
+STORE_KEY = 'freshness:{stage}'
+STORE_TTL = 7 * 86400
+
+LAG = metrics.Histogram('maps_location_freshness_seconds', 'Age of a fix when it was first served or stored',
+                        ['stage'], buckets=BUCKETS)
+
+# Per device and stage: [count, sum, max, last age, newest fix ts, bucket counts..., +Inf]
+N, SUM, MAX, LAST, FIX_TS, B0 = range(6)
+
+
+def _empty():
+    return [0, 0.0, 0.0, 0.0, 0.0] + [0] * (len(BUCKETS) + 1)
+
+
+def _merge(into, stat):
+    into[N] += stat[N]
+    into[SUM] += stat[SUM]
+    into[MAX] = max(into[MAX], stat[MAX])
+    if stat[FIX_TS] >= into[FIX_TS]:
+        into[LAST], into[FIX_TS] = stat[LAST], stat[FIX_TS]
+    for i in range(B0, len(into)):
+        into[i] += stat[i]
+
+
+def quantile(stat, q):
+    """Upper bound of the bucket holding the q-quantile (max age for the +Inf bucket)."""
+    if not stat[N]:
+        return None
+    target, seen = q * stat[N], 0
+    for i, upper in enumerate(BUCKETS):
+        seen += stat[B0 + i]
+        if seen >= target:
+            return round(min(upper, stat[MAX]), 1)
+    return round(stat[MAX], 1)
+
+
+def summarize(stat):
+    return {
+        'count': stat[N],
+        'avg_s': round(stat[SUM] / stat[N], 1) if stat[N] else None,
+        'p50_s': quantile(stat, 0.5),
+        'p95_s': quantile(stat, 0.95),
+        'p99_s': quantile(stat, 0.99),
+        'max_s': round(stat[MAX], 1),
+        'last_s': round(stat[LAST], 1),
+    }
+
+
+class FreshnessTracker:
+    def __init__(self, store=None, flush_interval=None):
+        self.store = store          # shared_cache backend, or None for this process only
+        self.flush_interval = float(flush_interval if flush_interval is not None
+                                    else os.getenv('FRESHNESS_FLUSH_S', 30))
+        self._pending = {}          # stage -> {device: stat} since the last flush
+        self._local = {}            # stage -> {device: stat} when there is no store
+        self._seen = {}             # (stage, device) -> newest fix ts already counted
+        self._primed = set()        # first_only stages whose _seen is initialized
+        self._flushed_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def observe(self, stage, device, fix_ts, now=None):
+        """Count one fix taken at fix_ts (epoch seconds) reaching stage now."""
+        self.observe_many(stage, [(device, fix_ts)], now)
+
+    def observe_many(self, stage, fixes, now=None, first_only=False):
+        """
+        observe() for [(device, fix_ts)]. With first_only a fix is counted only
+        if it is newer than the last one counted for that device and stage
+        (a fix stays in /api/locations until the next one replaces it).
+        Returns the number counted.
+        """
+        now = time.time() if now is None else now
+        if first_only and stage not in self._primed:
+            fixes = self._prime(stage, fixes)
+        counted = 0
+        with self._lock:
+            pending = self._pending.setdefault(stage, {})
+            for device, fix_ts in fixes:
+                if fix_ts is None:
+                    continue
+                if first_only:
+                    if self._seen.get((stage, device), 0.0) >= fix_ts:
+                        continue
+                    self._seen[(stage, device)] = fix_ts
+                age = max(0.0, now - fix_ts)
+                stat = pending.get(device)
+                if stat is None:
+                    stat = pending[device] = _empty()
+                stat[N] += 1
+                stat[SUM] += age
+                stat[MAX] = max(stat[MAX], age)
+                if fix_ts >= stat[FIX_TS]:
+                    stat[LAST], stat[FIX_TS] = age, fix_ts
+                stat[B0 + bisect.bisect_left(BUCKETS, age)] += 1
+                LAG.observe(age, stage=stage)
+                counted += 1
+        if time.monotonic() - self._flushed_at >= self.flush_interval:
+            self.flush()
+        return counted
+
+    def _prime(self, stage, fixes):
+        """
+        Learn which fixes were already counted (by any process) before this
+        process counts its first batch. With nothing to learn from, the first
+        batch only primes: a restart must not count every standing fix again.
+        """
+        cached = self.store.get(STORE_KEY.format(stage=stage)) if self.store is not None else None
+        with self._lock:
+            if cached:
+                for device, stat in cached.value.items():
+                    self._seen[(stage, device)] = max(self._seen.get((stage, device), 0.0), stat[FIX_TS])
+            else:
+                for device, fix_ts in fixes:
+                    if fix_ts is not None:
+                        self._seen[(stage, device)] = fix_ts
+                fixes = []
+            self._primed.add(stage)
+        return fixes
+
+    def flush(self):
+        """Merge the buffered stats into the shared store (or this process's totals)."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._flushed_at = time.monotonic()
+            if self.store is None:
+                for stage, devices in pending.items():
+                    merged = self._local.setdefault(stage, {})
+                    for device, stat in devices.items():
+                        _merge(merged.setdefault(device, _empty()), stat)
+                return
+            # Read-modify-write per stage; a concurrent flush from another
+            # worker can occasionally be lost, which is fine for diagnostics.
+            for stage, devices in pending.items():
+                key = STORE_KEY.format(stage=stage)
+                cached = self.store.get(key)
+                merged = dict(cached.value) if cached else {}
+                for device, stat in devices.items():
+                    current = merged.get(device) or _empty()
+                    _merge(current, stat)
+                    merged[device] = current
+                self.store.set(key, merged, STORE_TTL)
+                # Fixes another worker already counted don't count again here
+                for device, stat in merged.items():
+                    seen = self._seen.get((stage, device), 0.0)
+                    if stat[FIX_TS] > seen:
+                        self._seen[(stage, device)] = stat[FIX_TS]
+
+    def stages(self):
+        """{stage: {device: stat}} merged over every writer."""
+        self.flush()
+        if self.store is None:
+            with self._lock:
+                return {stage: dict(devices) for stage, devices in self._local.items()}
+        out = {}
+        for stage in STAGES:
+            cached = self.store.get(STORE_KEY.format(stage=stage))
+            if cached:
+                out[stage] = cached.value
+        return out
+
+    def report(self, stage=None, limit=200):
+        """Per-stage summaries plus the stalest devices (by p95) of one stage."""
+        stages = self.stages()
+        summary = {}
+        for name, devices in stages.items():
+            total = _empty()
+            for stat in devices.values():
+                _merge(total, stat)
+            summary[name] = dict(summarize(total), devices=len(devices))
+        devices = stages.get(stage, {}) if stage else {}
+        rows = sorted(((device, summarize(stat)) for device, stat in devices.items()),
+                      key=lambda r: (r[1]['p95_s'] or 0, r[1]['max_s']), reverse=True)
+        return {
+            'stages': summary,
+            'stage': stage,
+            'devices': [dict(s, device=d) for d, s in rows[:limit]],
+        }
+
+    def clear(self):
+        with self._lock:
+            self._pending.clear()
+            self._local.clear()
+        if self.store is not None:
+            for stage in STAGES:
+                self.store.delete(STORE_KEY.format(stage=stage))
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+"""
+Synthetic fleet generator for load tests and benchmarks.
+
+Populates a LOCAL Postgres (never point this at production) with:
+  • devices               realistic devices.info JSON (location, battery, apps…)
+  • plugin_devicelog_log  GPS/Network location updates in the same mixed
+                          formats parse_gps_from_message handles (JSON and
+                          "lat=.., lon=.." / "latitude=.., longitude=.." text)
+                          plus non-location noise rows
+  • location_history      periodic snapshots along the same tracks
+
+Every device drives a random-walk route around one of a few cities, so
+history, logs and the current fix are consistent. Rows are streamed with
+COPY FROM STDIN, split across --jobs processes.
+
+    python generate_fleet.py --schema --devices 10000 --log-rows 100000000 --days 30 --jobs 8
+    python generate_fleet.py --reset --devices 200 --log-rows 200000 --bench-user bench:bench
+"""
+import argparse
+import json
+import math
+import os
+import random
+import time
+from datetime import datetime, timedelta
+from multiprocessing import Pool
+
+import bcrypt
+import psycopg2
+from psycopg2.extras import execute_values
+from dotenv import load_dotenv
+
+load_dotenv()
+
+DB_CONFIG = {
+    'host': os.getenv('DB_HOST', 'localhost'),
+    'port': int(os.getenv('DB_PORT', 5432)),
+    'database': os.getenv('DB_NAME', 'hmdm'),
+    'user': os.getenv('DB_USER', 'hmdm'),
+    'password': os.getenv('DB_PASSWORD', 'topsecret')
+}
+
+CITIES = [
+    (18.0179, -76.8099),   # Kingston
+    (18.4762, -77.8939),   # Montego Bay
+    (17.9970, -77.2422),   # Spanish Town / May Pen corridor
+    (40.7128, -74.0060),   # New York
+    (25.7617, -80.1918),   # Miami
+]
+MODELS = ['SM-A515F', 'SM-T295', 'Pixel 6a', 'TC52', 'CT40', 'moto g(8)']
+APPS = ['com.hmdm.launcher', 'com.hmdm.pager', 'com.android.chrome', 'com.google.android.gm',
+        'com.whatsapp', 'com.microsoft.teams', 'com.example.dispatch', 'com.example.scanner']
+NOISE_MESSAGES = [
+    'Application started: com.example.dispatch',
+    'Configuration updated',
+    'Battery level: {battery}%',
+    'Network changed: wifi',
+    'Launcher restarted',
+]
+
+METERS_PER_DEG = 111_320.0
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Track + message synthesis
+# ──────────────────────────────────────────────────────────────────────────────
+class Track:
+    """Random-walk vehicle: drives at 0–25 m/s, turns gradually, stops now and then."""
+
+    def __init__(self, rng, lat, lon):
+        self.rng = rng
+        self.lat, self.lon = lat, lon
+        self.heading = rng.uniform(0, 2 * math.pi)
+        self.speed = rng.uniform(0, 15)
+        self.stopped_for = 0.0
+
+    def step(self, dt):
+        rng = self.rng
+        if self.stopped_for > 0:
+            self.stopped_for -= dt
+            return self.lat, self.lon
+        if rng.random() < 0.02:
+            self.stopped_for = rng.uniform(300, 3600)   # a stop of 5–60 min
+            return self.lat, self.lon
+        self.heading += rng.gauss(0, 0.4)
+        self.speed = min(25.0, max(0.0, self.speed + rng.gauss(0, 2)))
+        dist = self.speed * dt
+        self.lat += math.cos(self.heading) * dist / METERS_PER_DEG
+        self.lon += math.sin(self.heading) * dist / (METERS_PER_DEG * max(0.1, math.cos(math.radians(self.lat))))
+        return self.lat, self.lon
+
+
+def location_message(rng, lat, lon):
+    acc = rng.randint(3, 60)
+    kind = rng.random()
+    if kind < 0.45:
+        return f'GPS location update: lat={lat:.6f}, lon={lon:.6f}, accuracy={acc}'
+    if kind < 0.70:
+        return f'Network location update: latitude={lat:.6f}, longitude={lon:.6f}'
+    if kind < 0.90:
+        return json.dumps({'event': 'GPS location update', 'lat': round(lat, 6), 'lon': round(lon, 6), 'accuracy': acc})
+    return json.dumps({'event': 'Network location update', 'latitude': round(lat, 6), 'longitude': round(lon, 6)})
+
+
+def device_info(rng, number, lat, lon, ts_ms):
+    return json.dumps({
+        'deviceId': number,
+        'model': rng.choice(MODELS),
+        'androidVersion': rng.choice(['10', '11', '12', '13', '14']),
+        'batteryLevel': rng.randint(5, 100),
+        'batteryCharging': rng.random() < 0.2,
+        'mdmMode': True,
+        'kioskMode': rng.random() < 0.5,
+        'launcherVersion': '6.18',
+        'permissions': [1, 1, 1],
+        'location': {'lat': round(lat, 6), 'lon': round(lon, 6), 'ts': ts_ms},
+        'applications': [
+            {'pkg': pkg, 'name': pkg.rsplit('.', 1)[-1], 'version': f'{rng.randint(1, 9)}.{rng.randint(0, 20)}'}
+            for pkg in rng.sample(APPS, k=rng.randint(3, len(APPS)))
+        ],
+    })
+
+
+class LineStream:
+    """File-like adapter so copy_expert can pull COPY text from a generator."""
+
+    def __init__(self, lines, batch=2000):
+        self._lines = iter(lines)
+        self._batch = batch
+        self._buf = b''
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buf) < size:
+            chunk = []
+            for line in self._lines:
+                chunk.append(line)
+                if len(chunk) >= self._batch:
+                    break
+            if not chunk:
+                break
+            self._buf += ''.join(chunk).encode('utf-8')
+        if size < 0:
+            out, self._buf = self._buf, b''
+        else:
+            out, self._buf = self._buf[:size], self._buf[size:]
+        return out
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Work split across processes
+# ──────────────────────────────────────────────────────────────────────────────
+def generate_chunk(task):
+    """Generate logs + history for a slice of devices; returns (logs, history, seconds)."""
+    devices, args = task
+    started = time.time()
+    end = datetime.now()
+    start = end - timedelta(days=args.days)
+    span_s = (end - start).total_seconds()
+    logs_per_device = max(1, args.log_rows // args.devices)
+    history_every = max(1, round(args.log_rows / max(1, args.history_rows))) if args.history_rows else 0
+
+    counts = {'logs': 0, 'history': 0}
+    finals = []
+    history_lines = []
+
+    def log_lines():
+        for dev_id, idx in devices:
+            rng = random.Random(args.seed * 1_000_003 + idx)
+            home = CITIES[idx % len(CITIES)]
+            track = Track(rng, home[0] + rng.uniform(-0.15, 0.15), home[1] + rng.uniform(-0.15, 0.15))
+            step = span_s / logs_per_device
+            t, end_ts = start.timestamp(), end.timestamp()
+            lat, lon = track.lat, track.lon
+            for i in range(logs_per_device):
+                dt = step * rng.uniform(0.5, 1.5)
+                t = min(t + dt, end_ts)
+                ts_ms = int(t * 1000)
+                if rng.random() < args.noise:
+                    msg = rng.choice(NOISE_MESSAGES).format(battery=rng.randint(5, 100))
+                else:
+                    lat, lon = track.step(dt)
+                    msg = location_message(rng, lat, lon)
+                    if history_every and i % history_every == 0:
+                        history_lines.append(
+                            f"{dev_id}\t{lat:.6f}\t{lon:.6f}\t{datetime.fromtimestamp(t).isoformat()}\t"
+                            f"{rng.choice(['snapshot_all', 'auto-save', 'snapshot'])}\n")
+                counts['logs'] += 1
+                yield f"{ts_ms}\t{dev_id}\t10.0.{idx % 256}.{rng.randint(1, 254)}\t{rng.choice([2, 3, 4])}\t{msg}\n"
+            finals.append((dev_id, idx, lat, lon, int(t * 1000)))
+
+    conn = psycopg2.connect(**DB_CONFIG)
+    cur = conn.cursor()
+    cur.copy_expert(
+        "COPY plugin_devicelog_log (createtime, deviceid, ipaddress, severity, message) FROM STDIN",
+        LineStream(log_lines())
+    )
+    if history_lines:
+        cur.copy_expert(
+            "COPY location_history (device_id, lat, lon, recorded_at, source) FROM STDIN",
+            LineStream(history_lines)
+        )
+        counts['history'] = len(history_lines)
+
+    # Current fix in devices.info = end of each device's track
+    updates = []
+    for dev_id, idx, lat, lon, ts_ms in finals:
+        rng = random.Random(args.seed * 7919 + idx)
+        updates.append((dev_id, device_info(rng, f'{args.prefix}{idx:05d}', lat, lon, ts_ms)))
+    execute_values(cur, "UPDATE devices d SET info = v.info FROM (VALUES %s) AS v(id, info) WHERE d.id = v.id",
+                   updates, page_size=500)
+    conn.commit()
+    cur.close(); conn.close()
+    return counts['logs'], counts['history'], time.time() - started
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Main
+# ──────────────────────────────────────────────────────────────────────────────
+def parse_args():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--devices', type=int, default=1000)
+    ap.add_argument('--log-rows', type=int, default=1_000_000, help='total plugin_devicelog_log rows')
+    ap.add_argument('--history-rows', type=int, help='total location_history rows (default: log rows / 10)')
+    ap.add_argument('--days', type=int, default=30, help='time span covered by the data')
+    ap.add_argument('--noise', type=float, default=0.3, help='fraction of non-location log rows')
+    ap.add_argument('--prefix', default='SIM', help='device number prefix (SIM00001, …)')
+    ap.add_argument('--seed', type=int, default=42)
+    ap.add_argument('--jobs', type=int, default=os.cpu_count() or 2)
+    ap.add_argument('--schema', action='store_true', help='apply schema.sql first')
+    ap.add_argument('--reset', action='store_true', help='delete previously generated devices and their rows')
+    ap.add_argument('--bench-user', metavar='USER:PASSWORD', help='create/update an admin login for benchmarks')
+    args = ap.parse_args()
+    if args.history_rows is None:
+        args.history_rows = args.log_rows // 10
+    return args
+
+
+def main():
+    args = parse_args()
+    conn = psycopg2.connect(**DB_CONFIG)
+    cur = conn.cursor()
+
+    if args.schema:
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schema.sql')) as f:
+            cur.execute(f.read())
+        conn.commit()
+
+    if args.reset:
+        print(f"Removing devices '{args.prefix}%' and their rows...")
+        cur.execute("SELECT id FROM devices WHERE number LIKE %s", (args.prefix + '%',))
+        ids = [r[0] for r in cur.fetchall()]
+        if ids:
+            cur.execute("DELETE FROM plugin_devicelog_log WHERE deviceid = ANY(%s)", (ids,))
+            cur.execute("DELETE FROM location_history WHERE device_id = ANY(%s)", (ids,))
+            cur.execute("DELETE FROM devices WHERE id = ANY(%s)", (ids,))
+        conn.commit()
+
+    if args.bench_user:
+        username, _, password = args.bench_user.partition(':')
+        pw_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+        cur.execute("""
+            INSERT INTO map_users (username, password_hash, full_name, is_admin, created_at)
+            VALUES (%s, %s, 'Benchmark', TRUE, NOW())
+            ON CONFLICT (username) DO UPDATE SET password_hash = EXCLUDED.password_hash
+        """, (username, pw_hash))
+        conn.commit()
+
+    # Devices first (info is filled in by the workers once tracks are known)
+    rows = [(f'{args.prefix}{i:05d}', f'Vehicle {i:05d}', f'35{random.Random(i).randint(10**12, 10**13 - 1)}')
+            for i in range(args.devices)]
+    execute_values(cur, """
+        INSERT INTO devices (number, description, imei, info) VALUES %s
+        ON CONFLICT (number) DO NOTHING
+    """, [r + ('{}',) for r in rows], page_size=1000)
+    conn.commit()
+    cur.execute("SELECT id, number FROM devices WHERE number LIKE %s ORDER BY number", (args.prefix + '%',))
+    devices = [(dev_id, int(number[len(args.prefix):])) for dev_id, number in cur.fetchall()][:args.devices]
+
+    print(f"Generating {args.log_rows:,} log rows and ~{args.history_rows:,} history rows "
+          f"for {len(devices):,} devices over {args.days} days ({args.jobs} jobs)...")
+    chunk = max(1, math.ceil(len(devices) / (args.jobs * 4)))
+    tasks = [(devices[i:i + chunk], args) for i in range(0, len(devices), chunk)]
+
+    started = time.time()
+    total_logs = total_hist = 0
+    with Pool(args.jobs) as pool:
+        for n, (logs, hist, secs) in enumerate(pool.imap_unordered(generate_chunk, tasks), 1):
+            total_logs += logs
+            total_hist += hist
+            rate = total_logs / max(1e-6, time.time() - started)
+            print(f"  [{n}/{len(tasks)}] {total_logs:,} logs, {total_hist:,} history ({rate:,.0f} rows/s)")
+
+    print("ANALYZE...")
+    conn.autocommit = True
+    for table in ('devices', 'plugin_devicelog_log', 'location_history'):
+        cur.execute(f"ANALYZE {table}")
+    cur.close(); conn.close()
+    print(f"Done in {time.time() - started:.0f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,401 @@
+#!/usr/bin/env python3
+"""
+Geofences (polygons and circles) and enter/exit events.
+
+Fences live in `geofences`; every evaluation run takes the location_history
+rows recorded since the watermark in geofence_job_state, looks each point up
+in an STR-packed R-tree of fence bounding boxes, tests only the candidate
+fences exactly, and compares the result with the device's stored inside set
+(geofence_device_state). Only transitions are written to geofence_events.
+
+Evaluation runs only in this job. The watermark (settled_until) is a
+recorded_at time: a run evaluates points up to GEOFENCE_SETTLE_S before the
+database's now(), so a point committed late (ids are handed out before
+commit, and every writer inserts concurrently) is still picked up as long as
+it lands within that window.
+
+    python geofences.py --schema --once
+    python geofences.py --interval 30
+
+Points older than the last one evaluated for a device are skipped: state
+only moves forward in time.
+"""
+import argparse
+import json
+import math
+import os
+import time
+from datetime import datetime, timedelta
+
+import psycopg2
+from psycopg2.extras import execute_values
+from dotenv import load_dotenv
+
+KINDS = ('polygon', 'circle')
+NODE_CAPACITY = 16
+SETTLE_S = float(os.getenv('GEOFENCE_SETTLE_S', 60))
+# Seconds of points evaluated per transaction while catching up
+BATCH_S = float(os.getenv('GEOFENCE_BATCH_S', 3600))
+METERS_PER_DEG_LAT = 111320.0
+
+SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS geofences (
+    id          SERIAL PRIMARY KEY,
+    name        VARCHAR(255) NOT NULL,
+    kind        VARCHAR(8) NOT NULL,            -- 'polygon' | 'circle'
+    polygon     TEXT,                           -- JSON [[lat, lon], ...]
+    center_lat  DOUBLE PRECISION,
+    center_lon  DOUBLE PRECISION,
+    radius_m    DOUBLE PRECISION,
+    created_at  TIMESTAMP NOT NULL DEFAULT NOW(),
+    updated_at  TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS geofence_device_state (
+    device_id   INT PRIMARY KEY,
+    inside      INT[] NOT NULL DEFAULT '{}',
+    last_at     TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS geofence_events (
+    id          BIGSERIAL PRIMARY KEY,
+    device_id   INT NOT NULL,
+    fence_id    INT NOT NULL,
+    event       VARCHAR(5) NOT NULL,            -- 'enter' | 'exit'
+    at          TIMESTAMP NOT NULL,
+    lat         DOUBLE PRECISION NOT NULL,
+    lon         DOUBLE PRECISION NOT NULL
+);
+CREATE INDEX IF NOT EXISTS geofence_events_device_time ON geofence_events (device_id, at);
+CREATE INDEX IF NOT EXISTS geofence_events_fence_time ON geofence_events (fence_id, at);
+
+CREATE TABLE IF NOT EXISTS geofence_job_state (
+    id              INT PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+    settled_until   TIMESTAMP,                  -- points recorded up to this are evaluated
+    updated_at      TIMESTAMP
+);
+-- Earlier versions kept an id watermark: carry on from its point's recorded_at
+ALTER TABLE geofence_job_state ADD COLUMN IF NOT EXISTS settled_until TIMESTAMP;
+ALTER TABLE geofence_job_state ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP;
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM information_schema.columns
+               WHERE table_name = 'geofence_job_state' AND column_name = 'last_history_id') THEN
+        UPDATE geofence_job_state s
+        SET settled_until = (SELECT recorded_at FROM location_history WHERE id = s.last_history_id);
+        ALTER TABLE geofence_job_state DROP COLUMN last_history_id;
+    END IF;
+END $$;
+"""
+
+FENCES_SQL = """
+    SELECT id, name, kind, polygon, center_lat, center_lon, radius_m, created_at, updated_at
+    FROM geofences
+    ORDER BY id
+"""
+
+FENCES_VERSION_SQL = "SELECT COUNT(*), MAX(updated_at) FROM geofences"
+
+SETTLED_UNTIL_SQL = "SELECT (now() - make_interval(secs => %s))::timestamp"
+
+# Points recorded in (since, until]: one (device_id, recorded_at) index range per device
+NEW_POINTS_SQL = """
+    SELECT h.device_id, h.lat, h.lon, h.recorded_at
+    FROM devices d
+    CROSS JOIN LATERAL (
+        SELECT device_id, lat, lon, recorded_at, id
+        FROM location_history
+        WHERE device_id = d.id AND recorded_at > %s AND recorded_at <= %s
+    ) h
+    ORDER BY h.device_id, h.recorded_at, h.id
+"""
+
+EVENTS_SQL = """
+    SELECT e.id, e.event, e.at, e.lat, e.lon, e.fence_id, f.name AS fence, d.number AS device
+    FROM geofence_events e
+    JOIN devices d ON d.id = e.device_id
+    LEFT JOIN geofences f ON f.id = e.fence_id
+    WHERE e.id > %(after)s
+      {filters}
+    ORDER BY e.id
+    LIMIT %(limit)s
+"""
+
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    dp, dl = p2 - p1, math.radians(lon2 - lon1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * 6371000.0 * math.asin(math.sqrt(min(1.0, a)))
+
+
+def point_in_polygon(lat, lon, ring):
+    """Even-odd ray cast on a ring of (lat, lon); fine for site-sized fences."""
+    inside = False
+    j = len(ring) - 1
+    for i in range(len(ring)):
+        yi, xi = ring[i]
+        yj, xj = ring[j]
+        if (yi > lat) != (yj > lat) and lon < (xj - xi) * (lat - yi) / (yj - yi) + xi:
+            inside = not inside
+        j = i
+    return inside
+
+
+class Fence:
+    __slots__ = ('id', 'name', 'kind', 'ring', 'lat', 'lon', 'radius_m', 'bbox')
+
+    def __init__(self, row):
+        self.id = row['id']
+        self.name = row['name']
+        self.kind = row['kind']
+        if self.kind == 'circle':
+            self.lat, self.lon, self.radius_m = row['center_lat'], row['center_lon'], row['radius_m']
+            dlat = self.radius_m / METERS_PER_DEG_LAT
+            dlon = self.radius_m / (METERS_PER_DEG_LAT * max(math.cos(math.radians(self.lat)), 1e-6))
+            self.bbox = (self.lat - dlat, self.lon - dlon, self.lat + dlat, self.lon + dlon)
+        else:
+            self.ring = [(float(lat), float(lon)) for lat, lon in json.loads(row['polygon'])]
+            lats = [p[0] for p in self.ring]
+            lons = [p[1] for p in self.ring]
+            self.bbox = (min(lats), min(lons), max(lats), max(lons))
+
+    def contains(self, lat, lon):
+        if self.kind == 'circle':
+            return haversine_m(self.lat, self.lon, lat, lon) <= self.radius_m
+        return point_in_polygon(lat, lon, self.ring)
+
+
+class STRtree:
+    """
+    Static R-tree over (min_lat, min_lon, max_lat, max_lon, item) boxes, packed
+    with Sort-Tile-Recursive: each level is sorted into vertical slices by
+    centre latitude, each slice by centre longitude, and cut into nodes of
+    NODE_CAPACITY. Nodes are (min_lat, min_lon, max_lat, max_lon, children, leaf);
+    leaf children are the entries themselves.
+    """
+
+    def __init__(self, entries, capacity=NODE_CAPACITY):
+        self.root = None
+        level = list(entries)
+        if not level:
+            return
+        leaf = True
+        while True:
+            level = self._pack(level, capacity, leaf)
+            leaf = False
+            if len(level) == 1:
+                self.root = level[0]
+                return
+
+    @staticmethod
+    def _pack(items, capacity, leaf):
+        n_nodes = math.ceil(len(items) / capacity)
+        n_slices = math.ceil(math.sqrt(n_nodes))
+        per_slice = n_slices * capacity
+        items = sorted(items, key=lambda b: b[0] + b[2])
+        nodes = []
+        for s in range(0, len(items), per_slice):
+            tile = sorted(items[s:s + per_slice], key=lambda b: b[1] + b[3])
+            for c in range(0, len(tile), capacity):
+                children = tile[c:c + capacity]
+                nodes.append((min(b[0] for b in children), min(b[1] for b in children),
+                              max(b[2] for b in children), max(b[3] for b in children),
+                              children, leaf))
+        return nodes
+
+    def query(self, lat, lon):
+        """Items whose box contains the point."""
+        if self.root is None:
+            return []
+        found, stack = [], [self.root]
+        while stack:
+            min_lat, min_lon, max_lat, max_lon, children, leaf = stack.pop()
+            if lat < min_lat or lat > max_lat or lon < min_lon or lon > max_lon:
+                continue
+            if leaf:
+                found.extend(e[4] for e in children
+                             if e[0] <= lat <= e[2] and e[1] <= lon <= e[3])
+            else:
+                stack.extend(children)
+        return found
+
+
+class FenceIndex:
+    def __init__(self, fences):
+        self.fences = {f.id: f for f in fences}
+        self.tree = STRtree([f.bbox + (f,) for f in fences])
+
+    def containing(self, lat, lon):
+        """Set of fence ids the point lies in."""
+        return {f.id for f in self.tree.query(lat, lon) if f.contains(lat, lon)}
+
+
+_index = {'version': None, 'index': None}
+
+
+def load_index(cur):
+    """FenceIndex for the current fences, rebuilt only when geofences changed."""
+    cur.execute(FENCES_VERSION_SQL)
+    version = tuple(cur.fetchone())
+    if version != _index['version']:
+        cur.execute(FENCES_SQL)
+        cols = [c[0] for c in cur.description]
+        fences = []
+        for row in cur.fetchall():
+            try:
+                fences.append(Fence(dict(zip(cols, row))))
+            except (TypeError, ValueError) as e:
+                print(f"[geofence {row[0]} skipped] {e}")
+        _index['index'], _index['version'] = FenceIndex(fences), version
+    return _index['index']
+
+
+def evaluate(index, points, states):
+    """
+    Feed points (device_id, lat, lon, at), ordered by device and time, through
+    the fences. states maps device_id -> [inside set, last_at] and is updated
+    in place; returns the transition events as tuples for geofence_events.
+    """
+    events = []
+    for device_id, lat, lon, at in points:
+        state = states.setdefault(device_id, [set(), None])
+        if state[1] is not None and at < state[1]:
+            continue
+        lat, lon = float(lat), float(lon)
+        # Fences deleted since the state was stored are dropped silently
+        was = {fid for fid in state[0] if fid in index.fences}
+        now = index.containing(lat, lon)
+        events.extend((device_id, fid, 'exit', at, lat, lon) for fid in sorted(was - now))
+        events.extend((device_id, fid, 'enter', at, lat, lon) for fid in sorted(now - was))
+        state[0], state[1] = now, at
+    return events
+
+
+def fence_from_json(data):
+    """Validated column values for a geofence from an API payload; raises ValueError."""
+    name = (data.get('name') or '').strip()
+    kind = data.get('kind')
+    if not name:
+        raise ValueError('name is required')
+    if kind == 'circle':
+        try:
+            lat, lon, radius = float(data['lat']), float(data['lon']), float(data['radius_m'])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError('circle needs numeric lat, lon and radius_m')
+        if radius <= 0:
+            raise ValueError('radius_m must be positive')
+        return {'name': name, 'kind': kind, 'polygon': None,
+                'center_lat': lat, 'center_lon': lon, 'radius_m': radius}
+    if kind == 'polygon':
+        try:
+            ring = [(float(p[0]), float(p[1])) for p in data['polygon']]
+        except (KeyError, TypeError, ValueError, IndexError):
+            raise ValueError('polygon needs a list of [lat, lon] pairs')
+        if len(ring) < 3:
+            raise ValueError('polygon needs at least 3 points')
+        return {'name': name, 'kind': kind, 'polygon': json.dumps(ring),
+                'center_lat': None, 'center_lon': None, 'radius_m': None}
+    raise ValueError(f"kind must be one of {', '.join(KINDS)}")
+
+
+def fence_to_json(row):
+    out = {'id': row['id'], 'name': row['name'], 'kind': row['kind']}
+    if row['kind'] == 'circle':
+        out.update(lat=row['center_lat'], lon=row['center_lon'], radius_m=row['radius_m'])
+    else:
+        out['polygon'] = json.loads(row['polygon'])
+    out['updated_at'] = row['updated_at'].isoformat()
+    return out
+
+
+def ensure_schema(cur):
+    cur.execute(SCHEMA_SQL)
+
+
+def run_job(conn):
+    """Evaluate location_history points recorded since the last run; returns events written."""
+    cur = conn.cursor()
+    ensure_schema(cur)
+    cur.execute(SETTLED_UNTIL_SQL, (SETTLE_S,))
+    settled_until = cur.fetchone()[0]
+    # First run starts now: fences apply from here on
+    cur.execute("""
+        INSERT INTO geofence_job_state (id, settled_until, updated_at) VALUES (1, %s, now())
+        ON CONFLICT DO NOTHING
+    """, (settled_until,))
+    cur.execute("UPDATE geofence_job_state SET settled_until = %s WHERE id = 1 AND settled_until IS NULL",
+                (settled_until,))
+    conn.commit()
+    index = load_index(cur)
+
+    written = 0
+    while True:
+        # Row lock: concurrent runs never evaluate a range twice
+        cur.execute("SELECT settled_until FROM geofence_job_state WHERE id = 1 FOR UPDATE")
+        since = cur.fetchone()[0]
+        if since >= settled_until:
+            conn.commit()
+            break
+        until = min(settled_until, since + timedelta(seconds=BATCH_S))
+        if index.fences:
+            cur.execute(NEW_POINTS_SQL, (since, until))
+            written += store_events(cur, index, cur.fetchall())
+        cur.execute("UPDATE geofence_job_state SET settled_until = %s, updated_at = now() WHERE id = 1", (until,))
+        conn.commit()
+    cur.close()
+    return written
+
+
+def store_events(cur, index, points):
+    """Evaluate points against the devices' stored state and write events and state back; returns events."""
+    if not points:
+        return 0
+    device_ids = sorted({p[0] for p in points})
+    cur.execute("SELECT device_id, inside, last_at FROM geofence_device_state WHERE device_id = ANY(%s)",
+                (device_ids,))
+    states = {r[0]: [set(r[1]), r[2]] for r in cur.fetchall()}
+    events = evaluate(index, points, states)
+    if events:
+        execute_values(cur, "INSERT INTO geofence_events (device_id, fence_id, event, at, lat, lon) VALUES %s",
+                       events, page_size=1000)
+    execute_values(cur, """
+        INSERT INTO geofence_device_state (device_id, inside, last_at) VALUES %s
+        ON CONFLICT (device_id) DO UPDATE SET inside = EXCLUDED.inside, last_at = EXCLUDED.last_at
+    """, [(d, sorted(states[d][0]), states[d][1]) for d in device_ids], template="(%s, %s::int[], %s)",
+        page_size=1000)
+    return len(events)
+
+
+def main():
+    load_dotenv()
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--schema', action='store_true', help='create geofence tables and exit unless --once')
+    ap.add_argument('--once', action='store_true', help='evaluate once and exit')
+    ap.add_argument('--interval', type=float, default=30.0, help='seconds between runs')
+    args = ap.parse_args()
+
+    conn = psycopg2.connect(
+        host=os.getenv('DB_HOST', 'localhost'),
+        port=int(os.getenv('DB_PORT', 5432)),
+        database=os.getenv('DB_NAME', 'hmdm'),
+        user=os.getenv('DB_USER', 'hmdm'),
+        password=os.getenv('DB_PASSWORD', 'topsecret'),
+    )
+    with conn.cursor() as cur:
+        ensure_schema(cur)
+    conn.commit()
+    if args.schema and not args.once:
+        return
+
+    while True:
+        started = time.time()
+        written = run_job(conn)
+        print(f"{datetime.now()}: {written} geofence events in {time.time() - started:.1f}s")
+        if args.once:
+            return
+        time.sleep(args.interval)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Gunicorn settings for the maps API.
+
+    gunicorn -c gunicorn.conf.py server_history:app
+
+Defaults are sized for an I/O-bound app (most time is spent waiting on
+Postgres): one process per CPU with a pool of threads each, or gevent
+greenlets when GUNICORN_WORKER_CLASS=gevent. Everything can be overridden
+through the environment.
+"""
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Workers
+# ──────────────────────────────────────────────────────────────────────────────
+bind = f"{os.getenv('APP_HOST', '0.0.0.0')}:{os.getenv('APP_PORT', '5003')}"
+
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')  # gthread | gevent | sync
+workers = int(os.getenv('GUNICORN_WORKERS', max(2, multiprocessing.cpu_count())))
+threads = int(os.getenv('GUNICORN_THREADS', 8))                # gthread only
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', 500))  # gevent only
+
+# Import the app once in the master so workers share its pages copy-on-write.
+# Anything holding sockets (DB pool, cache handles) is re-created post-fork.
+preload_app = True
+
+# Workers write metric snapshots here; /metrics on any worker merges them
+os.environ.setdefault('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'mdm-maps-metrics'))
+
+# One DB connection per concurrent request where possible. A gevent worker
+# can run more requests than that; the extra ones wait for a free connection
+# (DB_POOL_TIMEOUT_S) instead of failing.
+if worker_class == 'gevent':
+    os.environ.setdefault('DB_POOL_MAX', str(min(worker_connections, 50)))
+else:
+    os.environ.setdefault('DB_POOL_MAX', str(threads))
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Timeouts, keep-alive and recycling
+# ──────────────────────────────────────────────────────────────────────────────
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 60))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', 30))
+# Behind Traefik/Nginx: keep upstream connections open a bit longer than the
+# browser polling interval would otherwise allow.
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', 5))
+
+# Recycle workers periodically to bound slow leaks; jitter avoids all workers
+# restarting at the same time.
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', 5000))
+max_requests_jitter = int(os.getenv('GUNICORN_MAX_REQUESTS_JITTER', 500))
+
+# Same peers server_history.client_ip() accepts X-Forwarded-For from
+forwarded_allow_ips = os.getenv('FORWARDED_ALLOW_IPS', os.getenv('TRUSTED_PROXIES', '127.0.0.1,::1'))
+accesslog = os.getenv('GUNICORN_ACCESS_LOG', '-')
+errorlog = '-'
+loglevel = os.getenv('GUNICORN_LOG_LEVEL', 'info')
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Hooks
+# ──────────────────────────────────────────────────────────────────────────────
+def on_starting(server):
+    # Counters start from zero on every master start
+    shutil.rmtree(os.environ['METRICS_DIR'], ignore_errors=True)
+    os.makedirs(os.environ['METRICS_DIR'], exist_ok=True)
+
+
+def post_fork(server, worker):
+    if worker_class == 'gevent':
+        # psycopg2 blocks the whole worker unless it yields to the gevent hub
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+
+    import db
+    db.init_pool()
+    server.log.info("worker %s: DB pool ready", worker.pid)
+
+
+def worker_exit(server, worker):
+    import db
+    import metrics
+    db.close_pool()
+    metrics.flush(force=True)
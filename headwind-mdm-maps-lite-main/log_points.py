@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+SQL pieces for location fixes in Headwind MDM's device log (plugin_devicelog_log).
+
+/history, the export and the archive and rollup jobs all build their log
+queries from these, so a message counts as a fix, with the same coordinates
+and provider, wherever it is read. The rules are those of
+parse_gps_from_message below, which backfill.py uses for log dumps.
+
+    SELECT {AT} AS at, {LAT} AS lat, {LON} AS lon, {PROVIDER} AS provider
+    FROM (
+        SELECT l.createtime, l.message, {MATCH_COLUMNS}
+        FROM plugin_devicelog_log l
+        WHERE {MESSAGE_FILTER} AND ...
+    ) m
+    WHERE {HAS_FIX}
+
+Log times (createtime, epoch ms) are read as wall-clock time in the DB
+session's time zone, like location_history.recorded_at; MS_BOUNDS_SQL turns
+[start, end) wall-clock bounds into createtime bounds the same way. All of it
+uses psycopg2 placeholders ('%%' for a literal '%').
+"""
+import json
+import re
+
+# Messages that may carry a fix (l = plugin_devicelog_log)
+MESSAGE_FILTER = """(
+            l.message ILIKE '%%GPS location update%%'
+         OR l.message ILIKE '%%Network location update%%'
+         OR l.message ILIKE '%%location update%%'
+      )"""
+
+# Candidate coordinates of l.message; LAT, LON and HAS_FIX read these columns
+MATCH_COLUMNS = r"""regexp_match(l.message, '"(?:lat|latitude)"\s*:\s*"?(-?\d+(?:\.\d+)?)') AS jlat,
+               regexp_match(l.message, '"(?:lon|lng|longitude)"\s*:\s*"?(-?\d+(?:\.\d+)?)') AS jlon,
+               regexp_match(l.message, 'lat(?:itude)?\s*[:=]\s*(-?\d+(?:\.\d+)?)\s*,?\s*lon(?:gitude)?\s*[:=]\s*(-?\d+(?:\.\d+)?)', 'i') AS latlon,
+               regexp_match(l.message, 'lon(?:gitude)?\s*[:=]\s*(-?\d+(?:\.\d+)?)\s*,?\s*lat(?:itude)?\s*[:=]\s*(-?\d+(?:\.\d+)?)', 'i') AS lonlat"""
+
+HAS_FIX = "((jlat IS NOT NULL AND jlon IS NOT NULL) OR latlon IS NOT NULL OR lonlat IS NOT NULL)"
+
+LAT = """(CASE WHEN jlat IS NOT NULL AND jlon IS NOT NULL THEN jlat[1]
+                     WHEN latlon IS NOT NULL THEN latlon[1] ELSE lonlat[2] END)::float8"""
+
+LON = """(CASE WHEN jlat IS NOT NULL AND jlon IS NOT NULL THEN jlon[1]
+                     WHEN latlon IS NOT NULL THEN latlon[2] ELSE lonlat[1] END)::float8"""
+
+PROVIDER = """CASE WHEN message ILIKE '%%gps%%' THEN 'gps'
+                    WHEN message ILIKE '%%network%%' THEN 'network'
+                    ELSE 'log' END"""
+
+AT = "to_timestamp(createtime / 1000.0)::timestamp"
+
+# createtime bounds of the wall-clock range [%(start)s, %(end)s)
+MS_BOUNDS_SQL = """
+    SELECT (EXTRACT(EPOCH FROM %(start)s::timestamp::timestamptz) * 1000)::bigint,
+           (EXTRACT(EPOCH FROM %(end)s::timestamp::timestamptz) * 1000)::bigint
+"""
+
+
+def ms_bounds(cur, start, end):
+    """(start_ms, end_ms) createtime bounds of [start, end), computed by the database."""
+    cur.execute(MS_BOUNDS_SQL, {'start': start, 'end': end})
+    return cur.fetchone()
+
+
+def parse_gps_from_message(message: str):
+    """
+    Extract lat/lon from:
+      • JSON messages: {"lat":..,"lon":..} or {"latitude":..,"longitude":..}
+      • Text messages: "lat=.., lon=.." or "latitude=.., longitude=.."
+    Returns (lat, lon) or (None, None)
+    """
+    if not message:
+        return None, None
+
+    # Try JSON first
+    try:
+        j = json.loads(message)
+        lat = j.get('lat') if 'lat' in j else j.get('latitude')
+        lon = j.get('lon') if 'lon' in j else (j.get('lng') if 'lng' in j else j.get('longitude'))
+        if lat is not None and lon is not None:
+            return float(lat), float(lon)
+    except Exception:
+        pass
+
+    # Fallback: key=value in free text
+    num = r'(-?\d+(?:\.\d+)?)'
+    patterns = [
+        (rf'lat\s*[:=]\s*{num}\s*,?\s*lon\s*[:=]\s*{num}', 'latlon'),
+        (rf'latitude\s*[:=]\s*{num}\s*,?\s*longitude\s*[:=]\s*{num}', 'latlon'),
+        (rf'lon\s*[:=]\s*{num}\s*,?\s*lat\s*[:=]\s*{num}', 'lonlat'),
+        (rf'longitude\s*[:=]\s*{num}\s*,?\s*latitude\s*[:=]\s*{num}', 'lonlat'),
+    ]
+    for pattern, order in patterns:
+        m = re.search(pattern, message, re.IGNORECASE)
+        if m:
+            a, b = float(m.group(1)), float(m.group(2))
+            return (a, b) if order == 'latlon' else (b, a)
+
+    return None, None
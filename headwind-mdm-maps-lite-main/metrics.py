@@ -0,0 +1,410 @@
+#!/usr/bin/env python3
+"""
+Minimal Prometheus-style metrics for the maps server and the poller.
+
+Counters, gauges and histograms live in a per-process registry; updating one
+is a dict lookup plus an add under a lock, cheap enough to leave on.
+
+Under gunicorn every worker has its own registry. When METRICS_DIR is set
+(gunicorn.conf.py does this) each worker writes a snapshot of its registry to
+METRICS_DIR/<pid>.json at most every FLUSH_INTERVAL seconds, and /metrics
+merges all snapshots: counters and histograms are summed (including workers
+that have since been recycled), gauges only over live workers.
+"""
+import bisect
+import fcntl
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', 5))
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Metric types
+# ──────────────────────────────────────────────────────────────────────────────
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def snapshot(self):
+        """{name: {type, help, labels, buckets, samples: [[labelvalues, value], ...]}}"""
+        out = {}
+        for m in self.metrics.values():
+            out[m.name] = {
+                'type': m.type, 'help': m.help, 'labels': list(m.labelnames),
+                'buckets': list(getattr(m, 'buckets', ())),
+                'samples': [[list(k), v] for k, v in m.samples().items()],
+            }
+        return out
+
+
+REGISTRY = Registry()
+
+
+class _Metric:
+    type = 'untyped'
+
+    def __init__(self, name, help, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(n, '')) for n in self.labelnames)
+
+    def samples(self):
+        with self._lock:
+            return dict(self._values)
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._fn = None
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, fn):
+        """fn() -> {labelvalues tuple: value}, evaluated when the gauge is read."""
+        self._fn = fn
+
+    def samples(self):
+        if self._fn is not None:
+            try:
+                return {tuple(map(str, k)): v for k, v in self._fn().items()}
+            except Exception:
+                return {}
+        return super().samples()
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help, labelnames, registry)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            v = self._values.get(key)
+            if v is None:
+                # per-bucket counts (last slot is +Inf), then sum, then count
+                v = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            v[i] += 1
+            v[-2] += value
+            v[-1] += 1
+
+    def samples(self):
+        with self._lock:
+            return {k: list(v) for k, v in self._values.items()}
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Exposition
+# ──────────────────────────────────────────────────────────────────────────────
+def _fmt_labels(names, values, extra=()):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)] + list(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _escape(v):
+    return str(v).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _fmt_num(v):
+    if v == float('inf'):
+        return '+Inf'
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+def render(snapshot):
+    lines = []
+    for name, m in snapshot.items():
+        lines.append(f"# HELP {name} {m['help']}")
+        lines.append(f"# TYPE {name} {m['type']}")
+        names = m['labels']
+        for values, v in m['samples']:
+            if m['type'] == 'histogram':
+                cumulative = 0
+                for bound, count in zip(list(m['buckets']) + [float('inf')], v[:-2]):
+                    cumulative += count
+                    le = f'le="{_fmt_num(bound)}"'
+                    lines.append(f"{name}_bucket{_fmt_labels(names, values, [le])} {cumulative}")
+                lines.append(f"{name}_sum{_fmt_labels(names, values)} {_fmt_num(v[-2])}")
+                lines.append(f"{name}_count{_fmt_labels(names, values)} {v[-1]}")
+            else:
+                lines.append(f"{name}{_fmt_labels(names, values)} {_fmt_num(v)}")
+    return '\n'.join(lines) + '\n'
+
+
+def _merge_into(total, snapshot, include_gauges=True):
+    for name, m in snapshot.items():
+        t = total.setdefault(name, dict(m, samples={}))
+        if m['type'] == 'gauge' and not include_gauges:
+            continue
+        for values, v in m['samples']:
+            key = tuple(values)
+            if key not in t['samples']:
+                t['samples'][key] = list(v) if isinstance(v, list) else v
+            elif isinstance(v, list):
+                t['samples'][key] = [a + b for a, b in zip(t['samples'][key], v)]
+            else:
+                t['samples'][key] += v
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Multi-process (gunicorn) support
+# ──────────────────────────────────────────────────────────────────────────────
+_last_flush = 0.0
+
+
+def metrics_dir():
+    return os.getenv('METRICS_DIR')
+
+
+def flush(force=False):
+    """Write this process's snapshot to METRICS_DIR (rate-limited unless forced)."""
+    global _last_flush
+    directory = metrics_dir()
+    if not directory:
+        return
+    now = time.monotonic()
+    if not force and now - _last_flush < FLUSH_INTERVAL:
+        return
+    _last_flush = now
+    path = os.path.join(directory, f'{os.getpid()}.json')
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(REGISTRY.snapshot(), f)
+    os.replace(tmp, path)
+
+
+def collect():
+    """Merged snapshot of every process sharing METRICS_DIR (or just this one)."""
+    directory = metrics_dir()
+    if not directory:
+        return {k: dict(v, samples={tuple(s[0]): s[1] for s in v['samples']})
+                for k, v in REGISTRY.snapshot().items()}
+
+    flush(force=True)
+    total = {}
+    with open(os.path.join(directory, '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        archive_path = os.path.join(directory, 'archive.json')
+        archive = {}
+        if os.path.exists(archive_path):
+            with open(archive_path) as f:
+                archive = json.load(f)
+        archived_any = False
+
+        for fname in os.listdir(directory):
+            if not fname.endswith('.json') or fname == 'archive.json':
+                continue
+            path = os.path.join(directory, fname)
+            try:
+                with open(path) as f:
+                    snap = json.load(f)
+            except (OSError, ValueError):
+                continue
+            pid = int(fname[:-5])
+            if _pid_alive(pid):
+                _merge_into(total, snap)
+            else:
+                # Fold recycled workers into the archive so counters don't go backwards
+                merged = {}
+                _merge_into(merged, archive)
+                _merge_into(merged, snap, include_gauges=False)
+                archive = {k: dict(v, samples=[[list(s), val] for s, val in v['samples'].items()])
+                           for k, v in merged.items()}
+                os.remove(path)
+                archived_any = True
+
+        if archived_any:
+            with open(archive_path + '.tmp', 'w') as f:
+                json.dump(archive, f)
+            os.replace(archive_path + '.tmp', archive_path)
+        _merge_into(total, archive, include_gauges=False)
+    return total
+
+
+def exposition():
+    merged = collect()
+    return render({k: dict(v, samples=[[list(s), val] for s, val in v['samples'].items()])
+                   for k, v in merged.items()})
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def start_http_server(port, addr='0.0.0.0'):
+    """Serve /metrics from a background thread (for non-Flask processes like the poller)."""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = exposition().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((addr, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Maps API metrics
+# ──────────────────────────────────────────────────────────────────────────────
+HTTP_REQUESTS = Counter('maps_http_requests_total', 'HTTP requests', ['route', 'method', 'status'])
+HTTP_LATENCY = Histogram('maps_http_request_duration_seconds', 'Request latency', ['route'])
+HTTP_RESPONSE_BYTES = Counter('maps_http_response_bytes_total', 'Response body bytes', ['route'])
+
+DB_QUERIES = Counter('maps_db_queries_total', 'SQL statements executed', ['route'])
+DB_QUERY_TIME = Counter('maps_db_query_seconds_total', 'Time spent in SQL statements', ['route'])
+DB_ROWS = Counter('maps_db_rows_total', 'Rows fetched or affected', ['route'])
+DB_QUERIES_PER_REQUEST = Histogram('maps_db_queries_per_request', 'SQL statements per request', ['route'],
+                                   buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100))
+DB_TIME_PER_REQUEST = Histogram('maps_db_time_per_request_seconds', 'Time in SQL per request', ['route'])
+DB_POOL = Gauge('maps_db_pool_connections', 'DB pool connections by state', ['state'])
+DB_REPLICA_LAG = Gauge('maps_db_replica_lag_seconds', 'Replay lag last measured on each read replica', ['replica'])
+DB_REPLICA_UP = Gauge('maps_db_replica_up', 'Read replica reachable (0 while skipped after an error)', ['replica'])
+
+CACHE_REQUESTS = Counter('maps_cache_requests_total', 'Shared cache lookups', ['cache', 'result'])
+
+SNAPSHOT_RUNS = Histogram('maps_snapshot_run_seconds', 'Snapshot writer run duration', ['writer'])
+SNAPSHOT_DEVICES = Counter('maps_snapshot_devices_total', 'Devices examined by snapshot writers', ['writer'])
+SNAPSHOT_ROWS = Counter('maps_snapshot_rows_inserted_total', 'location_history rows written', ['writer'])
+SNAPSHOT_ERRORS = Counter('maps_snapshot_errors_total', 'Snapshot writer failures', ['writer'])
+
+LOGIN_ATTEMPTS = Counter('maps_login_attempts_total', 'Login attempts by outcome', ['result'])
+LOGIN_LATENCY = Histogram('maps_login_duration_seconds', 'Login POST latency', ['result'])
+LOGIN_HASH_QUEUE = Gauge('maps_login_hash_queue', 'bcrypt operations waiting or running')
+LOGIN_REHASHES = Counter('maps_login_rehashes_total', 'Password hashes upgraded to BCRYPT_ROUNDS')
+
+
+class RequestStats:
+    __slots__ = ('queries', 'db_seconds', 'rows')
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.rows = 0
+
+
+_request_stats = ContextVar('maps_request_stats', default=None)
+
+
+def record_query(statement, params, seconds, rowcount, cursor=None):
+    """db.QUERY_HOOKS callback: accumulate per-request DB stats."""
+    stats = _request_stats.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.db_seconds += seconds
+        if rowcount and rowcount > 0:
+            stats.rows += rowcount
+
+
+def init_app(app):
+    """Instrument a Flask app and expose GET /metrics (with METRICS_TOKEN set)."""
+    from flask import Response, g, request, abort
+
+    token = os.getenv('METRICS_TOKEN')
+
+    def start_timer():
+        g._metrics_start = time.perf_counter()
+        g._metrics_token = _request_stats.set(RequestStats())
+
+    def record(response):
+        start = g.pop('_metrics_start', None)
+        if start is None:
+            return response
+        stats = _request_stats.get()
+        _request_stats.reset(g.pop('_metrics_token'))
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        if route == '/metrics':
+            return response
+
+        HTTP_REQUESTS.inc(route=route, method=request.method, status=response.status_code)
+        HTTP_LATENCY.observe(time.perf_counter() - start, route=route)
+        if response.content_length:
+            HTTP_RESPONSE_BYTES.inc(response.content_length, route=route)
+        if stats is not None:
+            DB_QUERIES_PER_REQUEST.observe(stats.queries, route=route)
+            if stats.queries:
+                DB_QUERIES.inc(stats.queries, route=route)
+                DB_QUERY_TIME.inc(stats.db_seconds, route=route)
+                DB_ROWS.inc(stats.rows, route=route)
+                DB_TIME_PER_REQUEST.observe(stats.db_seconds, route=route)
+        flush()
+        return response
+
+    # Run before any auth hook so rejected requests are timed too
+    app.before_request_funcs.setdefault(None, []).insert(0, start_timer)
+    app.after_request(record)
+
+    def metrics_view():
+        # Off unless METRICS_TOKEN is set: route names and query counts are not public
+        if not token:
+            abort(404)
+        if request.headers.get('Authorization') != f'Bearer {token}':
+            abort(403)
+        return Response(exposition(), mimetype=None, content_type=CONTENT_TYPE)
+
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Movement statistics over a device's point array, vectorized with NumPy.
+
+Input is the merged point list get_device_history builds (dicts with lat, lon
+and ISO time). Hops between consecutive points are classified as:
+  • jump    implied speed above MAX_SPEED_KMH: a bad fix, not travel
+  • moving  speed of at least MOVING_SPEED_KMH
+  • idle    slower than that
+  • gap     more than MAX_GAP_SECONDS apart: distance counts, time doesn't
+
+Single-point spikes (a fix that jumps away and straight back) are dropped
+before hops are computed, so they are reported as outliers and don't add two
+phantom legs to the distance.
+"""
+import os
+
+import numpy as np
+
+EARTH_RADIUS_M = 6371000.0
+MAX_SPEED_KMH = float(os.getenv('STATS_MAX_SPEED_KMH', 200))
+MOVING_SPEED_KMH = float(os.getenv('STATS_MOVING_SPEED_KMH', 3))
+MAX_GAP_SECONDS = float(os.getenv('STATS_MAX_GAP_SECONDS', 900))
+# Speeds over very short intervals are dominated by GPS noise
+MIN_SPEED_INTERVAL_S = 10.0
+
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    """Element-wise great-circle distance in metres (arrays in degrees)."""
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def _hops(lat, lon, t):
+    d = haversine_m(lat[:-1], lon[:-1], lat[1:], lon[1:])
+    dt = np.diff(t)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        speed = np.where(dt > 0, d / dt * 3.6, np.where(d > 0, np.inf, 0.0))
+    return d, dt, speed
+
+
+def arrays_from_points(points):
+    """(lat, lon, t) arrays from history points; t is seconds since epoch, sorted."""
+    if not points:
+        empty = np.empty(0)
+        return empty, empty, empty
+    lat = np.fromiter((p['lat'] for p in points), dtype=np.float64, count=len(points))
+    lon = np.fromiter((p['lon'] for p in points), dtype=np.float64, count=len(points))
+    t = np.array([p['time'] for p in points], dtype='datetime64[ms]').astype(np.int64) / 1000.0
+    order = np.argsort(t, kind='stable')
+    return lat[order], lon[order], t[order]
+
+
+def movement_stats(lat, lon, t):
+    n = len(t)
+    result = {
+        'points': int(n), 'distance_km': 0.0, 'moving_minutes': 0.0, 'idle_minutes': 0.0,
+        'gap_minutes': 0.0, 'max_speed_kmh': 0.0, 'avg_speed_kmh': 0.0,
+        'outliers': {'spikes': 0, 'jumps': 0},
+        'first': None, 'last': None,
+    }
+    if n < 2:
+        return result
+
+    # Drop spikes: both the hop in and the hop out are impossible, and the
+    # points either side are close to each other
+    d, dt, speed = _hops(lat, lon, t)
+    fast = speed > MAX_SPEED_KMH
+    spike = np.zeros(n, dtype=bool)
+    spike[1:-1] = fast[:-1] & fast[1:]
+    if spike.any():
+        idx = np.flatnonzero(spike)
+        bridge = haversine_m(lat[idx - 1], lon[idx - 1], lat[idx + 1], lon[idx + 1])
+        spike[idx[bridge > np.minimum(d[idx - 1], d[idx])]] = False
+        keep = ~spike
+        lat, lon, t = lat[keep], lon[keep], t[keep]
+        d, dt, speed = _hops(lat, lon, t)
+
+    jump = speed > MAX_SPEED_KMH
+    gap = ~jump & (dt > MAX_GAP_SECONDS)
+    timed = ~jump & ~gap
+    moving = timed & (speed >= MOVING_SPEED_KMH)
+    idle = timed & ~moving
+
+    moving_s = dt[moving].sum()
+    moving_m = d[moving].sum()
+    measurable = moving & (dt >= MIN_SPEED_INTERVAL_S)
+
+    result.update({
+        'distance_km': round(float(d[~jump].sum()) / 1000.0, 3),
+        'moving_minutes': round(float(moving_s) / 60.0, 1),
+        'idle_minutes': round(float(dt[idle].sum()) / 60.0, 1),
+        'gap_minutes': round(float(dt[gap].sum()) / 60.0, 1),
+        'max_speed_kmh': round(float(speed[measurable].max()), 1) if measurable.any() else 0.0,
+        'avg_speed_kmh': round(float(moving_m / moving_s * 3.6), 1) if moving_s > 0 else 0.0,
+        'outliers': {'spikes': int(spike.sum()), 'jumps': int(jump.sum())},
+    })
+    return result
+
+
+def stats_from_points(points):
+    lat, lon, t = arrays_from_points(points)
+    stats = movement_stats(lat, lon, t)
+    if len(t):
+        stats['first'] = np.datetime64(int(t[0] * 1000), 'ms').astype(object).isoformat()
+        stats['last'] = np.datetime64(int(t[-1] * 1000), 'ms').astype(object).isoformat()
+    return stats
@@ -0,0 +1,118 @@
+"""
+k-nearest devices to a point over current positions, kept in memory.
+
+Positions are stored as unit vectors on the sphere in one (n, 3) array, so a
+query is a single matrix-vector product (cosine of the central angle) plus an
+argpartition, which is exact under the haversine metric and takes well under
+a millisecond for 10k devices. The array is updated in place from the
+/api/locations rows: only devices whose fix changed are rewritten, new
+devices take a free slot and vanished ones are masked out.
+"""
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+
+EARTH_RADIUS_M = 6371000.0
+
+
+def unit_vectors(lat, lon):
+    lat, lon = np.radians(lat), np.radians(lon)
+    cos_lat = np.cos(lat)
+    return np.stack([cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)], axis=-1)
+
+
+class NearestIndex:
+    def __init__(self, capacity=1024):
+        self._lock = threading.Lock()
+        self._xyz = np.zeros((capacity, 3))
+        self._ts = np.zeros(capacity)
+        self._valid = np.zeros(capacity, dtype=bool)
+        self._items = [None] * capacity
+        self._slots = {}          # device number -> row
+        self._free = []
+        self._size = 0
+        self.refreshed_at = 0.0
+
+    def __len__(self):
+        return int(self._valid[:self._size].sum())
+
+    def _grow(self):
+        cap = len(self._items) * 2
+        for name in ('_xyz', '_ts', '_valid'):
+            old = getattr(self, name)
+            new = np.zeros((cap,) + old.shape[1:], dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+        self._items.extend([None] * (cap - len(self._items)))
+
+    def update(self, locations):
+        """Fold in /api/locations items; returns the number of rows written."""
+        changed = 0
+        with self._lock:
+            seen = set()
+            for loc in locations:
+                number = loc['number']
+                seen.add(number)
+                slot = self._slots.get(number)
+                if slot is not None:
+                    old = self._items[slot]
+                    if old['lat'] == loc['lat'] and old['lon'] == loc['lon'] and old['time'] == loc['time']:
+                        self._items[slot] = loc
+                        continue
+                else:
+                    if self._free:
+                        slot = self._free.pop()
+                    else:
+                        if self._size == len(self._items):
+                            self._grow()
+                        slot = self._size
+                        self._size += 1
+                    self._slots[number] = slot
+                self._xyz[slot] = unit_vectors(loc['lat'], loc['lon'])
+                self._ts[slot] = datetime.fromisoformat(loc['time']).timestamp()
+                self._valid[slot] = True
+                self._items[slot] = loc
+                changed += 1
+
+            for number in [n for n in self._slots if n not in seen]:
+                slot = self._slots.pop(number)
+                self._valid[slot] = False
+                self._items[slot] = None
+                self._free.append(slot)
+                changed += 1
+            self.refreshed_at = time.time()
+        return changed
+
+    def refresh(self, load, max_age):
+        """Update from load() if the last update is older than max_age seconds."""
+        if time.time() - self.refreshed_at >= max_age:
+            self.update(load())
+
+    def nearest(self, lat, lon, k=5, max_age=None):
+        """
+        [(item, distance_m)] for the k closest devices, nearest first; with
+        max_age (seconds) only fixes at most that old are considered.
+        """
+        q = unit_vectors(lat, lon)
+        with self._lock:
+            n = self._size
+            cos = self._xyz[:n] @ q
+            mask = self._valid[:n]
+            if max_age is not None:
+                mask = mask & (self._ts[:n] >= time.time() - max_age)
+            candidates = np.flatnonzero(mask)
+            if not len(candidates) or k <= 0:
+                return []
+            cos = cos[candidates]
+            if k < len(candidates):
+                part = np.argpartition(-cos, k - 1)[:k]
+            else:
+                part = np.arange(len(candidates))
+            part = part[np.argsort(-cos[part], kind='stable')]
+            rows = candidates[part]
+            # Chord length is precise at short range, where arccos(cos) is not
+            chord = np.linalg.norm(self._xyz[rows] - q, axis=1)
+            dist = 2 * EARTH_RADIUS_M * np.arcsin(np.clip(chord / 2, 0.0, 1.0))
+            return [(self._items[r], float(d)) for r, d in zip(rows, dist)]
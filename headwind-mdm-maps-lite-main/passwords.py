@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+bcrypt hashing off the request path, with login throttling.
+
+bcrypt releases the GIL while hashing, so running it on a small thread pool
+(LOGIN_HASH_WORKERS per process, default 2) caps how many cores a login storm
+can take from the map API. At most LOGIN_QUEUE_MAX hashes may be waiting or
+running per process; beyond that a login is refused with Busy rather than
+queued behind everyone else. Under gevent the hashes go to gevent's native
+thread pool, since a monkey-patched ThreadPoolExecutor would run them on the
+hub.
+
+Failed logins are counted per client IP and per username in a shared store
+with its atomic incr() (LOGIN_FAIL_WINDOW seconds); once over LOGIN_MAX_FAILURES_PER_USER /
+LOGIN_MAX_FAILURES_PER_IP further attempts are Throttled until the window
+expires, without spending a hash on them.
+
+Hashes with a cost other than BCRYPT_ROUNDS are transparently upgraded on the
+next successful login (needs_rehash). check_password(password, None), for an
+unknown username, checks against a throwaway hash of the same cost, so it
+takes as long as a wrong password would.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+
+ROUNDS = int(os.getenv('BCRYPT_ROUNDS', 12))
+WORKERS = int(os.getenv('LOGIN_HASH_WORKERS', 2))
+QUEUE_MAX = int(os.getenv('LOGIN_QUEUE_MAX', 32))
+FAIL_WINDOW = int(os.getenv('LOGIN_FAIL_WINDOW', 900))
+MAX_FAILURES_PER_USER = int(os.getenv('LOGIN_MAX_FAILURES_PER_USER', 5))
+# Generous: a whole shift often logs in from behind one NAT address
+MAX_FAILURES_PER_IP = int(os.getenv('LOGIN_MAX_FAILURES_PER_IP', 50))
+
+
+class Busy(Exception):
+    """Too many hashes already queued in this process."""
+
+
+class Throttled(Exception):
+    """Too many recent failures for this user or address."""
+
+
+_executor = None
+_executor_pid = None
+_pending = 0
+_lock = threading.Lock()
+
+
+def _gevent_threadpool():
+    try:
+        from gevent import monkey, get_hub
+    except ImportError:
+        return None
+    if monkey.is_module_patched('threading'):
+        return get_hub().threadpool
+    return None
+
+
+def _run(fn, *args):
+    global _executor, _executor_pid, _pending
+    with _lock:
+        if _pending >= QUEUE_MAX:
+            raise Busy()
+        _pending += 1
+    try:
+        pool = _gevent_threadpool()
+        if pool is not None:
+            return pool.apply(fn, args)
+        if _executor is None or _executor_pid != os.getpid():
+            with _lock:
+                if _executor is None or _executor_pid != os.getpid():
+                    _executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix='bcrypt')
+                    _executor_pid = os.getpid()
+        return _executor.submit(fn, *args).result()
+    finally:
+        with _lock:
+            _pending -= 1
+
+
+def pending():
+    """Hashes waiting or running in this process."""
+    return _pending
+
+
+def hash_password(password):
+    return _run(lambda: bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(ROUNDS)).decode('utf-8'))
+
+
+# Checked against for unknown usernames; made at import (once, in gunicorn's
+# master with preload_app) rather than by the first such login
+_DUMMY_HASH = bcrypt.hashpw(os.urandom(16), bcrypt.gensalt(ROUNDS))
+
+
+def check_password(password, password_hash):
+    """False for password_hash None, after the same amount of work as a real check."""
+    if password_hash is None:
+        _run(bcrypt.checkpw, password.encode('utf-8'), _DUMMY_HASH)
+        return False
+    return _run(bcrypt.checkpw, password.encode('utf-8'), password_hash.encode('utf-8'))
+
+
+def needs_rehash(password_hash):
+    """True if the stored hash was made with a different cost than BCRYPT_ROUNDS."""
+    try:
+        return int(password_hash.split('$')[2]) != ROUNDS
+    except (IndexError, ValueError):
+        return True
+
+
+class LoginThrottle:
+    """Failure counters in a shared_cache backend."""
+
+    def __init__(self, store):
+        self.store = store
+
+    def _keys(self, username, ip):
+        return ((f'login_fail:user:{(username or "").lower()}', MAX_FAILURES_PER_USER),
+                (f'login_fail:ip:{ip}', MAX_FAILURES_PER_IP))
+
+    def check(self, username, ip):
+        for key, limit in self._keys(username, ip):
+            entry = self.store.get(key)
+            if entry is not None and entry.value >= limit:
+                raise Throttled()
+
+    def failed(self, username, ip):
+        for key, _ in self._keys(username, ip):
+            self.store.incr(key, FAIL_WINDOW)
+
+    def succeeded(self, username, ip):
+        # Only the user's counter: others behind the same address keep theirs
+        self.store.delete(self._keys(username, ip)[0][0])
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+On-demand sampling profiler for single requests.
+
+An admin adds `X-Profile: 1` (or `?profile=1`) to any request. While it runs,
+a helper thread samples the request thread's Python stack every
+PROFILE_INTERVAL_MS and the profile is stored in collapsed-stack format (one
+`frame;frame;frame count` line per stack, as read by flamegraph.pl and
+speedscope). Each stack is rooted at one of the buckets below, so the flame
+graph splits wall time into JSON parsing, regex parsing, DB wait,
+serialization and everything else.
+
+`X-Profile: collapsed` (or `?profile=collapsed`) returns the stacks as the
+response body instead of the normal response, for `curl ... | flamegraph.pl`.
+Otherwise the response gets X-Profile-Id / X-Profile-Summary headers and the
+profile is listed at /admin/profiles.
+
+Sampling looks at OS threads, so it is accurate on gthread workers; under
+gevent the samples show whatever greenlet happens to be running.
+"""
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter as _Counter
+from datetime import datetime
+
+BUCKETS = ('db_wait', 'json_parse', 'regex_parse', 'serialization', 'other')
+INDEX_KEY = 'profiles'
+INTERVAL = float(os.getenv('PROFILE_INTERVAL_MS', 2)) / 1000.0
+KEEP = int(os.getenv('PROFILE_KEEP', 20))
+TTL = 86400
+
+
+def _bucket(filename, func):
+    f = filename.replace('\\', '/')
+    if '/psycopg2/' in f or '/asyncpg/' in f or f.endswith('/db.py'):
+        return 'db_wait'
+    if f.endswith('/json/decoder.py') or (f.endswith('/json/__init__.py') and func == 'loads'):
+        return 'json_parse'
+    if '/re/' in f or f.endswith('/re.py') or '/sre_' in f or func == 'parse_gps_from_message':
+        return 'regex_parse'
+    if f.endswith('/json/encoder.py') or '/flask/json/' in f or func in ('jsonify', 'dumps'):
+        return 'serialization'
+    return None
+
+
+def collapse(frame):
+    """(bucket, 'root;...;leaf') for a frame."""
+    names, bucket = [], None
+    while frame is not None:
+        code = frame.f_code
+        if bucket is None:
+            bucket = _bucket(code.co_filename, code.co_name)
+        names.append(f"{os.path.splitext(os.path.basename(code.co_filename))[0]}:{code.co_name}")
+        frame = frame.f_back
+    bucket = bucket or 'other'
+    names.append(bucket)
+    return bucket, ';'.join(reversed(names))
+
+
+class Sampler:
+    """Samples one thread's stack from a helper thread until stop()."""
+
+    def __init__(self, thread_id=None, interval=INTERVAL):
+        self.thread_id = thread_id or threading.get_ident()
+        self.interval = interval
+        self.stacks = _Counter()
+        self.buckets = _Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.started = time.perf_counter()
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            bucket, stack = collapse(frame)
+            self.stacks[stack] += 1
+            self.buckets[bucket] += 1
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.elapsed = time.perf_counter() - self.started
+        return self
+
+    def collapsed(self):
+        return '\n'.join(f'{stack} {n}' for stack, n in self.stacks.most_common()) + '\n'
+
+    def summary_ms(self):
+        """Wall time per bucket, scaling sample counts to the measured duration."""
+        total = sum(self.buckets.values())
+        if not total:
+            return {b: 0.0 for b in BUCKETS}
+        return {b: round(self.elapsed * 1000 * self.buckets[b] / total, 1) for b in BUCKETS}
+
+
+class ProfileStore:
+    """Profiles in the shared cache (or this process when store is None)."""
+
+    def __init__(self, store=None):
+        self.store = store
+        self._local = {}
+        self._lock = threading.Lock()
+
+    def save(self, meta, collapsed):
+        if self.store is None:
+            self._local[meta['id']] = (meta, collapsed)
+            for old in list(self._local)[:-KEEP]:
+                del self._local[old]
+            return
+        self.store.set(f"profile:{meta['id']}", collapsed, TTL)
+        with self._lock:
+            cached = self.store.get(INDEX_KEY)
+            index = [meta] + list(cached.value if cached else [])
+            self.store.set(INDEX_KEY, index[:KEEP], TTL)
+
+    def index(self):
+        if self.store is None:
+            return [m for m, _ in reversed(self._local.values())]
+        cached = self.store.get(INDEX_KEY)
+        return list(cached.value) if cached else []
+
+    def collapsed(self, profile_id):
+        if self.store is None:
+            hit = self._local.get(profile_id)
+            return hit[1] if hit else None
+        cached = self.store.get(f'profile:{profile_id}')
+        return cached.value if cached else None
+
+
+def init_app(app, is_admin, store=None):
+    """Profile requests of admins (is_admin() -> bool) that ask for it."""
+    from flask import Response, g, request
+
+    profiles = ProfileStore(store)
+
+    def requested():
+        return request.headers.get('X-Profile') or request.args.get('profile')
+
+    def start():
+        mode = requested()
+        if mode and mode != '0' and is_admin():
+            g._profile = (mode, Sampler().start())
+
+    def finish(response):
+        started = g.pop('_profile', None)
+        if started is None:
+            return response
+        mode, sampler = started
+        sampler.stop()
+        if mode == 'collapsed':
+            return Response(sampler.collapsed(), mimetype='text/plain')
+
+        summary = sampler.summary_ms()
+        meta = {
+            'id': uuid.uuid4().hex[:12],
+            'at': datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+            'method': request.method,
+            'path': request.full_path.rstrip('?'),
+            'status': response.status_code,
+            'ms': round(sampler.elapsed * 1000, 1),
+            'samples': sum(sampler.stacks.values()),
+            'buckets': summary,
+        }
+        profiles.save(meta, sampler.collapsed())
+        response.headers['X-Profile-Id'] = meta['id']
+        response.headers['X-Profile-Summary'] = ' '.join(f'{b}={ms}ms' for b, ms in summary.items())
+        return response
+
+    app.before_request(start)
+    app.after_request(finish)
+    return profiles
@@ -0,0 +1,106 @@
+"""
+Registry of named hot-path statements, server-side prepared once per pooled
+connection.
+
+    queries.register('history', HISTORY_SQL, ('text', 'bigint', 'timestamp'))
+    queries.execute(cur, 'history', (number, since_ms, window_start))
+
+The first execute on a connection sends PREPARE name (types) AS <sql>; every
+later one sends only EXECUTE name (params), so Postgres skips parsing and,
+after a few runs, planning. Parameter types are declared with the statement
+so its plan doesn't depend on how the first call's values were typed.
+Per-statement latency goes to the maps_db_named_query_seconds histogram.
+
+asyncpg (asgi_server.py) uses the same SQL via `numbered`; it prepares and
+caches statements per connection itself and decodes results in binary.
+
+Set DB_PREPARE=0 behind a transaction-pooling PgBouncer, where session-level
+prepared statements don't survive between transactions.
+"""
+import itertools
+import os
+import re
+import time
+
+from psycopg2 import errors
+
+import metrics
+
+PREPARE = os.getenv('DB_PREPARE', '1') != '0'
+
+NAMED_QUERY_TIME = metrics.Histogram('maps_db_named_query_seconds', 'Latency of registered statements', ['query'])
+
+
+def to_numbered(sql):
+    """Rewrite psycopg2 placeholders ('%s', '%%') to server-side ones ('$n', '%')."""
+    counter = itertools.count(1)
+    return re.sub(r'%%|%s', lambda m: '%' if m.group() == '%%' else f'${next(counter)}', sql)
+
+
+# A data-modifying statement inside a WITH (INSERT/UPDATE/DELETE/MERGE)
+_WRITE_RE = re.compile(r'\b(INSERT\s+INTO|UPDATE\s+[\w."]+(\s+(AS\s+)?\w+)?\s+SET|DELETE\s+FROM|MERGE\s+INTO)\b',
+                       re.IGNORECASE)
+
+
+def is_readonly(sql):
+    """True for a SELECT, or a WITH query without data-modifying CTEs (safe to EXPLAIN ANALYZE)."""
+    m = re.match(r'\s*(SELECT|WITH)\b', sql, re.IGNORECASE)
+    if not m:
+        return False
+    return m.group(1).upper() == 'SELECT' or not _WRITE_RE.search(sql)
+
+
+class Query:
+    def __init__(self, name, sql, types=()):
+        self.name = name
+        self.sql = sql
+        self.numbered = to_numbered(sql)
+        self.params = len(re.findall(r'%s', sql.replace('%%', '')))
+        if types and len(types) != self.params:
+            raise ValueError(f"{name}: {len(types)} types for {self.params} parameters")
+        self.types = tuple(types)
+        self.readonly = is_readonly(sql)
+        signature = f" ({', '.join(self.types)})" if self.types else ''
+        self.prepare_sql = f"PREPARE {name}{signature} AS {self.numbered}"
+        self.execute_sql = f"EXECUTE {name} ({', '.join(['%s'] * self.params)})" if self.params else f"EXECUTE {name}"
+
+
+REGISTRY = {}
+
+
+def register(name, sql, types=()):
+    """Add a statement to the registry (module import time); returns it."""
+    if not re.fullmatch(r'[a-z_][a-z0-9_]*', name):
+        raise ValueError(f"bad statement name {name!r}")
+    query = REGISTRY[name] = Query(name, sql, types)
+    return query
+
+
+def execute(cur, name, params=()):
+    """Run a registered statement on cur, preparing it on cur's connection first if needed."""
+    query = REGISTRY[name]
+    prepared = getattr(cur.connection, 'prepared', None)
+    start = time.perf_counter()
+    try:
+        if not PREPARE or prepared is None:
+            # Not a pooled db.Connection (scripts, tests): plain text
+            return cur.execute(query.sql, params or None)
+        if name not in prepared:
+            # No params: psycopg2 sends the text untouched, so '%' stays '%'
+            cur.execute(query.prepare_sql)
+            prepared.add(name)
+        try:
+            return cur.execute(query.execute_sql, params or None)
+        except errors.InvalidSqlStatementName:
+            # Session was reset under us (DISCARD ALL, pooler): prepare again next time
+            prepared.clear()
+            raise
+    finally:
+        NAMED_QUERY_TIME.observe(time.perf_counter() - start, query=name)
+
+
+def readonly_execute(statement):
+    """True if statement is an EXECUTE of a registered read-only query (safe to EXPLAIN ANALYZE)."""
+    m = re.match(r'\s*EXECUTE\s+(\w+)', statement, re.IGNORECASE)
+    query = REGISTRY.get(m.group(1)) if m else None
+    return bool(query and query.readonly)
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Exercise db.connection(readonly=True) against a real primary and streaming
+replica: routing, a replica whose pooled connections died, recovery, and
+replay lag.
+
+Point it at LOCAL test databases only: it terminates its own replica
+connections and pauses WAL replay on the replica for a few seconds.
+
+    # ../postgresql (see docker-compose.replica.yml's header for the one-time setup)
+    docker compose -f docker-compose.yml -f docker-compose.replica.yml up -d
+    # here, on the same docker network
+    docker compose run --rm -e DB_REPLICAS=postgresql://postgresql-replica mdm-maps python replica_check.py
+
+Connection parameters are the API's (DB_* and DB_REPLICAS, first replica
+used); the DB user must be allowed to call pg_wal_replay_pause() on the
+replica (the compose POSTGRES_USER is a superuser).
+"""
+import argparse
+import time
+
+import psycopg2
+from dotenv import load_dotenv
+
+import db
+
+APP_NAME = 'maps-replica-check'
+
+
+def routed(expect):
+    """Borrow a read connection; True if it went where expected ('replica' or 'primary')."""
+    with db.connection(readonly=True) as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT pg_is_in_recovery()")
+        in_recovery = cur.fetchone()[0]
+        cur.close()
+        where = 'replica' if conn.replica else 'primary'
+    return where == expect and in_recovery == (expect == 'replica')
+
+
+def check(name, ok, failures):
+    print(f"{'PASS' if ok else 'FAIL'}  {name}  {db.replica_stats()}")
+    if not ok:
+        failures.append(name)
+
+
+def main():
+    load_dotenv()
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--max-lag', type=float, default=2.0, help='DB_REPLICA_MAX_LAG_S for this run')
+    args = ap.parse_args()
+
+    config = db.env_config()
+    if not config['replicas']:
+        raise SystemExit("Set DB_REPLICAS to the replica's DSN")
+    config['application_name'] = APP_NAME
+    db.configure(config)
+    db.REPLICA_MAX_LAG_S, db.REPLICA_CHECK_S, db.REPLICA_RETRY_S = args.max_lag, 0.5, 2.0
+    db.init_pool()
+    name = next(iter(db._replicas))
+    admin = psycopg2.connect(**db._replicas[name])
+    admin.autocommit = True
+    acur = admin.cursor()
+    failures = []
+
+    check('reads go to the replica', routed('replica'), failures)
+
+    # The replica "restarts": every pooled connection to it is closed by the server
+    acur.execute("""
+        SELECT count(pg_terminate_backend(pid)) FROM pg_stat_activity
+        WHERE application_name = %s AND pid <> pg_backend_pid()
+    """, (APP_NAME,))
+    print(f"      terminated {acur.fetchone()[0]} pooled replica connection(s)")
+    time.sleep(0.2)
+    try:
+        ok = routed('primary') and not db.replica_stats()[name]['up']
+    except psycopg2.Error as e:
+        print(f"      read failed: {e}")
+        ok = False
+    check('dead replica connections fall back to the primary without an error', ok, failures)
+
+    time.sleep(db.REPLICA_RETRY_S + 0.1)
+    check('reads return to the replica after DB_REPLICA_RETRY_S', routed('replica'), failures)
+
+    acur.execute("SELECT pg_wal_replay_pause()")
+    try:
+        with db.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT txid_current()")     # a commit the replica receives but doesn't replay
+            conn.commit()
+        time.sleep(args.max_lag + db.REPLICA_CHECK_S + 0.5)
+        check('a replica lagging past DB_REPLICA_MAX_LAG_S is skipped', routed('primary'), failures)
+    finally:
+        acur.execute("SELECT pg_wal_replay_resume()")
+    time.sleep(db.REPLICA_CHECK_S + 0.5)
+    check('reads return to the replica once it caught up', routed('replica'), failures)
+
+    admin.close()
+    db.close_pool()
+    raise SystemExit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
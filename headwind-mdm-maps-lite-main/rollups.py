@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+"""
+Hourly and daily rollups of every stored fix: location_history plus the
+GPS/Network log points, read with the same log_points rules and
+de-duplicated the same way as /history.
+
+location_rollups keeps one row per device per hour ('hour') and per day
+('day') with the first and last fix, the centroid, the number of points and
+the distance travelled. A bucket's distance includes the hop from the
+device's previous point, so summing buckets gives the distance over any range.
+
+Rollups advance by whole hours. location_rollup_state.rolled_until is the end
+of the last hour rolled up; each run rolls up the hours from there to
+ROLLUP_SETTLE_S before the database's now() (at most ROLLUP_BATCH_HOURS per
+transaction), then rebuilds every day those hours fall in from its hours.
+The settle time lets rows committed a little late land before their hour is
+rolled up; location_history rows added later with an older recorded_at
+(backfill.py, a live fix stored with the device's timestamp) pull
+rolled_until back to their hour, so those hours are rolled up again. /history serves long windows from here up to rolled_until and raw
+points after it (see server_history.load_device_rollups), so a 14-day view
+reads ~336 rows per device plus the last hour or so of raw points.
+
+    python rollups.py --schema --once      # create or upgrade tables, catch up
+    python rollups.py --interval 60        # keep up with new points
+    python rollups.py --rebuild            # recompute everything still in Postgres
+"""
+import argparse
+import os
+import time
+from datetime import datetime, timedelta
+
+import psycopg2
+from dotenv import load_dotenv
+
+import log_points
+
+PERIODS = ('hour', 'day')
+SETTLE_S = float(os.getenv('ROLLUP_SETTLE_S', 300))
+# Hours rolled up per transaction while catching up
+BATCH_HOURS = int(os.getenv('ROLLUP_BATCH_HOURS', 24))
+
+SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS location_rollups (
+    device_id    INT NOT NULL,
+    period       VARCHAR(4) NOT NULL,           -- 'hour' | 'day'
+    bucket_start TIMESTAMP NOT NULL,
+    first_at     TIMESTAMP NOT NULL,
+    first_lat    DOUBLE PRECISION NOT NULL,
+    first_lon    DOUBLE PRECISION NOT NULL,
+    last_at      TIMESTAMP NOT NULL,
+    last_lat     DOUBLE PRECISION NOT NULL,
+    last_lon     DOUBLE PRECISION NOT NULL,
+    lat          DOUBLE PRECISION NOT NULL,     -- centroid
+    lon          DOUBLE PRECISION NOT NULL,
+    point_count  INT NOT NULL,
+    distance_m   DOUBLE PRECISION NOT NULL DEFAULT 0,
+    PRIMARY KEY (device_id, period, bucket_start)
+);
+
+CREATE TABLE IF NOT EXISTS location_rollup_state (
+    id              INT PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+    rolled_until    TIMESTAMP,                  -- every hour before this is rolled up
+    seen_history_id BIGINT,                     -- location_history rows checked for older recorded_at
+    updated_at      TIMESTAMP
+);
+"""
+
+# Upgrades from earlier versions; run by --schema only, since ALTER TABLE
+# takes an ACCESS EXCLUSIVE lock. Earlier versions advanced by
+# location_history id and never saw log points: start over from the oldest fix
+MIGRATE_SQL = """
+ALTER TABLE location_rollup_state ADD COLUMN IF NOT EXISTS rolled_until TIMESTAMP;
+ALTER TABLE location_rollup_state ADD COLUMN IF NOT EXISTS seen_history_id BIGINT;
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM information_schema.columns
+               WHERE table_name = 'location_rollup_state' AND column_name = 'last_history_id') THEN
+        ALTER TABLE location_rollup_state DROP COLUMN last_history_id;
+        TRUNCATE location_rollups, location_rollup_state;
+    END IF;
+END $$;
+"""
+
+_HOP_M = """
+    2 * 6371000.0 * asin(sqrt(least(1.0,
+        power(sin(radians({lat} - {plat}) / 2), 2)
+        + cos(radians({plat})) * cos(radians({lat})) * power(sin(radians({lon} - {plon}) / 2), 2))))
+"""
+
+# Last hour that may be rolled up: ROLLUP_SETTLE_S ago, rounded down
+SETTLED_SQL = "SELECT date_trunc('hour', (now() - make_interval(secs => %s))::timestamp)"
+
+# Oldest hour among location_history rows added since the last run (backfill,
+# or a live fix stored with the device's own, older, timestamp) and the new
+# high-water id
+NEW_HISTORY_SQL = """
+    SELECT date_trunc('hour', MIN(recorded_at)), MAX(id)
+    FROM location_history
+    WHERE id > %s
+"""
+
+# Where the first run starts
+OLDEST_SQL = f"""
+    SELECT date_trunc('hour', LEAST(
+        (SELECT MIN(recorded_at) FROM location_history),
+        (SELECT {log_points.AT} FROM plugin_devicelog_log l
+         WHERE {log_points.MESSAGE_FILTER} ORDER BY createtime LIMIT 1)))
+"""
+
+# Hour buckets of [start, end) for every device: one index range per device
+# and table, points de-duplicated like HISTORY_SQL, hops chained across hours
+# and from the device's last rolled-up point before start
+HOUR_ROLLUP_SQL = f"""
+    WITH pts AS (
+        SELECT DISTINCT ON (p.device_id, p.at, round(p.lat::numeric, 6), round(p.lon::numeric, 6))
+               p.device_id, p.at, p.src, p.ord, p.lat, p.lon
+        FROM devices d
+        CROSS JOIN LATERAL (
+            SELECT m.deviceid AS device_id, {log_points.AT} AS at, 0 AS src, m.createtime AS ord,
+                   {log_points.LAT} AS lat, {log_points.LON} AS lon
+            FROM (
+                SELECT l.deviceid, l.createtime, l.message,
+                       {log_points.MATCH_COLUMNS}
+                FROM plugin_devicelog_log l
+                WHERE l.deviceid = d.id
+                  AND l.createtime >= %(start_ms)s AND l.createtime < %(end_ms)s
+                  AND {log_points.MESSAGE_FILTER}
+            ) m
+            WHERE {log_points.HAS_FIX}
+            UNION ALL
+            SELECT h.device_id, h.recorded_at, 1, h.id, h.lat, h.lon
+            FROM location_history h
+            WHERE h.device_id = d.id AND h.recorded_at >= %(start)s AND h.recorded_at < %(end)s
+        ) p
+        ORDER BY p.device_id, p.at, round(p.lat::numeric, 6), round(p.lon::numeric, 6), p.src, p.ord
+    ),
+    prev AS (
+        SELECT d.device_id, r.last_lat AS lat, r.last_lon AS lon
+        FROM (SELECT DISTINCT device_id FROM pts) d
+        CROSS JOIN LATERAL (
+            SELECT last_lat, last_lon FROM location_rollups
+            WHERE device_id = d.device_id AND period = 'hour' AND bucket_start < %(start)s
+            ORDER BY bucket_start DESC
+            LIMIT 1
+        ) r
+    ),
+    hops AS (
+        SELECT pts.device_id, date_trunc('hour', pts.at) AS bucket_start, pts.at, pts.src, pts.ord,
+               pts.lat, pts.lon,
+               COALESCE(lag(pts.lat) OVER w, prev.lat) AS plat,
+               COALESCE(lag(pts.lon) OVER w, prev.lon) AS plon
+        FROM pts
+        LEFT JOIN prev ON prev.device_id = pts.device_id
+        WINDOW w AS (PARTITION BY pts.device_id ORDER BY pts.at, pts.src, pts.ord)
+    )
+    INSERT INTO location_rollups (device_id, period, bucket_start, first_at, first_lat, first_lon,
+                                  last_at, last_lat, last_lon, lat, lon, point_count, distance_m)
+    SELECT device_id, 'hour', bucket_start,
+           min(at),
+           (array_agg(lat ORDER BY at, src, ord))[1],
+           (array_agg(lon ORDER BY at, src, ord))[1],
+           max(at),
+           (array_agg(lat ORDER BY at DESC, src DESC, ord DESC))[1],
+           (array_agg(lon ORDER BY at DESC, src DESC, ord DESC))[1],
+           avg(lat), avg(lon), count(*),
+           COALESCE(sum({_HOP_M.format(lat='lat', lon='lon', plat='plat', plon='plon')}), 0)
+    FROM hops
+    GROUP BY device_id, bucket_start
+"""
+
+# Days [day_start, day_end) rebuilt from their hours
+DAY_ROLLUP_SQL = """
+    INSERT INTO location_rollups (device_id, period, bucket_start, first_at, first_lat, first_lon,
+                                  last_at, last_lat, last_lon, lat, lon, point_count, distance_m)
+    SELECT device_id, 'day', date_trunc('day', bucket_start),
+           min(first_at),
+           (array_agg(first_lat ORDER BY bucket_start))[1],
+           (array_agg(first_lon ORDER BY bucket_start))[1],
+           max(last_at),
+           (array_agg(last_lat ORDER BY bucket_start DESC))[1],
+           (array_agg(last_lon ORDER BY bucket_start DESC))[1],
+           sum(lat * point_count) / sum(point_count),
+           sum(lon * point_count) / sum(point_count),
+           sum(point_count), sum(distance_m)
+    FROM location_rollups
+    WHERE period = 'hour' AND bucket_start >= %(day_start)s AND bucket_start < %(day_end)s
+    GROUP BY device_id, date_trunc('day', bucket_start)
+"""
+
+DELETE_SQL = """
+    DELETE FROM location_rollups
+    WHERE period = %(period)s AND bucket_start >= %(start)s AND bucket_start < %(end)s
+"""
+
+# Where a window's rollups end and its raw tail begins: the start of the last
+# bucket not fully rolled up, or window_start when rollups don't reach it
+ROLLUP_BOUNDARY_SQL = """
+    SELECT b.boundary, (EXTRACT(EPOCH FROM b.boundary::timestamptz) * 1000)::bigint - 1 AS boundary_ms
+    FROM (
+        SELECT GREATEST(%s::timestamp,
+                        (SELECT date_trunc(%s, rolled_until) FROM location_rollup_state WHERE id = 1)) AS boundary
+    ) b
+"""
+
+# Whole buckets in [from, boundary) that reach into the window (last_at >= window_start)
+ROLLUPS_SQL = """
+    SELECT bucket_start, first_at, first_lat, first_lon, last_at, last_lat, last_lon,
+           lat, lon, point_count, distance_m
+    FROM location_rollups
+    WHERE device_id = %s AND period = %s AND last_at >= %s
+      AND bucket_start >= %s AND bucket_start + ('1 ' || period)::interval <= %s
+    ORDER BY bucket_start
+"""
+
+
+def period_for(days):
+    """Rollup period for a history window, or None to serve raw points."""
+    if days < float(os.getenv('ROLLUP_MIN_DAYS', 7)):
+        return None
+    return 'hour' if days <= float(os.getenv('ROLLUP_HOURLY_MAX_DAYS', 31)) else 'day'
+
+
+def rollup_points(rows, period):
+    """
+    History points for rollup rows: one per bucket at its last fix (so the
+    track joins bucket ends), with the bucket's first fix, centroid, point
+    count and distance alongside.
+    """
+    return [{
+        'lat': r['last_lat'],
+        'lon': r['last_lon'],
+        'time': r['last_at'].isoformat(),
+        'type': 'rollup',
+        'provider': period,
+        'bucket': r['bucket_start'].isoformat(),
+        'first': {'lat': r['first_lat'], 'lon': r['first_lon'], 'time': r['first_at'].isoformat()},
+        'centroid': {'lat': r['lat'], 'lon': r['lon']},
+        'points': r['point_count'],
+        'distance_km': round(r['distance_m'] / 1000.0, 3),
+    } for r in rows]
+
+
+def ensure_schema(cur):
+    cur.execute(SCHEMA_SQL)
+
+
+def migrate(cur):
+    cur.execute(SCHEMA_SQL)
+    cur.execute(MIGRATE_SQL)
+
+
+def roll_up(cur, start, end):
+    """Recompute the hours [start, end) and every day they touch (caller's transaction)."""
+    start_ms, end_ms = log_points.ms_bounds(cur, start, end)
+    cur.execute(DELETE_SQL, {'period': 'hour', 'start': start, 'end': end})
+    cur.execute(HOUR_ROLLUP_SQL, {'start': start, 'end': end, 'start_ms': start_ms, 'end_ms': end_ms})
+    # Whole days, also when the range ends or starts mid-day
+    day_start = datetime.combine(start.date(), datetime.min.time())
+    day_end = datetime.combine((end - timedelta(microseconds=1)).date(), datetime.min.time()) + timedelta(days=1)
+    cur.execute(DELETE_SQL, {'period': 'day', 'start': day_start, 'end': day_end})
+    cur.execute(DAY_ROLLUP_SQL, {'day_start': day_start, 'day_end': day_end})
+
+
+def rewind(cur, rolled_until, seen_id):
+    """
+    rolled_until pulled back to the oldest hour among the location_history
+    rows added since seen_id, if that is earlier; records the new seen id.
+    """
+    if seen_id is None:
+        cur.execute("SELECT MAX(id) FROM location_history")
+        oldest, max_id = None, cur.fetchone()[0]
+    else:
+        cur.execute(NEW_HISTORY_SQL, (seen_id,))
+        oldest, max_id = cur.fetchone()
+    if max_id is None or max_id == seen_id:
+        return rolled_until
+    if rolled_until is not None and oldest is not None and oldest < rolled_until:
+        rolled_until = oldest
+    cur.execute("UPDATE location_rollup_state SET rolled_until = %s, seen_history_id = %s WHERE id = 1",
+                (rolled_until, max_id))
+    return rolled_until
+
+
+def run_job(conn, rebuild=False):
+    """Roll up the hours that settled since the last run; returns the number of hours."""
+    cur = conn.cursor()
+    ensure_schema(cur)
+    if rebuild:
+        cur.execute("TRUNCATE location_rollups")
+        cur.execute("DELETE FROM location_rollup_state")
+    cur.execute("INSERT INTO location_rollup_state (id) VALUES (1) ON CONFLICT DO NOTHING")
+    conn.commit()
+
+    cur.execute(SETTLED_SQL, (SETTLE_S,))
+    settled = cur.fetchone()[0]
+    hours = 0
+    while True:
+        # Row lock: concurrent runs never roll up the same hours twice
+        cur.execute("SELECT rolled_until, seen_history_id FROM location_rollup_state WHERE id = 1 FOR UPDATE")
+        start = rewind(cur, *cur.fetchone())
+        if start is None:
+            cur.execute(OLDEST_SQL)
+            start = cur.fetchone()[0]
+            if start is None:
+                conn.commit()
+                break
+        if start >= settled:
+            conn.commit()
+            break
+        end = min(settled, start + timedelta(hours=BATCH_HOURS))
+        roll_up(cur, start, end)
+        cur.execute("UPDATE location_rollup_state SET rolled_until = %s, updated_at = NOW() WHERE id = 1", (end,))
+        conn.commit()
+        hours += int((end - start) / timedelta(hours=1))
+    cur.close()
+    return hours
+
+
+def main():
+    load_dotenv()
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--schema', action='store_true', help='create or upgrade rollup tables and exit unless --once')
+    ap.add_argument('--once', action='store_true', help='catch up once and exit')
+    ap.add_argument('--rebuild', action='store_true', help='drop all rollups and recompute')
+    ap.add_argument('--interval', type=float, default=60.0, help='seconds between runs')
+    args = ap.parse_args()
+
+    conn = psycopg2.connect(
+        host=os.getenv('DB_HOST', 'localhost'),
+        port=int(os.getenv('DB_PORT', 5432)),
+        database=os.getenv('DB_NAME', 'hmdm'),
+        user=os.getenv('DB_USER', 'hmdm'),
+        password=os.getenv('DB_PASSWORD', 'topsecret'),
+    )
+    if args.schema:
+        with conn.cursor() as cur:
+            migrate(cur)
+        conn.commit()
+        if not (args.once or args.rebuild):
+            return
+
+    rebuild = args.rebuild
+    while True:
+        started = time.time()
+        hours = run_job(conn, rebuild=rebuild)
+        rebuild = False
+        print(f"{datetime.now()}: rolled up {hours} hours in {time.time() - started:.1f}s")
+        if args.once or args.rebuild:
+            return
+        time.sleep(args.interval)
+
+
+if __name__ == '__main__':
+    main()
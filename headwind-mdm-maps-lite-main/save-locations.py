@@ -1,9 +1,20 @@
 #!/usr/bin/env python3
 import psycopg2
 import json
+import os
 import time
 from datetime import datetime
 
+import freshness
+import metrics
+from shared_cache import get_cache, NullCache
+
+# Seconds between runs; compare with /admin/freshness (auto-save stage)
+SAVE_INTERVAL_S = float(os.getenv('SAVE_INTERVAL_S', 300))
+
+_cache = get_cache()
+freshness_tracker = freshness.FreshnessTracker(store=None if isinstance(_cache, NullCache) else _cache)
+
 DB_CONFIG = {
     'host': 'localhost',
     'port': 5432,
@@ -14,6 +25,7 @@ DB_CONFIG = {
 
 def save_current_locations():
     """Save current device locations to history table"""
+    started = time.perf_counter()
     try:
         conn = psycopg2.connect(**DB_CONFIG)
         cur = conn.cursor()
@@ -27,6 +39,7 @@ def save_current_locations():
         
         devices = cur.fetchall()
         locations_saved = 0
+        stored = []             # (number, fix ts) for freshness
         
         for device in devices:
             try:
@@ -54,22 +67,36 @@ def save_current_locations():
                                 VALUES (%s, %s, %s, 'auto-save')
                             """, (device[0], float(lat), float(lon)))
                             locations_saved += 1
+                            if loc.get('ts'):
+                                stored.append((device[1], float(loc['ts']) / 1000.0))
                         
             except (json.JSONDecodeError, ValueError, TypeError) as e:
                 print(f"Error processing device {device[1]}: {e}")
+                metrics.SNAPSHOT_ERRORS.inc(writer='auto-save')
                 continue
         
         conn.commit()
         cur.close()
+
         conn.close()
         
+        metrics.SNAPSHOT_DEVICES.inc(len(devices), writer='auto-save')
+        metrics.SNAPSHOT_ROWS.inc(locations_saved, writer='auto-save')
+        freshness_tracker.observe_many('auto-save', stored)
+        freshness_tracker.flush()
         print(f"{datetime.now()}: Saved {locations_saved} new device locations")
         
     except Exception as e:
+        metrics.SNAPSHOT_ERRORS.inc(writer='auto-save')
         print(f"Error saving locations: {e}")
+    finally:
+        metrics.SNAPSHOT_RUNS.observe(time.perf_counter() - started, writer='auto-save')
 
 if __name__ == '__main__':
     print("Starting location auto-save service...")
+    if os.getenv('METRICS_PORT'):
+        # Prometheus scrape target for the poller (same metric names as the API)
+        metrics.start_http_server(int(os.getenv('METRICS_PORT')))
     while True:
         save_current_locations()
-        time.sleep(300)  # Save every 5 minutes
+        time.sleep(SAVE_INTERVAL_S)
@@ -0,0 +1,167 @@
+-- Tables used by the maps server.
+--
+-- devices / plugin_devicelog_log belong to Headwind MDM and already exist on a
+-- real install; the minimal definitions below are only created on an empty
+-- local database (benchmarks, generate_fleet.py). location_history and
+-- map_users are owned by the maps server.
+--
+--   psql -h localhost -U hmdm -d hmdm -f schema.sql
+
+CREATE TABLE IF NOT EXISTS devices (
+    id          SERIAL PRIMARY KEY,
+    number      VARCHAR(100) NOT NULL UNIQUE,
+    description VARCHAR(1000),
+    imei        VARCHAR(50),
+    info        TEXT
+);
+
+CREATE TABLE IF NOT EXISTS plugin_devicelog_log (
+    id          BIGSERIAL PRIMARY KEY,
+    createtime  BIGINT NOT NULL,
+    deviceid    INT NOT NULL,
+    ipaddress   VARCHAR(50),
+    severity    INT,
+    message     TEXT
+);
+CREATE INDEX IF NOT EXISTS plugin_devicelog_log_device_time
+    ON plugin_devicelog_log (deviceid, createtime);
+
+CREATE TABLE IF NOT EXISTS location_history (
+    id          BIGSERIAL PRIMARY KEY,
+    device_id   INT NOT NULL,
+    lat         DOUBLE PRECISION NOT NULL,
+    lon         DOUBLE PRECISION NOT NULL,
+    recorded_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    source      VARCHAR(32)
+);
+CREATE INDEX IF NOT EXISTS location_history_device_time
+    ON location_history (device_id, recorded_at);
+
+CREATE TABLE IF NOT EXISTS map_users (
+    id            SERIAL PRIMARY KEY,
+    username      VARCHAR(100) NOT NULL UNIQUE,
+    password_hash VARCHAR(255) NOT NULL,
+    full_name     VARCHAR(255),
+    is_admin      BOOLEAN NOT NULL DEFAULT FALSE,
+    created_at    TIMESTAMP NOT NULL DEFAULT NOW(),
+    last_login    TIMESTAMP
+);
+
+-- Trip / stop segments, maintained by trips.py (keep in sync with trips.SCHEMA_SQL)
+CREATE TABLE IF NOT EXISTS device_trips (
+    id          BIGSERIAL PRIMARY KEY,
+    device_id   INT NOT NULL,
+    kind        VARCHAR(8) NOT NULL,
+    started_at  TIMESTAMP NOT NULL,
+    ended_at    TIMESTAMP NOT NULL,
+    duration_s  INT NOT NULL,
+    distance_m  DOUBLE PRECISION NOT NULL DEFAULT 0,
+    point_count INT NOT NULL,
+    lat         DOUBLE PRECISION,
+    lon         DOUBLE PRECISION,
+    start_lat   DOUBLE PRECISION NOT NULL,
+    start_lon   DOUBLE PRECISION NOT NULL,
+    end_lat     DOUBLE PRECISION NOT NULL,
+    end_lon     DOUBLE PRECISION NOT NULL,
+    is_open     BOOLEAN NOT NULL DEFAULT TRUE
+);
+CREATE INDEX IF NOT EXISTS device_trips_device_time ON device_trips (device_id, started_at);
+
+CREATE TABLE IF NOT EXISTS device_trip_state (
+    device_id       INT PRIMARY KEY,
+    last_at         TIMESTAMP,
+    state           TEXT
+);
+
+CREATE TABLE IF NOT EXISTS trip_job_state (
+    id              INT PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+    settled_until   TIMESTAMP,
+    updated_at      TIMESTAMP
+);
+
+-- Hourly / daily history rollups, maintained by rollups.py (keep in sync with rollups.SCHEMA_SQL)
+CREATE TABLE IF NOT EXISTS location_rollups (
+    device_id    INT NOT NULL,
+    period       VARCHAR(4) NOT NULL,
+    bucket_start TIMESTAMP NOT NULL,
+    first_at     TIMESTAMP NOT NULL,
+    first_lat    DOUBLE PRECISION NOT NULL,
+    first_lon    DOUBLE PRECISION NOT NULL,
+    last_at      TIMESTAMP NOT NULL,
+    last_lat     DOUBLE PRECISION NOT NULL,
+    last_lon     DOUBLE PRECISION NOT NULL,
+    lat          DOUBLE PRECISION NOT NULL,
+    lon          DOUBLE PRECISION NOT NULL,
+    point_count  INT NOT NULL,
+    distance_m   DOUBLE PRECISION NOT NULL DEFAULT 0,
+    PRIMARY KEY (device_id, period, bucket_start)
+);
+
+CREATE TABLE IF NOT EXISTS location_rollup_state (
+    id              INT PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+    rolled_until    TIMESTAMP,
+    seen_history_id BIGINT,
+    updated_at      TIMESTAMP
+);
+
+-- Geofences and enter/exit events, maintained by geofences.py (keep in sync with geofences.SCHEMA_SQL)
+CREATE TABLE IF NOT EXISTS geofences (
+    id          SERIAL PRIMARY KEY,
+    name        VARCHAR(255) NOT NULL,
+    kind        VARCHAR(8) NOT NULL,            -- 'polygon' | 'circle'
+    polygon     TEXT,                           -- JSON [[lat, lon], ...]
+    center_lat  DOUBLE PRECISION,
+    center_lon  DOUBLE PRECISION,
+    radius_m    DOUBLE PRECISION,
+    created_at  TIMESTAMP NOT NULL DEFAULT NOW(),
+    updated_at  TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS geofence_device_state (
+    device_id   INT PRIMARY KEY,
+    inside      INT[] NOT NULL DEFAULT '{}',
+    last_at     TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS geofence_events (
+    id          BIGSERIAL PRIMARY KEY,
+    device_id   INT NOT NULL,
+    fence_id    INT NOT NULL,
+    event       VARCHAR(5) NOT NULL,            -- 'enter' | 'exit'
+    at          TIMESTAMP NOT NULL,
+    lat         DOUBLE PRECISION NOT NULL,
+    lon         DOUBLE PRECISION NOT NULL
+);
+CREATE INDEX IF NOT EXISTS geofence_events_device_time ON geofence_events (device_id, at);
+CREATE INDEX IF NOT EXISTS geofence_events_fence_time ON geofence_events (fence_id, at);
+
+CREATE TABLE IF NOT EXISTS geofence_job_state (
+    id              INT PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+    settled_until   TIMESTAMP,
+    updated_at      TIMESTAMP
+);
+
+-- GPS update-frequency counters, maintained by update_frequency.py (keep in sync with update_frequency.SCHEMA_SQL)
+CREATE TABLE IF NOT EXISTS gps_update_buckets (
+    device_id       INT NOT NULL,
+    period          VARCHAR(6) NOT NULL,        -- 'minute' | 'hour'
+    bucket          BIGINT NOT NULL,            -- createtime / 60000 or / 3600000
+    updates         INT NOT NULL,
+    last_update_ms  BIGINT NOT NULL,
+    PRIMARY KEY (device_id, period, bucket)
+);
+
+CREATE TABLE IF NOT EXISTS gps_update_counters (
+    device_id       INT PRIMARY KEY,
+    updates_10m     INT NOT NULL DEFAULT 0,
+    updates_1h      INT NOT NULL DEFAULT 0,
+    updates_24h     INT NOT NULL DEFAULT 0,
+    last_update_ms  BIGINT,
+    computed_at     TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS gps_update_state (
+    id                  INT PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+    counted_until_ms    BIGINT,
+    computed_at         TIMESTAMP
+);
@@ -1,14 +1,31 @@
 #!/usr/bin/env python3
-from flask import Flask, jsonify, send_file, request, render_template_string, redirect, url_for, flash
+from flask import Flask, Response, jsonify, send_file, request, render_template_string, redirect, url_for, flash, has_request_context
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
-import psycopg2
-from psycopg2.extras import RealDictCursor
+from db import DictCursor
+import ipaddress
 import json
-import re
-import bcrypt
 import os
+import threading
+import time
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
+from shared_cache import get_cache, NullCache, MemoryCache
+from slow_queries import SlowQueryLog
+import db
+import archive
+import export
+import freshness
+import geofences
+import log_points
+import metrics
+import movement
+import nearest
+import passwords
+import profiling
+import queries
+import rollups
+import trips
+import update_frequency
 
 # ──────────────────────────────────────────────────────────────────────────────
 # Config
@@ -19,16 +36,20 @@ app = Flask(__name__)
 app.secret_key = os.getenv('SECRET_KEY', 'dev-key-please-change-in-production')
 app.config['DEBUG'] = os.getenv('FLASK_DEBUG', 'False').lower() == 'true'
 
-DB_CONFIG = {
-    'host': os.getenv('DB_HOST', 'localhost'),
-    'port': int(os.getenv('DB_PORT', 5432)),
-    'database': os.getenv('DB_NAME', 'hmdm'),
-    'user': os.getenv('DB_USER', 'hmdm'),
-    'password': os.getenv('DB_PASSWORD', 'topsecret')
-}
+DB_CONFIG = db.env_config()
+db.configure(DB_CONFIG)
 
 API_KEY = os.getenv("API_KEY")
 
+# Shared across workers (see shared_cache.py); CACHE_URL=none:// disables it
+cache = get_cache()
+CACHE_TTL = {
+    'locations': float(os.getenv('CACHE_TTL_LOCATIONS', 10)),
+    'devices': float(os.getenv('CACHE_TTL_DEVICES', 60)),
+    'history': float(os.getenv('CACHE_TTL_HISTORY', 30)),
+    'update_frequency': float(os.getenv('CACHE_TTL_UPDATE_FREQUENCY', 30)),
+}
+
 @app.before_request
 def api_key_auth():
     # Only for API routes
@@ -43,6 +64,32 @@ def api_key_auth():
         return jsonify({"error": "Unauthorized"}), 401
 
 
+# Per-route latency, DB time and cache hit rates on GET /metrics
+metrics.init_app(app)
+db.QUERY_HOOKS.append(metrics.record_query)
+metrics.DB_POOL.set_function(lambda: {(k,): v for k, v in db.pool_stats().items()})
+metrics.DB_REPLICA_LAG.set_function(
+    lambda: {(name,): st['lag'] for name, st in db.replica_stats().items() if st['lag'] is not None})
+metrics.DB_REPLICA_UP.set_function(lambda: {(name,): int(st['up']) for name, st in db.replica_stats().items()})
+
+# Statements over SLOW_QUERY_MS, optionally with EXPLAIN plans; see /admin/slow-queries
+slow_query_log = SlowQueryLog(
+    store=None if isinstance(cache, NullCache) else cache,
+    context=lambda: f"{request.method} {request.path}" if has_request_context() else None,
+)
+db.QUERY_HOOKS.append(slow_query_log)
+
+# Age of fixes when they reach /api/locations, /history and location_history; see /admin/freshness
+freshness_tracker = freshness.FreshnessTracker(store=None if isinstance(cache, NullCache) else cache)
+
+# X-Profile: 1 / ?profile=1 from an admin samples the request; see /admin/profiles
+profiles = profiling.init_app(
+    app,
+    is_admin=lambda: current_user.is_authenticated and getattr(current_user, 'is_admin', False),
+    store=None if isinstance(cache, NullCache) else cache,
+)
+
+
 # ──────────────────────────────────────────────────────────────────────────────
 # Auth (Flask-Login)
 # ──────────────────────────────────────────────────────────────────────────────
@@ -50,6 +97,32 @@ login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 
+# Failed-login counters must be shared by all workers to mean anything
+login_throttle = passwords.LoginThrottle(MemoryCache() if isinstance(cache, NullCache) else cache)
+metrics.LOGIN_HASH_QUEUE.set_function(lambda: {(): passwords.pending()})
+
+# Only these peers may tell us the client address through X-Forwarded-For
+TRUSTED_PROXIES = [ipaddress.ip_network(n.strip(), strict=False)
+                   for n in os.getenv('TRUSTED_PROXIES', '127.0.0.1,::1').split(',') if n.strip()]
+
+def _trusted_proxy(addr):
+    try:
+        ip = ipaddress.ip_address(addr)
+    except ValueError:
+        return False
+    return any(ip in net for net in TRUSTED_PROXIES)
+
+def client_ip():
+    """The nearest address that isn't one of TRUSTED_PROXIES, walking X-Forwarded-For from the right."""
+    addr = request.remote_addr
+    if not _trusted_proxy(addr) or 'X-Forwarded-For' not in request.headers:
+        return addr
+    for hop in reversed(request.access_route):
+        addr = hop
+        if not _trusted_proxy(hop):
+            break
+    return addr
+
 class User(UserMixin):
     def __init__(self, id, username, full_name, is_admin=False):
         self.id = id
@@ -60,11 +133,11 @@ class User(UserMixin):
 @login_manager.user_loader
 def load_user(user_id):
     try:
-        conn = psycopg2.connect(**DB_CONFIG)
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        cur.execute("SELECT id, username, full_name, is_admin FROM map_users WHERE id = %s", (user_id,))
-        user_data = cur.fetchone()
-        cur.close(); conn.close()
+        with db.connection() as conn:
+            cur = conn.cursor(cursor_factory=DictCursor)
+            queries.execute(cur, 'user_by_id', (int(user_id),))
+            user_data = cur.fetchone()
+            cur.close()
         if user_data:
             return User(user_data['id'], user_data['username'], user_data['full_name'], user_data.get('is_admin', False))
     except Exception:
@@ -74,29 +147,64 @@ def load_user(user_id):
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
-        username = request.form.get('username')
-        password = request.form.get('password')
+        started = time.perf_counter()
+        result, response = login_attempt()
+        metrics.LOGIN_ATTEMPTS.inc(result=result)
+        metrics.LOGIN_LATENCY.observe(time.perf_counter() - started, result=result)
+        if response is not None:
+            return response
 
-        try:
-            conn = psycopg2.connect(**DB_CONFIG)
-            cur = conn.cursor(cursor_factory=RealDictCursor)
-            cur.execute("SELECT id, username, password_hash, full_name, is_admin FROM map_users WHERE username = %s", (username,))
-            user_data = cur.fetchone()
+    return render_template_string(LOGIN_TEMPLATE)
 
-            if user_data and bcrypt.checkpw(password.encode('utf-8'), user_data['password_hash'].encode('utf-8')):
-                user = User(user_data['id'], user_data['username'], user_data['full_name'], user_data.get('is_admin', False))
-                login_user(user)
-                cur.execute("UPDATE map_users SET last_login = NOW() WHERE id = %s", (user_data['id'],))
-                conn.commit()
-                cur.close(); conn.close()
-                return redirect(url_for('index'))
-            else:
-                cur.close(); conn.close()
-                flash('Invalid username or password')
-        except Exception as e:
-            flash(f'Login error: {str(e)}')
+def login_attempt():
+    """(result, response-or-None) for a login POST; None renders the form again."""
+    username = request.form.get('username') or ''
+    password = request.form.get('password') or ''
+    ip = client_ip()
 
-    return render_template_string(LOGIN_TEMPLATE)
+    try:
+        login_throttle.check(username, ip)
+    except passwords.Throttled:
+        flash('Too many failed attempts, please wait a few minutes')
+        return 'throttled', (render_template_string(LOGIN_TEMPLATE), 429)
+
+    try:
+        with db.connection() as conn:
+            cur = conn.cursor(cursor_factory=DictCursor)
+            queries.execute(cur, 'user_by_name', (username,))
+            user_data = cur.fetchone()
+            cur.close()
+
+        # The connection goes back to the pool before the hash: a queue of
+        # logins waits on bcrypt workers, not on DB connections.
+        # Unknown users still cost one bcrypt check, so timing doesn't reveal which names exist
+        password_ok = passwords.check_password(password, user_data['password_hash'] if user_data else None)
+        if not (user_data and password_ok):
+            login_throttle.failed(username, ip)
+            flash('Invalid username or password')
+            return 'invalid', None
+
+        user = User(user_data['id'], user_data['username'], user_data['full_name'], user_data.get('is_admin', False))
+        new_hash = passwords.hash_password(password) if passwords.needs_rehash(user_data['password_hash']) else None
+        with db.connection() as conn:
+            cur = conn.cursor()
+            if new_hash:
+                cur.execute("UPDATE map_users SET last_login = NOW(), password_hash = %s WHERE id = %s",
+                            (new_hash, user_data['id']))
+                metrics.LOGIN_REHASHES.inc()
+            else:
+                cur.execute("UPDATE map_users SET last_login = NOW() WHERE id = %s", (user_data['id'],))
+            conn.commit()
+            cur.close()
+        login_user(user)
+        login_throttle.succeeded(username, ip)
+        return 'ok', redirect(url_for('index'))
+    except passwords.Busy:
+        flash('The server is busy signing other users in, please try again in a moment')
+        return 'busy', (render_template_string(LOGIN_TEMPLATE), 503, {'Retry-After': '2'})
+    except Exception as e:
+        flash(f'Login error: {str(e)}')
+        return 'error', None
 
 @app.route('/logout')
 @login_required
@@ -113,257 +221,631 @@ def index():
 # ──────────────────────────────────────────────────────────────────────────────
 # Helpers
 # ──────────────────────────────────────────────────────────────────────────────
-def parse_gps_from_message(message: str):
+# Kept here for callers of the Flask module; the rules live with the SQL ones
+parse_gps_from_message = log_points.parse_gps_from_message
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+_flights = {}
+_flights_lock = threading.Lock()
+# A follower stops waiting for the leader after this long and computes itself
+COALESCE_TIMEOUT_S = float(os.getenv('COALESCE_TIMEOUT_S', 15))
+
+def single_flight(key, compute, timeout=None):
+    """
+    Run compute() once per key at a time in this process: threads asking for a
+    key that is already being computed wait for that result (or exception)
+    instead of running the same queries again.
+    """
+    with _flights_lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _flights[key] = _Flight()
+
+    name = key.split(':', 1)[0]
+    if not leader:
+        if flight.done.wait(COALESCE_TIMEOUT_S if timeout is None else timeout):
+            metrics.CACHE_REQUESTS.inc(cache=name, result='coalesced')
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+        metrics.CACHE_REQUESTS.inc(cache=name, result='coalesce_timeout')
+        return compute()
+
+    try:
+        flight.value = compute()
+        return flight.value
+    except Exception as e:
+        flight.error = e
+        raise
+    finally:
+        with _flights_lock:
+            del _flights[key]
+        flight.done.set()
+
+def cached(key, ttl, compute):
     """
-    Extract lat/lon from:
-      • JSON messages: {"lat":..,"lon":..} or {"latitude":..,"longitude":..}
-      • Text messages: "lat=.., lon=.." or "latitude=.., longitude=.."
-    Returns (lat, lon) or (None, None)
+    Return the shared-cache value for key, computing and storing it on a miss.
+    compute() may return None to signal "don't cache" (e.g. not found).
+    Concurrent misses on the same key share one compute() (single_flight).
     """
-    if not message:
-        return None, None
+    name = key.split(':', 1)[0]
+    entry = cache.get(key)
+    if entry is not None:
+        metrics.CACHE_REQUESTS.inc(cache=name, result='hit')
+        return entry.value
+    metrics.CACHE_REQUESTS.inc(cache=name, result='miss')
+
+    def load():
+        value = compute()
+        if value is not None:
+            cache.set(key, value, ttl)
+        return value
+    return single_flight(key, load)
 
-    # Try JSON first
+# ──────────────────────────────────────────────────────────────────────────────
+# Queries + row shaping (shared with asgi_server.py)
+# ──────────────────────────────────────────────────────────────────────────────
+LOCATIONS_SQL = """
+    SELECT id, number, description, imei, info
+    FROM devices
+    WHERE info IS NOT NULL
+    ORDER BY number
+"""
+
+DEVICES_SQL = """
+    SELECT
+        d.number,
+        d.description,
+        COALESCE(lc.log_updates, 0) + COALESCE(hc.hist_updates, 0) AS gps_updates,
+        COALESCE(lc.log_updates, 0) AS log_updates,
+        COALESCE(hc.hist_updates, 0) AS hist_updates
+    FROM devices d
+    LEFT JOIN (
+        SELECT deviceid, COUNT(*) AS log_updates
+        FROM plugin_devicelog_log
+        WHERE message ILIKE '%%location%%'
+        GROUP BY deviceid
+    ) lc ON lc.deviceid = d.id
+    LEFT JOIN (
+        SELECT device_id, COUNT(*) AS hist_updates
+        FROM location_history
+        WHERE recorded_at >= NOW() - INTERVAL '30 days'
+        GROUP BY device_id
+    ) hc ON hc.device_id = d.id
+    WHERE d.info IS NOT NULL
+    ORDER BY d.description, d.number
+"""
+
+DEVICE_LOOKUP_SQL = """
+    SELECT id, number, description, info
+    FROM devices
+    WHERE number = %s
+"""
+
+# One round trip for /history: a device row (part 0, carrying devices.info
+# for the live fix) followed by the log and location_history points (part 1),
+# coordinates already extracted from log messages (log_points.py, the rules of
+# parse_gps_from_message), de-duplicated on (time, lat, lon) and in time order.
+# Log times are converted in the DB session's time zone.
+HISTORY_SQL = f"""
+    WITH dev AS (
+        SELECT id, number, description, info
+        FROM devices
+        WHERE number = %s
+    ),
+    logs AS (
+        SELECT l.createtime, l.message,
+               {log_points.MATCH_COLUMNS}
+        FROM plugin_devicelog_log l
+        JOIN dev ON l.deviceid = dev.id
+        WHERE {log_points.MESSAGE_FILTER}
+          AND l.createtime > %s
+    ),
+    points AS (
+        SELECT {log_points.AT} AS at, 0 AS src, createtime AS ord,
+               {log_points.LAT} AS lat,
+               {log_points.LON} AS lon,
+               'log' AS type,
+               {log_points.PROVIDER} AS provider
+        FROM logs
+        WHERE {log_points.HAS_FIX}
+        UNION ALL
+        SELECT h.recorded_at, 1, h.id, h.lat, h.lon, 'history', COALESCE(h.source, 'history')
+        FROM location_history h
+        JOIN dev ON h.device_id = dev.id
+        WHERE h.recorded_at >= %s
+    )
+    SELECT 0 AS part, NULL::timestamp AS at, 0 AS src, 0::bigint AS ord,
+           NULL::float8 AS lat, NULL::float8 AS lon, NULL::text AS type, NULL::text AS provider,
+           id, number::text, description::text, info::text
+    FROM dev
+    UNION ALL
+    SELECT * FROM (
+        SELECT DISTINCT ON (at, round(lat::numeric, 6), round(lon::numeric, 6))
+               1, at, src, ord, lat, lon, type, provider, NULL::int, NULL::text, NULL::text, NULL::text
+        FROM points
+        ORDER BY at, round(lat::numeric, 6), round(lon::numeric, 6), src, ord
+    ) dedup
+    ORDER BY part, at, src, ord
+"""
+
+# A live fix is stored only if the device has no point this close before it
+SNAPSHOT_MIN_GAP_S = float(os.getenv('SNAPSHOT_MIN_GAP_S', 120))
+
+SNAPSHOT_INSERT_SQL = f"""
+    INSERT INTO location_history (device_id, lat, lon, recorded_at, source)
+    SELECT %s::bigint, %s::float8, %s::float8, %s::timestamp, %s::text
+    WHERE NOT EXISTS (
+      SELECT 1
+      FROM location_history
+      WHERE device_id = %s
+        AND recorded_at >= %s::timestamp - INTERVAL '{SNAPSHOT_MIN_GAP_S:g} seconds'
+    )
+"""
+
+USER_BY_ID_SQL = "SELECT id, username, full_name, is_admin FROM map_users WHERE id = %s"
+USER_BY_NAME_SQL = "SELECT id, username, password_hash, full_name, is_admin FROM map_users WHERE username = %s"
+
+# Hot statements, prepared once per pooled connection and run by name
+queries.register('locations', LOCATIONS_SQL)
+queries.register('devices', DEVICES_SQL)
+queries.register('device_lookup', DEVICE_LOOKUP_SQL, ('text',))
+queries.register('history', HISTORY_SQL, ('text', 'bigint', 'timestamp'))
+queries.register('snapshot_insert', SNAPSHOT_INSERT_SQL,
+                 ('bigint', 'float8', 'float8', 'timestamp', 'text', 'bigint', 'timestamp'))
+queries.register('rollup_state', rollups.ROLLUP_BOUNDARY_SQL, ('timestamp', 'text'))
+queries.register('rollups', rollups.ROLLUPS_SQL, ('int', 'text', 'timestamp', 'timestamp', 'timestamp'))
+queries.register('user_by_id', USER_BY_ID_SQL, ('int',))
+queries.register('user_by_name', USER_BY_NAME_SQL, ('text',))
+
+def location_from_row(d):
+    """devices row -> /api/locations item, or None if it has no usable fix."""
     try:
-        j = json.loads(message)
-        lat = j.get('lat') if 'lat' in j else j.get('latitude')
-        lon = j.get('lon') if 'lon' in j else (j.get('lng') if 'lng' in j else j.get('longitude'))
-        if lat is not None and lon is not None:
-            return float(lat), float(lon)
+        info_json = json.loads(d['info'])
+        loc = (info_json or {}).get('location') or {}
+        lat, lon = loc.get('lat'), loc.get('lon')
+        ts = loc.get('ts')
+
+        if lat is not None and lon is not None and float(lat) != 0 and float(lon) != 0:
+            if ts:
+                try:
+                    dt = datetime.fromtimestamp(int(ts) / 1000)
+                except Exception:
+                    dt = datetime.utcnow()
+            else:
+                dt = datetime.utcnow()
+
+            return {
+                'id': d['id'],
+                'number': d['number'],
+                'description': d['description'] or 'Unknown Device',
+                'imei': d['imei'],
+                'lat': float(lat),
+                'lon': float(lon),
+                'time': dt.isoformat(),
+                'battery': info_json.get('batteryLevel', 'Unknown'),
+                'status': 'active'
+            }
+    except Exception:
+        pass
+    return None
+
+def device_from_row(d):
+    """DEVICES_SQL row -> /api/devices item."""
+    total = d['gps_updates'] or 0
+    name_display = d['description'] or d['number']
+    if total > 0:
+        name_display += f" ({total} points: {d['hist_updates'] or 0} history, {d['log_updates'] or 0} logs)"
+    else:
+        name_display += " (No location points yet)"
+
+    return {
+        'number': d['number'],
+        'name': name_display,
+        'gps_count': total,
+        'log_count': d['log_updates'] or 0,
+        'history_count': d['hist_updates'] or 0,
+    }
+
+def history_window(days):
+    """(since_ms, window_start) for a history request of `days` days."""
+    since_ms = int((datetime.utcnow() - timedelta(days=days)).timestamp() * 1000)
+    window_start = datetime.utcnow() - timedelta(days=days)
+    return since_ms, window_start
+
+def current_fix(info, window_start, last_ts):
+    """
+    The live devices.info location as (lat, lon, dt) if it falls in the window
+    and is newer than last_ts (the newest stored point), else None.
+    """
+    if not info:
+        return None
+    try:
+        loc = (json.loads(info) or {}).get('location') or {}
+        cur_lat = loc.get('lat')
+        cur_lon = loc.get('lon')
+        cur_ts_ms = loc.get('ts')
+
+        if cur_lat is not None and cur_lon is not None:
+            cur_dt = datetime.fromtimestamp(cur_ts_ms / 1000.0) if cur_ts_ms else datetime.utcnow()
+            if cur_dt >= window_start and (last_ts is None or cur_dt > last_ts):
+                return float(cur_lat), float(cur_lon), cur_dt
     except Exception:
         pass
+    return None
 
-    # Fallback: key=value in free text
-    num = r'(-?\d+(?:\.\d+)?)'
-    patterns = [
-        (rf'lat\s*[:=]\s*{num}\s*,?\s*lon\s*[:=]\s*{num}', 'latlon'),
-        (rf'latitude\s*[:=]\s*{num}\s*,?\s*longitude\s*[:=]\s*{num}', 'latlon'),
-        (rf'lon\s*[:=]\s*{num}\s*,?\s*lat\s*[:=]\s*{num}', 'lonlat'),
-        (rf'longitude\s*[:=]\s*{num}\s*,?\s*latitude\s*[:=]\s*{num}', 'lonlat'),
-    ]
-    for pattern, order in patterns:
-        m = re.search(pattern, message, re.IGNORECASE)
-        if m:
-            a, b = float(m.group(1)), float(m.group(2))
-            return (a, b) if order == 'latlon' else (b, a)
-
-    return None, None
+def history_from_rows(rows, window_start):
+    """
+    Split HISTORY_SQL output into (device, points, current); device is None if
+    unknown. The rows are already typed, merged, de-duplicated and ordered, so
+    the only work left is shaping them and appending the live fix.
+    """
+    if not rows:
+        return None, [], None
+    device = rows[0]
+    points = [{
+        'lat': r['lat'],
+        'lon': r['lon'],
+        'time': r['at'].isoformat(),
+        'type': r['type'],
+        'provider': r['provider'],
+    } for r in rows[1:]]
+
+    current = current_fix(device['info'], window_start, rows[-1]['at'] if len(rows) > 1 else None)
+    if current:
+        points.append({
+            'lat': current[0],
+            'lon': current[1],
+            'time': current[2].isoformat(),
+            'type': 'current',
+            'provider': 'current'
+        })
+    return device, points, current
+
+def history_payload(device, points, resolution='raw'):
+    return {
+        'device': {
+            'number': device['number'],
+            'description': device['description']
+        },
+        'history': points,
+        'total_points': len(points),
+        'resolution': resolution
+    }
 
 # ──────────────────────────────────────────────────────────────────────────────
 # APIs
 # ──────────────────────────────────────────────────────────────────────────────
+def load_locations():
+    """Current device locations from devices.info JSON (uncached)."""
+    with db.connection(readonly=True) as conn:
+        cur = conn.cursor(cursor_factory=DictCursor)
+        queries.execute(cur, 'locations')
+        devices = cur.fetchall()
+        cur.close()
+
+    return locations_from_rows(devices)
+
+def locations_from_rows(rows):
+    """Shape the 'locations' rows and count newly seen fixes for freshness."""
+    locations = [loc for loc in map(location_from_row, rows) if loc is not None]
+    freshness_tracker.observe_many(
+        'locations', [(loc['number'], datetime.fromisoformat(loc['time']).timestamp()) for loc in locations],
+        first_only=True)
+    return locations
+
 @app.route('/api/locations')
 @login_required
 def get_locations():
     """Return current device locations from devices.info JSON."""
     try:
-        conn = psycopg2.connect(**DB_CONFIG)
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        cur.execute("""
-            SELECT id, number, description, imei, info
-            FROM devices
-            WHERE info IS NOT NULL
-            ORDER BY number
-        """)
-        devices = cur.fetchall()
-        cur.close(); conn.close()
-
-        result = []
-        for d in devices:
-            try:
-                info_json = json.loads(d['info'])
-                loc = (info_json or {}).get('location') or {}
-                lat, lon = loc.get('lat'), loc.get('lon')
-                ts = loc.get('ts')
-
-                if lat is not None and lon is not None and float(lat) != 0 and float(lon) != 0:
-                    if ts:
-                        try:
-                            dt = datetime.fromtimestamp(int(ts) / 1000)
-                        except Exception:
-                            dt = datetime.utcnow()
-                    else:
-                        dt = datetime.utcnow()
-
-                    result.append({
-                        'id': d['id'],
-                        'number': d['number'],
-                        'description': d['description'] or 'Unknown Device',
-                        'imei': d['imei'],
-                        'lat': float(lat),
-                        'lon': float(lon),
-                        'time': dt.isoformat(),
-                        'battery': info_json.get('batteryLevel', 'Unknown'),
-                        'status': 'active'
-                    })
-            except Exception:
-                continue
-
-        return jsonify(result)
+        return jsonify(cached('locations', CACHE_TTL['locations'], load_locations))
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# Months moved out of Postgres by archive.py; read with mmap when a window reaches them
+history_archive = archive.Archive()
+
+# Current positions for /api/nearest, refreshed from the same cached rows
+# /api/locations serves at most every CACHE_TTL['locations'] seconds
+nearest_index = nearest.NearestIndex()
+
+@app.route('/api/nearest')
+@login_required
+def get_nearest():
+    """
+    ?lat=&lon=&k=5 (max 100)&max_age=<seconds since location.ts> -> closest
+    devices first, each /api/locations item plus distance_m.
+    """
+    try:
+        lat = float(request.args['lat'])
+        lon = float(request.args['lon'])
+        k = min(int(request.args.get('k', 5)), 100)
+        max_age = float(request.args['max_age']) if request.args.get('max_age') else None
+    except (KeyError, ValueError):
+        return jsonify({"error": "lat and lon are required; k and max_age must be numbers"}), 400
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return jsonify({"error": "lat/lon out of range"}), 400
+
+    try:
+        nearest_index.refresh(lambda: cached('locations', CACHE_TTL['locations'], load_locations),
+                              CACHE_TTL['locations'])
+        results = [dict(item, distance_m=round(d, 1))
+                   for item, d in nearest_index.nearest(lat, lon, k, max_age)]
+        return jsonify({
+            'lat': lat, 'lon': lon, 'k': k, 'max_age': max_age,
+            'as_of': datetime.fromtimestamp(nearest_index.refreshed_at).isoformat(),
+            'results': results,
+        })
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/device/<device_number>/history')
 @login_required
 def get_device_history(device_number):
-    """Build history from GPS/Network logs + location_history; append current if newer."""
+    """
+    Build history from GPS/Network logs + location_history; append current if newer.
+    Windows of ROLLUP_MIN_DAYS or more are served from the hourly/daily rollups
+    unless ?detail=1 asks for every raw point.
+    """
     days = int(request.args.get('days', 7))
+    period = None if request.args.get('detail') == '1' else rollups.period_for(days)
 
     try:
-        conn = psycopg2.connect(**DB_CONFIG)
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-
-        # Device lookup
-        cur.execute("""
-            SELECT id, number, description
-            FROM devices
-            WHERE number = %s
-        """, (device_number,))
-        device = cur.fetchone()
-        if not device:
+        if period:
+            payload = cached(
+                f'history:{device_number}:{days}:{period}', CACHE_TTL['history'],
+                lambda: load_device_rollups(device_number, days, period)
+            )
+        else:
+            payload = cached(
+                f'history:{device_number}:{days}', CACHE_TTL['history'],
+                lambda: load_device_history(device_number, days)
+            )
+        if payload is None:
             return jsonify({"error": "Device not found"}), 404
+        return jsonify(payload)
+    except Exception as e:
+        print(f"Error getting device history: {e}")
+        return jsonify({"error": str(e)}), 500
 
-        # Time window
-        since_ms = int((datetime.utcnow() - timedelta(days=days)).timestamp() * 1000)
-        window_start = datetime.utcnow() - timedelta(days=days)
-        history_points = []
-
-        # A) GPS/Network logs (within window)
-        cur.execute("""
-            SELECT createtime, message
-            FROM plugin_devicelog_log
-            WHERE deviceid = %s
-              AND (
-                    message ILIKE '%%GPS location update%%'
-                 OR message ILIKE '%%Network location update%%'
-                 OR message ILIKE '%%location update%%'
-              )
-              AND createtime > %s
-            ORDER BY createtime ASC
-        """, (device['id'], since_ms))
-
-        for entry in cur.fetchall():
-            msg = entry['message'] or ''
-            lat, lon = parse_gps_from_message(msg)
-            if lat is not None and lon is not None:
-                t = datetime.fromtimestamp(entry['createtime'] / 1000.0)
-                provider = (
-                    'gps' if 'gps' in msg.lower()
-                    else 'network' if 'network' in msg.lower()
-                    else 'log'
-                )
-                history_points.append({
-                    'lat': float(lat),
-                    'lon': float(lon),
-                    'time': t.isoformat(),
-                    'type': 'log',
-                    'provider': provider
-                })
-
-        # B) location_history points (fills gaps)
-        cur.execute("""
-            SELECT lat, lon, recorded_at, source
-            FROM location_history
-            WHERE device_id = %s
-              AND recorded_at >= %s
-            ORDER BY recorded_at ASC
-        """, (device['id'], window_start))
-
-        for row in cur.fetchall():
-            try:
-                history_points.append({
-                    'lat': float(row['lat']),
-                    'lon': float(row['lon']),
-                    'time': row['recorded_at'].isoformat(),
-                    'type': 'history',
-                    'provider': (row.get('source') if isinstance(row, dict) else 'history') or 'history'
-                })
-            except (TypeError, ValueError):
-                continue
-
-        # C) Append live current from devices.info if newer & within window,
-	#    and PERSIST it into location_history (once per ~2 minutes)
-        last_ts = None
-        if history_points:
-            try:
-                last_ts = max(datetime.fromisoformat(p['time']) for p in history_points)
-            except Exception:
-                last_ts = None
-
-        cur.execute("SELECT info FROM devices WHERE id = %s", (device['id'],))
-        row = cur.fetchone()
-        if row and row.get('info'):
-            try:
-                info_json = json.loads(row['info']) or {}
-                loc = info_json.get('location') or {}
-                cur_lat = loc.get('lat')
-                cur_lon = loc.get('lon')
-                cur_ts_ms = loc.get('ts')
-
-                if cur_lat is not None and cur_lon is not None:
-                    cur_dt = datetime.fromtimestamp(cur_ts_ms / 1000.0) if cur_ts_ms else datetime.utcnow()
-
-                    if cur_dt >= window_start and (last_ts is None or cur_dt > last_ts):
-                        # 1) Return it in the API response
-                        history_points.append({
-                            'lat': float(cur_lat),
-                            'lon': float(cur_lon),
-                            'time': cur_dt.isoformat(),
-                            'type': 'current',
-                            'provider': 'current'
-                        })
-
-                        # 2) Also PERSIST it into location_history if we haven't recently
-                        #    stored a point for this device (<= ~2 minutes window)
-                        try:
-                            cur.execute("""
-                                INSERT INTO location_history (device_id, lat, lon, recorded_at, source)
-                                SELECT %s, %s, %s, %s, %s
-                                WHERE NOT EXISTS (
-                                  SELECT 1
-                                  FROM location_history
-                                  WHERE device_id = %s
-                                    AND recorded_at >= %s::timestamp - INTERVAL '2 minutes'
-                                )
-                            """, (
-                                device['id'], float(cur_lat), float(cur_lon), cur_dt, 'snapshot',
-                                device['id'], cur_dt
-                            ))
-                            conn.commit()
-                        except Exception as _e:
-                            # don't break the API if insert fails; just log
-                            print(f"[history snapshot insert skipped] {str(_e)}")
-            except Exception:
-                pass
-
-        # D) Sort and de-duplicate
-        history_points.sort(key=lambda p: p['time'])
-        seen = set()
-        dedup = []
-        for p in history_points:
-            key = (round(p['lat'], 6), round(p['lon'], 6), p['time'])
-            if key in seen:
-                continue
-            seen.add(key)
-            dedup.append(p)
+@app.route('/api/device/<device_number>/stats')
+@login_required
+def get_device_stats(device_number):
+    """Distance, moving/idle time, speeds and GPS outliers over the history point set."""
+    days = int(request.args.get('days', 7))
+
+    try:
+        # Same cache entry as /history, so opening both costs one DB round
+        payload = cached(
+            f'history:{device_number}:{days}', CACHE_TTL['history'],
+            lambda: load_device_history(device_number, days)
+        )
+        if payload is None:
+            return jsonify({"error": "Device not found"}), 404
+        stats = movement.stats_from_points(payload['history'])
+        return jsonify(dict(stats, device=payload['device'], days=days))
+    except Exception as e:
+        print(f"Error getting device stats: {e}")
+        return jsonify({"error": str(e)}), 500
+
+def load_device_history(device_number, days):
+    """History payload for one device (uncached); None if the device is unknown."""
+    with db.connection(readonly=True) as conn:
+        cur = conn.cursor(cursor_factory=DictCursor)
+
+        since_ms, window_start = history_window(days)
+        queries.execute(cur, 'history', (device_number, since_ms, window_start))
+        device, points, current = history_from_rows(cur.fetchall(), window_start)
+        cur.close()
+        if not device:
+            return None
+
+        # PERSIST the live point into location_history if we haven't recently
+        # stored a point for this device (<= ~2 minutes window); writes always
+        # go to the primary
+        if current:
+            if conn.replica:
+                with db.connection() as primary:
+                    persist_current(primary, device, current)
+            else:
+                persist_current(conn, device, current)
+
+    return history_result(device, points, window_start)
+
+def history_result(device, points, window_start):
+    """Payload for the raw history query's points, merged with archived months the window reaches."""
+    archived_before = history_archive.archived_before()
+    if archived_before and window_start < archived_before:
+        points = archive.merge_points(history_archive.read_points(device['id'], window_start), points)
+
+    observe_history(device, points)
+    return history_payload(device, points)
+
+def observe_history(device, points):
+    """Freshness of the newest stored (log, location_history or rollup) point the first time it is served."""
+    stored = [p for p in points[-2:] if p['type'] != 'current']
+    if stored:
+        freshness_tracker.observe_many(
+            'history', [(device['number'], datetime.fromisoformat(stored[-1]['time']).timestamp())], first_only=True)
+
+def persist_current(conn, device, current):
+    """Store the live fix in location_history unless a point is within ~2 minutes of it."""
+    cur_lat, cur_lon, cur_dt = current
+    cur = conn.cursor()
+    try:
+        queries.execute(cur, 'snapshot_insert', (
+            device['id'], cur_lat, cur_lon, cur_dt, 'snapshot',
+            device['id'], cur_dt
+        ))
+        conn.commit()
+        current_persisted(device, cur_dt, cur.rowcount)
+    except Exception as _e:
+        # don't break the API if insert fails; just log
+        print(f"[history snapshot insert skipped] {str(_e)}")
+    finally:
+        cur.close()
+
+def current_persisted(device, cur_dt, rowcount):
+    """Metrics and freshness for a /history snapshot insert (rowcount 0: a recent point already existed)."""
+    metrics.SNAPSHOT_DEVICES.inc(writer='history')
+    metrics.SNAPSHOT_ROWS.inc(max(rowcount, 0), writer='history')
+    if rowcount > 0:
+        freshness_tracker.observe('history_snapshot', device['number'], cur_dt.timestamp())
 
+def load_device_rollups(device_number, days, period):
+    """
+    Rollup-backed history payload (uncached); None if the device is unknown.
+    Buckets come from location_rollups up to the rollup job's watermark (from
+    the archive for archived months) and raw points after it, so a window the
+    job hasn't reached yet is served raw.
+    """
+    with db.connection(readonly=True) as conn:
+        cur = conn.cursor(cursor_factory=DictCursor)
+        _, window_start = history_window(days)
+        queries.execute(cur, 'rollup_state', (window_start, period))
+        boundary, boundary_ms = cur.fetchone()
+        queries.execute(cur, 'history', (device_number, boundary_ms, boundary))
+        tail = cur.fetchall()
+        if not tail:
+            return None
+
+        device, raw, current = history_from_rows(tail, boundary)
+        queries.execute(cur, 'rollups', (device['id'], period, window_start, rollup_from(window_start), boundary))
+        rows = cur.fetchall()
         cur.close()
-        conn.close()
 
-        return jsonify({
-            'device': {
-                'number': device['number'],
-                'description': device['description']
-            },
-            'history': dedup,
-            'total_points': len(dedup)
-        })
+        # Store the live fix as load_device_history does; writes always go to the primary
+        if current:
+            if conn.replica:
+                with db.connection() as primary:
+                    persist_current(primary, device, current)
+            else:
+                persist_current(conn, device, current)
 
+    return rollup_result(device, raw, rows, period, window_start)
+
+def rollup_from(window_start):
+    """Where location_rollups take over from the archive for a window."""
+    archived_before = history_archive.archived_before()
+    return archived_before if archived_before and window_start < archived_before else datetime.min
+
+def rollup_result(device, raw, rows, period, window_start):
+    """Payload for the 'rollups' rows plus the raw points (history_from_rows) after the last bucket."""
+    archived_before = history_archive.archived_before()
+    if archived_before and window_start < archived_before:
+        rows = history_archive.rollup_rows(device['id'], window_start, archived_before, period) + list(rows)
+    points = rollups.rollup_points(rows, period) + raw
+    observe_history(device, points)
+    return history_payload(device, points, period if rows else 'raw')
+
+
+@app.route('/api/device/<device_number>/trips')
+@login_required
+def get_device_trips(device_number):
+    """Trips and stops overlapping ?date=YYYY-MM-DD (default today) and the ?days-1 days before it."""
+    try:
+        day = datetime.strptime(request.args['date'], '%Y-%m-%d') if 'date' in request.args \
+            else datetime.combine(datetime.now().date(), datetime.min.time())
+        days = max(1, int(request.args.get('days', 1)))
+    except ValueError:
+        return jsonify({"error": "date must be YYYY-MM-DD and days an integer"}), 400
+
+    try:
+        payload = cached(
+            f'trips:{device_number}:{day.date()}:{days}', CACHE_TTL['history'],
+            lambda: load_device_trips(device_number, day - timedelta(days=days - 1), day + timedelta(days=1))
+        )
+        if payload is None:
+            return jsonify({"error": "Device not found"}), 404
+        return jsonify(payload)
     except Exception as e:
-        print(f"Error getting device history: {e}")
+        print(f"Error getting device trips: {e}")
         return jsonify({"error": str(e)}), 500
 
+def load_device_trips(device_number, start, end):
+    """Segments for one device as of trips.py's last run (uncached); None if the device is unknown."""
+    with db.connection(readonly=True) as conn:
+        cur = conn.cursor(cursor_factory=DictCursor)
+        queries.execute(cur, 'device_lookup', (device_number,))
+        device = cur.fetchone()
+        if not device:
+            return None
+
+        cur.execute(trips.TRIPS_SQL, (device['id'], start, end))
+        rows = cur.fetchall()
+        cur.execute(trips.JOB_STATE_SQL)
+        state = cur.fetchone()
+        cur.close()
+
+    return trips.trips_payload(device, rows, start, end, state['settled_until'] if state else None)
+
+@app.route('/api/export')
+@login_required
+def export_history():
+    """
+    Stream history for many devices: ?from=YYYY-MM-DD&to=YYYY-MM-DD (exclusive)
+    &format=csv|geojsonseq|gpx&devices=N1,N2 (default all)&logs=0 to skip log points.
+    """
+    fmt = request.args.get('format', 'csv')
+    try:
+        start = datetime.strptime(request.args['from'], '%Y-%m-%d')
+        end = datetime.strptime(request.args['to'], '%Y-%m-%d')
+    except (KeyError, ValueError):
+        return jsonify({"error": "from and to are required as YYYY-MM-DD"}), 400
+    if fmt not in export.FORMATS:
+        return jsonify({"error": f"format must be one of {sorted(export.FORMATS)}"}), 400
+    devices = [d for d in request.args.get('devices', '').split(',') if d] or None
+    logs = request.args.get('logs') != '0'
+
+    def generate():
+        # The pooled connection is held for the whole download and returned
+        # when the generator finishes or the client disconnects. An error is
+        # left to propagate, so the server aborts the response instead of
+        # ending a truncated download as if it were complete
+        with db.connection() as conn:
+            for chunk in export.render(fmt, export.iter_points(conn, start, end, devices, logs, history_archive)):
+                yield chunk
+
+    filename = f"history-{start.date()}-{end.date()}.{export.EXTENSIONS[fmt]}"
+    return Response(generate(), mimetype=export.FORMATS[fmt],
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+
+@app.route('/api/stats/update-frequency')
+@login_required
+def get_update_frequency():
+    """
+    GPS updates per device over the last 10 min / 1 h / 24 h from the
+    incrementally maintained counters, each device flagged ok / too_frequent /
+    silent. ?status=too_frequent,silent keeps only those.
+    """
+    try:
+        payload = cached('update_frequency', CACHE_TTL['update_frequency'], load_update_frequency)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    wanted = [s for s in request.args.get('status', '').split(',') if s]
+    if wanted:
+        payload = dict(payload, devices=[d for d in payload['devices'] if d['status'] in wanted])
+    return jsonify(payload)
+
+def load_update_frequency():
+    """Counters report (uncached), as of update_frequency.py's last run."""
+    with db.connection(readonly=True) as conn:
+        cur = conn.cursor(cursor_factory=DictCursor)
+        cur.execute(update_frequency.STATE_SQL)
+        state = cur.fetchone()
+        cur.execute(update_frequency.REPORT_SQL)
+        rows = cur.fetchall()
+        cur.close()
 
+    return update_frequency.report(rows, state)
 
 @app.route('/api/devices')
 @login_required
@@ -375,57 +857,19 @@ def get_devices():
       - recent location_history rows (last 30 days)
     """
     try:
-        conn = psycopg2.connect(**DB_CONFIG)
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-
-        cur.execute("""
-            SELECT
-                d.number,
-                d.description,
-                COALESCE(lc.log_updates, 0) + COALESCE(hc.hist_updates, 0) AS gps_updates,
-                COALESCE(lc.log_updates, 0) AS log_updates,
-                COALESCE(hc.hist_updates, 0) AS hist_updates
-            FROM devices d
-            LEFT JOIN (
-                SELECT deviceid, COUNT(*) AS log_updates
-                FROM plugin_devicelog_log
-                WHERE message ILIKE '%%location%%'
-                GROUP BY deviceid
-            ) lc ON lc.deviceid = d.id
-            LEFT JOIN (
-                SELECT device_id, COUNT(*) AS hist_updates
-                FROM location_history
-                WHERE recorded_at >= NOW() - INTERVAL '30 days'
-                GROUP BY device_id
-            ) hc ON hc.device_id = d.id
-            WHERE d.info IS NOT NULL
-            ORDER BY d.description, d.number
-        """)
+        return jsonify(cached('devices', CACHE_TTL['devices'], load_devices))
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
+def load_devices():
+    """Device list with location point counts (uncached)."""
+    with db.connection(readonly=True) as conn:
+        cur = conn.cursor(cursor_factory=DictCursor)
+        queries.execute(cur, 'devices')
         devices = cur.fetchall()
         cur.close()
-        conn.close()
-
-        result = []
-        for d in devices:
-            total = d['gps_updates'] or 0
-            name_display = d['description'] or d['number']
-            if total > 0:
-                name_display += f" ({total} points: {d['hist_updates'] or 0} history, {d['log_updates'] or 0} logs)"
-            else:
-                name_display += " (No location points yet)"
 
-            result.append({
-                'number': d['number'],
-                'name': name_display,
-                'gps_count': total,
-                'log_count': d['log_updates'] or 0,
-                'history_count': d['hist_updates'] or 0,
-            })
-
-        return jsonify(result)
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+    return [device_from_row(d) for d in devices]
 
 
 # ──────────────────────────────────────────────────────────────────────────────
@@ -439,50 +883,53 @@ def snapshot_all_devices():
       - if newer than ~2 minutes, insert into location_history
     """
     try:
-        conn = psycopg2.connect(**DB_CONFIG)
-        cur = conn.cursor(cursor_factory=RealDictCursor)
+        with metrics.SNAPSHOT_RUNS.time(writer='snapshot_all'), db.connection() as conn:
+            cur = conn.cursor(cursor_factory=DictCursor)
 
-        cur.execute("SELECT id, number, info FROM devices WHERE info IS NOT NULL")
-        devices = cur.fetchall()
+            cur.execute("SELECT id, number, info FROM devices WHERE info IS NOT NULL")
+            devices = cur.fetchall()
 
-        inserted = 0
-        now_utc = datetime.utcnow()
+            inserted = 0
+            stored = []                 # (number, fix ts) for freshness
+            now_utc = datetime.utcnow()
 
-        for d in devices:
-            try:
-                info_json = json.loads(d.get("info") or "{}")
-                loc = (info_json or {}).get("location") or {}
-                lat = loc.get("lat")
-                lon = loc.get("lon")
-                ts_ms = loc.get("ts")
+            for d in devices:
+                try:
+                    info_json = json.loads(d.get("info") or "{}")
+                    loc = (info_json or {}).get("location") or {}
+                    lat = loc.get("lat")
+                    lon = loc.get("lon")
+                    ts_ms = loc.get("ts")
 
-                if lat is None or lon is None:
-                    continue
+                    if lat is None or lon is None:
+                        continue
 
-                cur_dt = datetime.fromtimestamp(ts_ms / 1000.0) if ts_ms else now_utc
+                    cur_dt = datetime.fromtimestamp(ts_ms / 1000.0) if ts_ms else now_utc
 
-                cur.execute("""
-                    INSERT INTO location_history (device_id, lat, lon, recorded_at, source)
-                    SELECT %s, %s, %s, %s, %s
-                    WHERE NOT EXISTS (
-                      SELECT 1 FROM location_history
-                      WHERE device_id = %s
-                        AND recorded_at >= %s::timestamp - INTERVAL '2 minutes'
-                    )
-                """, (d["id"], float(lat), float(lon), cur_dt, "snapshot_all", d["id"], cur_dt))
+                    queries.execute(cur, 'snapshot_insert',
+                                    (d["id"], float(lat), float(lon), cur_dt, "snapshot_all", d["id"], cur_dt))
 
-                if cur.rowcount > 0:
-                    inserted += 1
+                    if cur.rowcount > 0:
+                        inserted += 1
+                        if ts_ms:
+                            stored.append((d["number"], ts_ms / 1000.0))
 
-            except Exception as _e:
-                print(f"[snapshot_all skip device {d.get('number')}] {_e}")
+                except Exception as _e:
+                    metrics.SNAPSHOT_ERRORS.inc(writer='snapshot_all')
+                    print(f"[snapshot_all skip device {d.get('number')}] {_e}")
 
-        conn.commit()
-        cur.close()
-        conn.close()
+            conn.commit()
+            cur.close()
+        metrics.SNAPSHOT_DEVICES.inc(len(devices), writer='snapshot_all')
+        metrics.SNAPSHOT_ROWS.inc(inserted, writer='snapshot_all')
+        freshness_tracker.observe_many('snapshot_all', stored)
+        if inserted:
+            # history counts in the device list are now stale for every worker
+            cache.delete('devices')
         return jsonify({"status": "ok", "inserted": inserted}), 200
 
     except Exception as e:
+        metrics.SNAPSHOT_ERRORS.inc(writer='snapshot_all')
         return jsonify({"error": str(e)}), 500
 
 
@@ -513,15 +960,15 @@ def admin_home():
 @admin_required
 def admin_users():
     try:
-        conn = psycopg2.connect(**DB_CONFIG)
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        cur.execute("""
-            SELECT id, username, full_name, is_admin, created_at, last_login
-            FROM map_users
-            ORDER BY username
-        """)
-        users = cur.fetchall()
-        cur.close(); conn.close()
+        with db.connection() as conn:
+            cur = conn.cursor(cursor_factory=DictCursor)
+            cur.execute("""
+                SELECT id, username, full_name, is_admin, created_at, last_login
+                FROM map_users
+                ORDER BY username
+            """)
+            users = cur.fetchall()
+            cur.close()
         return render_template_string(USER_MANAGEMENT_TEMPLATE, users=users)
     except Exception as e:
         flash(f"Error loading users: {e}")
@@ -542,24 +989,24 @@ def admin_users_add():
             return render_template_string(ADD_USER_TEMPLATE)
 
         try:
-            conn = psycopg2.connect(**DB_CONFIG)
-            cur = conn.cursor(cursor_factory=RealDictCursor)
+            with db.connection() as conn:
+                cur = conn.cursor(cursor_factory=DictCursor)
 
-            # ensure unique username
-            cur.execute("SELECT 1 FROM map_users WHERE username=%s", (username,))
-            if cur.fetchone():
-                cur.close(); conn.close()
-                flash('Username already exists')
-                return render_template_string(ADD_USER_TEMPLATE)
+                # ensure unique username
+                cur.execute("SELECT 1 FROM map_users WHERE username=%s", (username,))
+                if cur.fetchone():
+                    cur.close()
+                    flash('Username already exists')
+                    return render_template_string(ADD_USER_TEMPLATE)
 
-            pw_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
-            cur.execute("""
-                INSERT INTO map_users (username, password_hash, full_name, is_admin, created_at)
-                VALUES (%s, %s, %s, %s, NOW())
-                RETURNING id
-            """, (username, pw_hash, full_name, is_admin))
-            conn.commit()
-            cur.close(); conn.close()
+                pw_hash = passwords.hash_password(password)
+                cur.execute("""
+                    INSERT INTO map_users (username, password_hash, full_name, is_admin, created_at)
+                    VALUES (%s, %s, %s, %s, NOW())
+                    RETURNING id
+                """, (username, pw_hash, full_name, is_admin))
+                conn.commit()
+                cur.close()
             flash(f'User "{username}" created')
             return redirect(url_for('admin_users'))
         except Exception as e:
@@ -578,12 +1025,12 @@ def admin_users_reset_password(user_id):
         flash('Password must be at least 6 characters')
         return redirect(url_for('admin_users'))
     try:
-        conn = psycopg2.connect(**DB_CONFIG)
-        cur = conn.cursor()
-        pw_hash = bcrypt.hashpw(new_pw.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
-        cur.execute("UPDATE map_users SET password_hash=%s WHERE id=%s", (pw_hash, user_id))
-        conn.commit()
-        cur.close(); conn.close()
+        with db.connection() as conn:
+            cur = conn.cursor()
+            pw_hash = passwords.hash_password(new_pw)
+            cur.execute("UPDATE map_users SET password_hash=%s WHERE id=%s", (pw_hash, user_id))
+            conn.commit()
+            cur.close()
         flash('Password updated')
     except Exception as e:
         flash(f'Error resetting password: {e}')
@@ -598,16 +1045,188 @@ def admin_users_delete(user_id):
         flash("You can't delete your own account")
         return redirect(url_for('admin_users'))
     try:
-        conn = psycopg2.connect(**DB_CONFIG)
-        cur = conn.cursor()
-        cur.execute("DELETE FROM map_users WHERE id=%s", (user_id,))
-        conn.commit()
-        cur.close(); conn.close()
+        with db.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("DELETE FROM map_users WHERE id=%s", (user_id,))
+            conn.commit()
+            cur.close()
         flash('User deleted')
     except Exception as e:
         flash(f'Error deleting user: {e}')
     return redirect(url_for('admin_users'))
 
+@app.route('/admin/slow-queries')
+@login_required
+@admin_required
+def admin_slow_queries():
+    return render_template_string(SLOW_QUERIES_TEMPLATE, entries=slow_query_log.entries(),
+                                  threshold_ms=slow_query_log.threshold * 1000,
+                                  explain=slow_query_log.explain)
+
+@app.route('/admin/profiles')
+@login_required
+@admin_required
+def admin_profiles():
+    return render_template_string(PROFILES_TEMPLATE, profiles=profiles.index(), buckets=profiling.BUCKETS)
+
+@app.route('/admin/profiles/<profile_id>.txt')
+@login_required
+@admin_required
+def admin_profile_collapsed(profile_id):
+    collapsed = profiles.collapsed(profile_id)
+    if collapsed is None:
+        abort(404)
+    return app.response_class(collapsed, mimetype='text/plain', headers={
+        'Content-Disposition': f'attachment; filename=profile-{profile_id}.txt'})
+
+@app.route('/admin/freshness')
+@login_required
+@admin_required
+def admin_freshness():
+    """Fix age per stage and the stalest devices of one stage (?stage=, ?format=json)."""
+    stage = request.args.get('stage', 'locations')
+    if stage not in freshness.STAGES:
+        abort(404)
+    report = freshness_tracker.report(stage, limit=int(request.args.get('limit', 200)))
+    if request.args.get('format') == 'json':
+        return jsonify(report)
+    return render_template_string(FRESHNESS_TEMPLATE, report=report, stages=freshness.STAGES,
+                                  flush_s=freshness_tracker.flush_interval)
+
+@app.route('/admin/freshness/clear', methods=['POST'])
+@login_required
+@admin_required
+def admin_freshness_clear():
+    freshness_tracker.clear()
+    flash('Freshness stats cleared')
+    return redirect(url_for('admin_freshness'))
+
+@app.route('/admin/slow-queries/clear', methods=['POST'])
+@login_required
+@admin_required
+def admin_slow_queries_clear():
+    slow_query_log.clear()
+    flash('Slow query log cleared')
+    return redirect(url_for('admin_slow_queries'))
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Geofences (fences CRUD for admins, events for everyone)
+# ──────────────────────────────────────────────────────────────────────────────
+@app.route('/api/geofences')
+@login_required
+def list_geofences():
+    try:
+        with db.connection() as conn:
+            cur = conn.cursor(cursor_factory=DictCursor)
+            cur.execute(geofences.FENCES_SQL)
+            rows = cur.fetchall()
+            cur.close()
+        return jsonify([geofences.fence_to_json(r) for r in rows])
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/geofences', methods=['POST'])
+@login_required
+@admin_required
+def create_geofence():
+    """
+    {"name": .., "kind": "circle", "lat": .., "lon": .., "radius_m": ..} or
+    {"name": .., "kind": "polygon", "polygon": [[lat, lon], ...]}
+    """
+    try:
+        values = geofences.fence_from_json(request.get_json(silent=True) or {})
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        with db.connection() as conn:
+            cur = conn.cursor(cursor_factory=DictCursor)
+            cur.execute("""
+                INSERT INTO geofences (name, kind, polygon, center_lat, center_lon, radius_m)
+                VALUES (%(name)s, %(kind)s, %(polygon)s, %(center_lat)s, %(center_lon)s, %(radius_m)s)
+                RETURNING id, name, kind, polygon, center_lat, center_lon, radius_m, created_at, updated_at
+            """, values)
+            row = cur.fetchone()
+            conn.commit()
+            cur.close()
+        return jsonify(geofences.fence_to_json(row)), 201
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/geofences/<int:fence_id>', methods=['DELETE'])
+@login_required
+@admin_required
+def delete_geofence(fence_id):
+    try:
+        with db.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("DELETE FROM geofences WHERE id = %s", (fence_id,))
+            deleted = cur.rowcount
+            conn.commit()
+            cur.close()
+        if not deleted:
+            return jsonify({'error': 'Geofence not found'}), 404
+        return jsonify({'status': 'ok'})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/geofences/events')
+@login_required
+def geofence_events():
+    """
+    Enter/exit events in id order: ?after=<last id seen>&device=<number>
+    &fence=<id>&limit=N (max 1000). Poll with the last id to follow new events.
+    """
+    try:
+        params = {'after': int(request.args.get('after', 0)),
+                  'limit': min(int(request.args.get('limit', 200)), 1000)}
+        filters = []
+        if request.args.get('device'):
+            filters.append("AND d.number = %(device)s")
+            params['device'] = request.args['device']
+        if request.args.get('fence'):
+            filters.append("AND e.fence_id = %(fence)s")
+            params['fence'] = int(request.args['fence'])
+    except ValueError:
+        return jsonify({'error': 'after, fence and limit must be integers'}), 400
+    try:
+        with db.connection() as conn:
+            cur = conn.cursor(cursor_factory=DictCursor)
+            cur.execute(geofences.EVENTS_SQL.format(filters=' '.join(filters)), params)
+            rows = cur.fetchall()
+            cur.close()
+        events = [dict(r, at=r['at'].isoformat()) for r in rows]
+        return jsonify({'events': events, 'last_id': events[-1]['id'] if events else params['after']})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/device/<device_number>/geofences')
+@login_required
+def device_geofences(device_number):
+    """Fences the device is inside as of its last evaluated point."""
+    try:
+        with db.connection() as conn:
+            cur = conn.cursor(cursor_factory=DictCursor)
+            cur.execute("""
+                SELECT d.number, s.last_at, f.id, f.name, f.kind
+                FROM devices d
+                LEFT JOIN geofence_device_state s ON s.device_id = d.id
+                LEFT JOIN geofences f ON f.id = ANY(s.inside)
+                WHERE d.number = %s
+                ORDER BY f.id
+            """, (device_number,))
+            rows = cur.fetchall()
+            cur.close()
+        if not rows:
+            return jsonify({"error": "Device not found"}), 404
+        return jsonify({
+            'device': device_number,
+            'evaluated_at': rows[0]['last_at'].isoformat() if rows[0]['last_at'] else None,
+            'inside': [{'id': r['id'], 'name': r['name'], 'kind': r['kind']} for r in rows if r['id'] is not None],
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 
 
 # ──────────────────────────────────────────────────────────────────────────────
@@ -689,6 +1308,9 @@ USER_MANAGEMENT_TEMPLATE = '''
             <h1>👥 User Management</h1>
             <div>
                 <a href="/" class="btn btn-secondary">← Back to Maps</a>
+                <a href="/admin/slow-queries" class="btn btn-secondary">Slow Queries</a>
+                <a href="/admin/freshness" class="btn btn-secondary">Freshness</a>
+                <a href="/admin/profiles" class="btn btn-secondary">Profiles</a>
                 <a href="/admin/users/add" class="btn btn-primary">+ Add User</a>
             </div>
         </div>
@@ -830,6 +1452,208 @@ ADD_USER_TEMPLATE = '''
 </html>
 '''
 
+SLOW_QUERIES_TEMPLATE = '''
+<!DOCTYPE html>
+<html>
+<head>
+    <title>Slow Queries - MDM Maps</title>
+    <style>
+        body { font-family: Arial, sans-serif; margin:0; padding:20px; background:#f5f5f5; }
+        .container { max-width:1200px; margin:0 auto; background:white; padding:30px; border-radius:10px; box-shadow:0 2px 10px rgba(0,0,0,0.1); }
+        h1 { color:#333; margin-bottom:20px; }
+        .header { display:flex; justify-content:space-between; align-items:center; margin-bottom:10px; }
+        .btn { padding:10px 20px; border:none; border-radius:5px; cursor:pointer; text-decoration:none; display:inline-block; font-size:14px; }
+        .btn-danger { background:#e74c3c; color:white; }
+        .btn-secondary { background:#95a5a6; color:white; }
+        .btn:hover { opacity:.9; }
+        .meta { color:#777; font-size:13px; margin-bottom:20px; }
+        .entry { border-bottom:1px solid #ddd; padding:15px 0; }
+        .entry .ms { font-weight:bold; color:#e74c3c; }
+        code, pre { background:#f8f9fa; border-radius:5px; font-size:12px; }
+        pre { padding:10px; overflow-x:auto; white-space:pre-wrap; }
+        .alert { padding:12px; margin-bottom:20px; border-radius:5px; background:#d1ecf1; color:#0c5460; border:1px solid #bee5eb; }
+    </style>
+</head>
+<body>
+    <div class="container">
+        <div class="header">
+            <h1>🐢 Slow Queries</h1>
+            <div>
+                <a href="/admin/users" class="btn btn-secondary">← Users</a>
+                <form method="POST" action="/admin/slow-queries/clear" style="display:inline;">
+                    <button type="submit" class="btn btn-danger">Clear</button>
+                </form>
+            </div>
+        </div>
+        <div class="meta">
+            Statements slower than {{ threshold_ms|round|int }} ms, newest first.
+            EXPLAIN (ANALYZE, BUFFERS) capture is {{ 'on' if explain else 'off (SLOW_QUERY_EXPLAIN=true)' }}.
+        </div>
+
+        {% with messages = get_flashed_messages() %}
+            {% if messages %}
+                {% for message in messages %}
+                    <div class="alert">{{ message }}</div>
+                {% endfor %}
+            {% endif %}
+        {% endwith %}
+
+        {% for e in entries %}
+        <div class="entry">
+            <div>
+                <span class="ms">{{ e.ms }} ms</span> · {{ e.rows }} rows · {{ e.at }}
+                {% if e.context %} · <code>{{ e.context }}</code>{% endif %} · worker {{ e.pid }}
+            </div>
+            <pre>{{ e.statement }}</pre>
+            {% if e.params %}<div>params: <code>{{ e.params }}</code></div>{% endif %}
+            {% if e.plan %}<pre>{{ e.plan }}</pre>{% endif %}
+        </div>
+        {% else %}
+        <p>No slow queries recorded.</p>
+        {% endfor %}
+    </div>
+</body>
+</html>
+'''
+
+FRESHNESS_TEMPLATE = '''
+<!DOCTYPE html>
+<html>
+<head>
+    <title>Location Freshness - MDM Maps</title>
+    <style>
+        body { font-family: Arial, sans-serif; margin:0; padding:20px; background:#f5f5f5; }
+        .container { max-width:1200px; margin:0 auto; background:white; padding:30px; border-radius:10px; box-shadow:0 2px 10px rgba(0,0,0,0.1); }
+        h1 { color:#333; margin-bottom:20px; }
+        h2 { color:#333; font-size:18px; margin-top:30px; }
+        .header { display:flex; justify-content:space-between; align-items:center; margin-bottom:10px; }
+        .btn { padding:10px 20px; border:none; border-radius:5px; cursor:pointer; text-decoration:none; display:inline-block; font-size:14px; }
+        .btn-danger { background:#e74c3c; color:white; }
+        .btn-secondary { background:#95a5a6; color:white; }
+        .btn:hover { opacity:.9; }
+        .meta { color:#777; font-size:13px; margin-bottom:20px; }
+        table { width:100%; border-collapse:collapse; }
+        th, td { padding:8px 12px; text-align:right; border-bottom:1px solid #ddd; font-size:14px; }
+        th:first-child, td:first-child { text-align:left; }
+        th { background:#f8f9fa; font-weight:bold; color:#555; }
+        .alert { padding:12px; margin-bottom:20px; border-radius:5px; background:#d1ecf1; color:#0c5460; border:1px solid #bee5eb; }
+    </style>
+</head>
+<body>
+    <div class="container">
+        <div class="header">
+            <h1>⏱️ Location Freshness</h1>
+            <div>
+                <a href="/admin/users" class="btn btn-secondary">← Users</a>
+                <form method="POST" action="/admin/freshness/clear" style="display:inline;">
+                    <button type="submit" class="btn btn-danger">Clear</button>
+                </form>
+            </div>
+        </div>
+        <div class="meta">
+            Age of a fix (now − location.ts / createtime) when it first reached each stage, in seconds.
+            Percentiles are bucket upper bounds; every process merges its numbers here every {{ flush_s|round|int }} s.
+        </div>
+
+        {% with messages = get_flashed_messages() %}
+            {% if messages %}
+                {% for message in messages %}
+                    <div class="alert">{{ message }}</div>
+                {% endfor %}
+            {% endif %}
+        {% endwith %}
+
+        <table>
+            <tr><th>Stage</th><th>Fixes</th><th>Devices</th><th>avg</th><th>p50</th><th>p95</th><th>p99</th><th>max</th></tr>
+            {% for name in stages %}{% set s = report.stages.get(name) %}
+            <tr>
+                <td><a href="?stage={{ name }}">{{ name }}</a></td>
+                {% if s %}
+                <td>{{ s.count }}</td><td>{{ s.devices }}</td><td>{{ s.avg_s }}</td><td>{{ s.p50_s }}</td>
+                <td>{{ s.p95_s }}</td><td>{{ s.p99_s }}</td><td>{{ s.max_s }}</td>
+                {% else %}
+                <td colspan="7">no data</td>
+                {% endif %}
+            </tr>
+            {% endfor %}
+        </table>
+
+        <h2>Stalest devices: {{ report.stage }}</h2>
+        <table>
+            <tr><th>Device</th><th>Fixes</th><th>avg</th><th>p50</th><th>p95</th><th>max</th><th>last</th></tr>
+            {% for d in report.devices %}
+            <tr>
+                <td>{{ d.device }}</td><td>{{ d.count }}</td><td>{{ d.avg_s }}</td><td>{{ d.p50_s }}</td>
+                <td>{{ d.p95_s }}</td><td>{{ d.max_s }}</td><td>{{ d.last_s }}</td>
+            </tr>
+            {% else %}
+            <tr><td colspan="7">No fixes recorded for this stage yet.</td></tr>
+            {% endfor %}
+        </table>
+    </div>
+</body>
+</html>
+'''
+
+PROFILES_TEMPLATE = '''
+<!DOCTYPE html>
+<html>
+<head>
+    <title>Request Profiles - MDM Maps</title>
+    <style>
+        body { font-family: Arial, sans-serif; margin:0; padding:20px; background:#f5f5f5; }
+        .container { max-width:1200px; margin:0 auto; background:white; padding:30px; border-radius:10px; box-shadow:0 2px 10px rgba(0,0,0,0.1); }
+        h1 { color:#333; margin-bottom:20px; }
+        .header { display:flex; justify-content:space-between; align-items:center; margin-bottom:10px; }
+        .btn { padding:10px 20px; border:none; border-radius:5px; cursor:pointer; text-decoration:none; display:inline-block; font-size:14px; }
+        .btn-secondary { background:#95a5a6; color:white; }
+        .btn:hover { opacity:.9; }
+        .meta { color:#777; font-size:13px; margin-bottom:20px; }
+        table { width:100%; border-collapse:collapse; margin-top:20px; }
+        th,td { padding:10px; text-align:left; border-bottom:1px solid #ddd; font-size:13px; }
+        th { background:#f8f9fa; font-weight:bold; color:#333; }
+        td.num { text-align:right; }
+        code { background:#f8f9fa; border-radius:3px; padding:2px 4px; }
+    </style>
+</head>
+<body>
+    <div class="container">
+        <div class="header">
+            <h1>🔥 Request Profiles</h1>
+            <a href="/admin/users" class="btn btn-secondary">← Users</a>
+        </div>
+        <div class="meta">
+            Add <code>X-Profile: 1</code> or <code>?profile=1</code> to any request while logged in as admin.
+            Downloads are collapsed stacks for flamegraph.pl or speedscope.
+        </div>
+        <table>
+            <thead>
+                <tr>
+                    <th>When</th><th>Request</th><th>Status</th><th>Total ms</th>
+                    {% for b in buckets %}<th>{{ b }}</th>{% endfor %}
+                    <th></th>
+                </tr>
+            </thead>
+            <tbody>
+                {% for p in profiles %}
+                <tr>
+                    <td>{{ p.at }}</td>
+                    <td><code>{{ p.method }} {{ p.path }}</code></td>
+                    <td>{{ p.status }}</td>
+                    <td class="num">{{ p.ms }}</td>
+                    {% for b in buckets %}<td class="num">{{ p.buckets[b] }}</td>{% endfor %}
+                    <td><a href="/admin/profiles/{{ p.id }}.txt">stacks</a></td>
+                </tr>
+                {% else %}
+                <tr><td colspan="{{ 5 + buckets|length }}">No profiles yet.</td></tr>
+                {% endfor %}
+            </tbody>
+        </table>
+    </div>
+</body>
+</html>
+'''
+
 # ──────────────────────────────────────────────────────────────────────────────
 # Entrypoint (dev only; gunicorn will import app)
 # ──────────────────────────────────────────────────────────────────────────────
@@ -842,6 +1666,8 @@ if __name__ == '__main__':
     print("=" * 50)
     print(f"Server: http://{host}:{port}")
     print(f"Database: {DB_CONFIG['host']}:{DB_CONFIG['port']}/{DB_CONFIG['database']}")
+    if DB_CONFIG['replicas']:
+        print(f"Read replicas: {', '.join(db.replica_stats())}")
     print("=" * 50)
     print("\n⚠️  Login required to access maps\n")
 
@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+"""
+Shared cache for the maps API.
+
+Every WSGI worker is its own process, so a plain dict cache gets warmed
+separately per worker. The backends here are shared between processes on the
+same host without any external service:
+
+  • sqlite://<path>   one SQLite file (WAL) that every worker opens (default)
+  • redis://host:port/db   a Redis (or Redis-compatible stand-in) server
+  • memory://         per-process dict; handy for a single dev server
+  • none://           caching disabled
+
+Entries are versioned: every write takes the next value of a counter that is
+never reset (not by delete, clear or expiry), so a version identifies one
+write for good. incr() is an atomic counter (read and +1 in one step on
+every backend), for counts that concurrent workers update. A worker keeps the decoded values of the versions it last saw
+(at most CACHE_DECODED_MAX entries, dropped when they expire) and only
+re-reads the payload when another worker has replaced it.
+"""
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+CacheEntry = namedtuple('CacheEntry', 'value version expires_at')
+
+DEFAULT_CACHE_URL = 'sqlite:///' + os.path.join(tempfile.gettempdir(), 'mdm-maps-cache.sqlite')
+
+
+def _dumps(value):
+    return json.dumps(value, separators=(',', ':'), default=str)
+
+
+class _Decoded:
+    """Per-process LRU of key -> (version, value, expires_at) for the versioned backends."""
+
+    def __init__(self, size=None):
+        self.size = int(size or os.getenv('CACHE_DECODED_MAX', 256))
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, version):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            if item[0] != version or item[2] <= time.time():
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return item[1]
+
+    def put(self, key, version, value, expires_at):
+        with self._lock:
+            self._items[key] = (version, value, expires_at)
+            self._items.move_to_end(key)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Backends
+# ──────────────────────────────────────────────────────────────────────────────
+class NullCache:
+    """Cache that never stores anything (CACHE_URL=none://)."""
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value, ttl):
+        return 0
+
+    def incr(self, key, ttl):
+        return 1
+
+    def delete(self, key):
+        pass
+
+    def clear(self):
+        pass
+
+
+class MemoryCache:
+    """Per-process cache; only useful with a single worker."""
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+        self._version = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            if entry.expires_at <= time.time():
+                del self._data[key]
+                return None
+            return entry
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._version += 1
+            self._data[key] = CacheEntry(value, self._version, time.time() + ttl)
+            return self._version
+
+    def incr(self, key, ttl):
+        """Add 1 to an integer entry (0 when missing or expired) and restart its TTL; returns the new count."""
+        with self._lock:
+            entry = self._data.get(key)
+            count = entry.value + 1 if entry is not None and entry.expires_at > time.time() else 1
+            self._version += 1
+            self._data[key] = CacheEntry(count, self._version, time.time() + ttl)
+            return count
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class SQLiteCache:
+    """
+    Cross-process cache in a single SQLite file.
+
+    Writes take the next version from the one-row cache_version counter and
+    UPSERT the payload inside the same BEGIN IMMEDIATE, so the payload and its
+    version change together. Readers first fetch only (version, expires_at)
+    and reuse their locally decoded copy when the version has not moved.
+    """
+
+    PURGE_EVERY = 500  # writes between expired-row sweeps
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._decoded = _Decoded()
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._pid = os.getpid()
+        conn = self._connect()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS cache (
+                key        TEXT PRIMARY KEY,
+                value      TEXT NOT NULL,
+                version    INTEGER NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS cache_version (
+                id      INTEGER PRIMARY KEY CHECK (id = 1),
+                version INTEGER NOT NULL
+            )
+        """)
+        # Start above anything an older file handed out per key
+        conn.execute("""
+            INSERT OR IGNORE INTO cache_version (id, version)
+            SELECT 1, COALESCE(MAX(version), 0) FROM cache
+        """)
+
+    def _connect(self):
+        # Connections must not cross a fork; reopen lazily in each worker.
+        if self._pid != os.getpid():
+            self._local = threading.local()
+            self._decoded = _Decoded()
+            self._pid = os.getpid()
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT version, expires_at FROM cache WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None or row[1] <= time.time():
+            return None
+        version, expires_at = row
+
+        known = self._decoded.get(key, version)
+        if known is not None:
+            return CacheEntry(known, version, expires_at)
+
+        row = conn.execute(
+            "SELECT value, version, expires_at FROM cache WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None or row[2] <= time.time():
+            return None
+        value = json.loads(row[0])
+        self._decoded.put(key, row[1], value, row[2])
+        return CacheEntry(value, row[1], row[2])
+
+    def set(self, key, value, ttl):
+        conn = self._connect()
+        payload = _dumps(value)
+        expires_at = time.time() + ttl
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            version = self._next_version(conn)
+            conn.execute("""
+                INSERT INTO cache (key, value, version, expires_at)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET
+                    value = excluded.value,
+                    version = excluded.version,
+                    expires_at = excluded.expires_at
+            """, (key, payload, version, expires_at))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        self._decoded.put(key, version, value, expires_at)
+        with self._lock:
+            self._writes += 1
+            purge = self._writes % self.PURGE_EVERY == 0
+        if purge:
+            conn.execute("DELETE FROM cache WHERE expires_at <= ?", (time.time(),))
+        return version
+
+    @staticmethod
+    def _next_version(conn):
+        conn.execute("UPDATE cache_version SET version = version + 1 WHERE id = 1")
+        return conn.execute("SELECT version FROM cache_version WHERE id = 1").fetchone()[0]
+
+    def incr(self, key, ttl):
+        """Add 1 to an integer entry (0 when missing or expired) and restart its TTL; returns the new count."""
+        conn = self._connect()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            version = self._next_version(conn)
+            conn.execute("""
+                INSERT INTO cache (key, value, version, expires_at)
+                VALUES (?, '1', ?, ?)
+                ON CONFLICT(key) DO UPDATE SET
+                    value = CASE WHEN cache.expires_at > ? THEN CAST(cache.value AS INTEGER) + 1 ELSE 1 END,
+                    version = excluded.version,
+                    expires_at = excluded.expires_at
+            """, (key, version, now + ttl, now))
+            count = int(conn.execute("SELECT value FROM cache WHERE key = ?", (key,)).fetchone()[0])
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return count
+
+    def delete(self, key):
+        self._connect().execute("DELETE FROM cache WHERE key = ?", (key,))
+        self._decoded.pop(key)
+
+    def clear(self):
+        self._connect().execute("DELETE FROM cache")
+        self._decoded.clear()
+
+
+class RedisCache:
+    """
+    Redis-backed cache. Each key is a hash {value, version}; the version comes
+    from INCR on a counter key that never expires, and is written in the same
+    MULTI as the value.
+    """
+
+    def __init__(self, url, prefix='mdm-maps:'):
+        import redis  # optional dependency, only needed for redis:// URLs
+        self._redis = redis.Redis.from_url(url)
+        self._prefix = prefix
+        self._version_key = prefix + '__version__'
+        self._decoded = _Decoded()
+
+    def get(self, key):
+        k = self._prefix + key
+        version = self._redis.hget(k, 'version')
+        if version is None:
+            return None
+        version = int(version)
+        ttl = self._redis.pttl(k)
+        expires_at = time.time() + max(ttl, 0) / 1000.0
+
+        known = self._decoded.get(key, version)
+        if known is not None:
+            return CacheEntry(known, version, expires_at)
+
+        raw, version = self._redis.hmget(k, 'value', 'version')
+        if raw is None:
+            return None
+        value = json.loads(raw)
+        self._decoded.put(key, int(version), value, expires_at)
+        return CacheEntry(value, int(version), expires_at)
+
+    def set(self, key, value, ttl):
+        k = self._prefix + key
+        version = self._redis.incr(self._version_key)
+        pipe = self._redis.pipeline(transaction=True)
+        pipe.hset(k, mapping={'value': _dumps(value), 'version': version})
+        pipe.pexpire(k, int(ttl * 1000))
+        pipe.execute()
+        self._decoded.put(key, version, value, time.time() + ttl)
+        return version
+
+    def incr(self, key, ttl):
+        """Add 1 to an integer entry (0 when missing or expired) and restart its TTL; returns the new count."""
+        k = self._prefix + key
+        version = self._redis.incr(self._version_key)
+        pipe = self._redis.pipeline(transaction=True)
+        pipe.hincrby(k, 'value', 1)
+        pipe.hset(k, 'version', version)
+        pipe.pexpire(k, int(ttl * 1000))
+        return pipe.execute()[0]
+
+    def delete(self, key):
+        self._redis.delete(self._prefix + key)
+        self._decoded.pop(key)
+
+    def clear(self):
+        for k in self._redis.scan_iter(self._prefix + '*'):
+            if k.decode() != self._version_key:
+                self._redis.delete(k)
+        self._decoded.clear()
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Factory
+# ──────────────────────────────────────────────────────────────────────────────
+BACKENDS = {
+    'none': lambda url: NullCache(),
+    'memory': lambda url: MemoryCache(),
+    # sqlite:///relative.db or sqlite:////abs/path.db
+    'sqlite': lambda url: SQLiteCache(url[len('sqlite:///'):]),
+    'redis': lambda url: RedisCache(url),
+}
+
+
+def get_cache(url=None):
+    """Build a cache backend from a CACHE_URL-style string."""
+    url = url or os.getenv('CACHE_URL') or DEFAULT_CACHE_URL
+    scheme = url.split(':', 1)[0].lower()
+    if scheme not in BACKENDS:
+        raise ValueError(f"Unsupported cache backend: {scheme!r}")
+    return BACKENDS[scheme](url)
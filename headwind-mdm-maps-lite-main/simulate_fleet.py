@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+Live fleet simulator: a stand-in for Headwind MDM under write load.
+
+Drives N virtual devices along the same random-walk routes as
+generate_fleet.py, in real time. Each device reports every --interval seconds
+(jittered): its fix is appended to plugin_devicelog_log as a GPS/Network
+location update in the formats parse_gps_from_message handles, and
+devices.info.location is rewritten as HMDM does on check-in. Due devices are
+written together once per --tick, one transaction per tick.
+
+Point it at a LOCAL Postgres only. Run the poller, the jobs and the API next
+to it and watch their metrics; every --report seconds the simulator prints
+what it wrote and how long the writes took.
+
+    python simulate_fleet.py --devices 5000 --interval 30
+    python simulate_fleet.py --devices 200 --interval 5 --duration 600 --reset
+"""
+import argparse
+import heapq
+import json
+import random
+import signal
+import time
+from datetime import datetime
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+from generate_fleet import CITIES, DB_CONFIG, NOISE_MESSAGES, Track, device_info, location_message
+
+
+class Device:
+    def __init__(self, dev_id, idx, number, seed):
+        self.id = dev_id
+        self.idx = idx
+        self.rng = rng = random.Random(seed * 1_000_003 + idx)
+        home = CITIES[idx % len(CITIES)]
+        self.track = Track(rng, home[0] + rng.uniform(-0.15, 0.15), home[1] + rng.uniform(-0.15, 0.15))
+        self.info = json.loads(device_info(rng, number, self.track.lat, self.track.lon, int(time.time() * 1000)))
+        self.ip = f'10.0.{idx % 256}.{rng.randint(1, 254)}'
+        self.last_t = time.time()
+
+    def report(self, now, noise):
+        """Log rows and the new devices.info for one check-in at now."""
+        rng = self.rng
+        lat, lon = self.track.step(now - self.last_t)
+        self.last_t = now
+        ts_ms = int(now * 1000)
+        rows = [(ts_ms, self.id, self.ip, rng.choice([2, 3, 4]), location_message(rng, lat, lon))]
+        if rng.random() < noise:
+            rows.append((ts_ms, self.id, self.ip, 3,
+                         rng.choice(NOISE_MESSAGES).format(battery=self.info['batteryLevel'])))
+        info = self.info
+        info['location'] = {'lat': round(lat, 6), 'lon': round(lon, 6), 'ts': ts_ms}
+        if not info['batteryCharging'] and rng.random() < 0.05:
+            info['batteryLevel'] = max(1, info['batteryLevel'] - 1)
+        return rows, json.dumps(info)
+
+
+class Stats:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.started = time.time()
+        self.ticks = self.fixes = self.rows = self.behind = 0
+        self.write_s = []
+
+    def line(self):
+        span = max(1e-6, time.time() - self.started)
+        w = sorted(self.write_s) or [0.0]
+        return (f"{datetime.now():%H:%M:%S} {self.fixes / span:,.0f} fixes/s, {self.rows / span:,.0f} log rows/s, "
+                f"write p50 {w[len(w) // 2] * 1000:.0f} ms, max {w[-1] * 1000:.0f} ms"
+                + (f", {self.behind} ticks behind schedule" if self.behind else ""))
+
+
+def load_devices(cur, args):
+    """Create (or reuse) the simulated devices; returns [Device]."""
+    rows = [(f'{args.prefix}{i:05d}', f'Simulated {i:05d}', f'35{random.Random(i).randint(10**12, 10**13 - 1)}', '{}')
+            for i in range(args.devices)]
+    execute_values(cur, """
+        INSERT INTO devices (number, description, imei, info) VALUES %s
+        ON CONFLICT (number) DO NOTHING
+    """, rows, page_size=1000)
+    cur.execute("SELECT id, number FROM devices WHERE number LIKE %s ORDER BY number", (args.prefix + '%',))
+    return [Device(dev_id, int(number[len(args.prefix):]), number, args.seed)
+            for dev_id, number in cur.fetchall()[:args.devices]]
+
+
+def write_tick(cur, log_rows, infos):
+    execute_values(cur, """
+        INSERT INTO plugin_devicelog_log (createtime, deviceid, ipaddress, severity, message) VALUES %s
+    """, log_rows, page_size=1000)
+    execute_values(cur, "UPDATE devices d SET info = v.info FROM (VALUES %s) AS v(id, info) WHERE d.id = v.id",
+                   infos, page_size=1000)
+
+
+def parse_args():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--devices', type=int, default=1000)
+    ap.add_argument('--interval', type=float, default=60.0, help='mean seconds between a device\'s location updates')
+    ap.add_argument('--jitter', type=float, default=0.5, help='interval varies by ± this fraction')
+    ap.add_argument('--noise', type=float, default=0.3, help='chance of a non-location row with each update')
+    ap.add_argument('--tick', type=float, default=1.0, help='seconds between write batches')
+    ap.add_argument('--duration', type=float, default=0, help='stop after this many seconds (0: until Ctrl-C)')
+    ap.add_argument('--report', type=float, default=10.0, help='seconds between progress lines')
+    ap.add_argument('--prefix', default='LIVE', help='device number prefix (LIVE00001, …)')
+    ap.add_argument('--seed', type=int, default=42)
+    ap.add_argument('--reset', action='store_true', help='delete the simulated devices\' earlier rows first')
+    return ap.parse_args()
+
+
+def main():
+    args = parse_args()
+    conn = psycopg2.connect(**DB_CONFIG)
+    cur = conn.cursor()
+
+    if args.reset:
+        cur.execute("SELECT id FROM devices WHERE number LIKE %s", (args.prefix + '%',))
+        ids = [r[0] for r in cur.fetchall()]
+        if ids:
+            cur.execute("DELETE FROM plugin_devicelog_log WHERE deviceid = ANY(%s)", (ids,))
+            cur.execute("DELETE FROM location_history WHERE device_id = ANY(%s)", (ids,))
+    devices = load_devices(cur, args)
+    conn.commit()
+
+    # (next report time, index): first reports spread over one interval
+    rng = random.Random(args.seed)
+    now = time.time()
+    due = [(now + rng.uniform(0, args.interval), i) for i in range(len(devices))]
+    heapq.heapify(due)
+    print(f"Simulating {len(devices):,} devices '{args.prefix}…', one update every ~{args.interval:g}s each "
+          f"(~{len(devices) / args.interval:,.0f} fixes/s)")
+
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda *_: stopping.append(1))
+    stats = Stats()
+    started = next_tick = next_report = time.time()
+    next_report += args.report
+    try:
+        while not stopping and not (args.duration and time.time() - started >= args.duration):
+            now = time.time()
+            log_rows, infos = [], []
+            while due and due[0][0] <= now:
+                _, i = heapq.heappop(due)
+                rows, info = devices[i].report(now, args.noise)
+                log_rows.extend(rows)
+                infos.append((devices[i].id, info))
+                heapq.heappush(due, (now + args.interval * rng.uniform(1 - args.jitter, 1 + args.jitter), i))
+
+            if infos:
+                t0 = time.perf_counter()
+                write_tick(cur, log_rows, infos)
+                conn.commit()
+                stats.write_s.append(time.perf_counter() - t0)
+                stats.fixes += len(infos)
+                stats.rows += len(log_rows)
+            stats.ticks += 1
+
+            if time.time() >= next_report:
+                print(stats.line())
+                stats.reset()
+                next_report += args.report
+
+            next_tick += args.tick
+            delay = next_tick - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                # Writes took longer than a tick: report it and don't try to catch up in a burst
+                stats.behind += 1
+                next_tick = time.time()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(stats.line())
+        cur.close()
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+Slow-query log for the maps API.
+
+SlowQueryLog is a db.QUERY_HOOKS callback. Statements slower than
+SLOW_QUERY_MS are printed with their parameters redacted (only the type and
+size of each value is kept, never device numbers or coordinates) and kept in a
+ring buffer of the last SLOW_QUERY_BUFFER entries, shown at /admin/slow-queries.
+
+With SLOW_QUERY_EXPLAIN=true a slow SELECT (or WITH query without
+INSERT/UPDATE/DELETE/MERGE in its CTEs) is re-run once under
+EXPLAIN (ANALYZE, BUFFERS) on the same connection and the plan is stored with
+the entry. Inside the caller's transaction the EXPLAIN runs under a savepoint
+that is always rolled back, so neither its effects nor its failure reach the
+caller's transaction. That doubles the cost of an already slow query, so a statement is
+explained at most once per SLOW_QUERY_EXPLAIN_INTERVAL seconds per worker.
+
+The buffer lives in the shared cache when one is configured, so every gunicorn
+worker's slow queries show up on the same page.
+"""
+import os
+import re
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+from psycopg2 import extensions
+
+import queries
+
+BUFFER_KEY = 'slow_queries'
+
+
+def redact(params):
+    """Replace every bind value with its type (and length for strings)."""
+    def one(v):
+        if v is None:
+            return 'NULL'
+        if isinstance(v, (str, bytes)):
+            return f'<{type(v).__name__}:{len(v)}>'
+        return f'<{type(v).__name__}>'
+
+    if params is None:
+        return None
+    if isinstance(params, dict):
+        return {k: one(v) for k, v in params.items()}
+    return [one(v) for v in params]
+
+
+def normalize(statement):
+    if not isinstance(statement, str):
+        statement = statement.decode('utf-8', 'replace') if isinstance(statement, bytes) else str(statement)
+    return re.sub(r'\s+', ' ', statement).strip()
+
+
+class SlowQueryLog:
+    def __init__(self, threshold_ms=None, explain=None, size=None, store=None, context=None):
+        self.threshold = float(threshold_ms if threshold_ms is not None else os.getenv('SLOW_QUERY_MS', 200)) / 1000.0
+        if explain is None:
+            explain = os.getenv('SLOW_QUERY_EXPLAIN', 'false').lower() == 'true'
+        self.explain = explain
+        self.explain_interval = float(os.getenv('SLOW_QUERY_EXPLAIN_INTERVAL', 60))
+        self.size = int(size or os.getenv('SLOW_QUERY_BUFFER', 100))
+        self.store = store          # shared_cache backend, or None for this process only
+        self.context = context      # callable -> short label of the current request
+        self._local = deque(maxlen=self.size)
+        self._explained = {}
+        self._lock = threading.Lock()
+
+    # db.QUERY_HOOKS signature
+    def __call__(self, statement, params, seconds, rowcount, cursor):
+        if seconds < self.threshold:
+            return
+        try:
+            self._capture(statement, params, seconds, rowcount, cursor)
+        except Exception as e:
+            print(f"[slow query log failed] {e}")
+
+    def _capture(self, statement, params, seconds, rowcount, cursor):
+        text = normalize(statement)
+        entry = {
+            'at': datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+            'ms': round(seconds * 1000, 1),
+            'rows': rowcount,
+            'statement': text,
+            'params': redact(params),
+            'context': self.context() if self.context else None,
+            'pid': os.getpid(),
+            'plan': None,
+        }
+        print(f"[slow query {entry['ms']} ms, {rowcount} rows] {text[:300]} params={entry['params']}")
+
+        if self.explain and self._should_explain(text, cursor):
+            entry['plan'] = self._explain(statement, params, cursor)
+        self._append(entry)
+
+    def _should_explain(self, text, cursor):
+        # ANALYZE executes the statement: never do it for writes
+        if not (queries.is_readonly(text) or queries.readonly_execute(text)):
+            return False
+        if cursor.connection.get_transaction_status() == extensions.TRANSACTION_STATUS_INERROR:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            if now - self._explained.get(text, -self.explain_interval) < self.explain_interval:
+                return False
+            self._explained[text] = now
+            if len(self._explained) > 1000:
+                self._explained.clear()
+        return True
+
+    def _explain(self, statement, params, cursor):
+        conn = cursor.connection
+        # Plain cursor: not instrumented, so this doesn't re-enter the hook
+        cur = conn.cursor(cursor_factory=extensions.cursor)
+        in_transaction = conn.get_transaction_status() == extensions.TRANSACTION_STATUS_INTRANS
+        try:
+            if in_transaction:
+                cur.execute('SAVEPOINT slow_query_explain')
+            try:
+                cur.execute('EXPLAIN (ANALYZE, BUFFERS) ' + statement, params)
+                return '\n'.join(r[0] for r in cur.fetchall())
+            except Exception as e:
+                return f'EXPLAIN failed: {e}'
+            finally:
+                if in_transaction:
+                    cur.execute('ROLLBACK TO SAVEPOINT slow_query_explain')
+                    cur.execute('RELEASE SAVEPOINT slow_query_explain')
+        finally:
+            cur.close()
+
+    def _append(self, entry):
+        if self.store is None:
+            self._local.appendleft(entry)
+            return
+        # Read-modify-write; a concurrent slow query in another worker can
+        # occasionally be lost, which is fine for a diagnostics buffer.
+        with self._lock:
+            cached = self.store.get(BUFFER_KEY)
+            entries = [entry] + list(cached.value if cached else [])
+            self.store.set(BUFFER_KEY, entries[:self.size], 7 * 86400)
+
+    def entries(self):
+        """Newest first."""
+        if self.store is None:
+            return list(self._local)
+        cached = self.store.get(BUFFER_KEY)
+        return list(cached.value) if cached else []
+
+    def clear(self):
+        self._local.clear()
+        if self.store is not None:
+            self.store.delete(BUFFER_KEY)
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The maps modules are top-level scripts next to this directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('CACHE_URL', 'memory://')
@@ -0,0 +1,179 @@
+import csv
+import io
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+import archive
+import export
+import server_history as sh
+
+JAN = datetime(2024, 1, 1)
+FEB = datetime(2024, 2, 1)
+
+
+def _records(store, points):
+    """[(at, lat, lon, source)] -> POINT_DTYPE records, as archive_month builds them."""
+    records = np.empty(len(points), dtype=archive.POINT_DTYPE)
+    records['t'] = [archive.to_micros(at) for at, _, _, _ in points]
+    records['lat'] = np.round(np.array([p[1] for p in points]) * 1e6).astype('<i4')
+    records['lon'] = np.round(np.array([p[2] for p in points]) * 1e6).astype('<i4')
+    records['src'] = [store.source_code(p[3]) for p in points]
+    return records
+
+
+@pytest.fixture
+def store(tmp_path):
+    return archive.Archive(str(tmp_path))
+
+
+def test_points_round_trip(store):
+    points = [(JAN + timedelta(days=3, minutes=m), 52.123456, 13.654321 + m / 1e4, source)
+              for m, source in ((0, 'gps'), (1, 'network'), (2, 'snapshot'), (3, 'history'))]
+    assert store.write_month(5, JAN, _records(store, points)) == 4
+    store.set_archived_before(FEB)
+
+    assert store.read_points(5, JAN) == [{
+        'lat': lat, 'lon': round(lon, 6), 'time': at.isoformat(),
+        'type': 'log' if source in archive.LOG_SOURCES else 'history', 'provider': source,
+    } for at, lat, lon, source in points]
+    # Source codes survive a fresh reader
+    assert [p['provider'] for p in archive.Archive(store.root).read_points(5, JAN)] == \
+        ['gps', 'network', 'snapshot', 'history']
+    assert store.months(5) == [('2024-01', 4)]
+
+
+def test_rewriting_a_month_merges_sorts_and_deduplicates(store):
+    first = [(JAN + timedelta(hours=h), 52.0, 13.0, 'gps') for h in (1, 3)]
+    again = [(JAN + timedelta(hours=h), 52.0, 13.0, 'gps') for h in (3, 2)]
+    store.write_month(5, JAN, _records(store, first))
+    assert store.write_month(5, JAN, _records(store, again)) == 3
+    store.set_archived_before(FEB)
+    assert [p['time'] for p in store.read_points(5, JAN)] == \
+        [(JAN + timedelta(hours=h)).isoformat() for h in (1, 2, 3)]
+
+
+def test_window_spans_months_and_stops_at_archived_before(store):
+    dec = [(datetime(2023, 12, 31, 23, 0), 52.0, 13.0, 'gps')]
+    jan = [(JAN + timedelta(days=d), 52.0, 13.0, 'gps') for d in (0, 10, 20)]
+    store.write_month(5, datetime(2023, 12, 1), _records(store, dec))
+    store.write_month(5, JAN, _records(store, jan))
+    assert store.read_points(5, datetime(2023, 12, 1)) == []      # no manifest: nothing is archived yet
+    store.set_archived_before(JAN + timedelta(days=15))
+    assert [p['time'] for p in store.read_points(5, datetime(2023, 12, 31))] == \
+        ['2023-12-31T23:00:00', '2024-01-01T00:00:00', '2024-01-11T00:00:00']
+
+
+def test_merge_points_drops_points_stored_in_both():
+    at = JAN.isoformat()
+    archived = [{'lat': 52.0, 'lon': 13.0, 'time': at, 'type': 'log', 'provider': 'gps'}]
+    live = [dict(archived[0], type='history', provider='snapshot'),
+            {'lat': 52.1, 'lon': 13.1, 'time': '2023-12-31T00:00:00', 'type': 'history', 'provider': 'history'}]
+    merged = archive.merge_points(archived, live)
+    assert [(p['time'], p['provider']) for p in merged] == [('2023-12-31T00:00:00', 'history'), (at, 'gps')]
+
+
+class FakeCursor:
+    """archive_month's statements over one device's month of rows."""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.deleted = {}
+        self.result = []
+
+    def execute(self, sql, params=None):
+        if sql == archive.log_points.MS_BOUNDS_SQL:
+            self.result = [(0, 0)]
+        elif sql.startswith('SELECT id FROM devices'):
+            self.result = [(5,)]
+        elif sql == archive.MONTH_POINTS_SQL:
+            self.result = self.rows
+        elif sql.startswith('DELETE FROM'):
+            self.deleted[sql.split()[2]] = sorted(params[0])
+
+    def fetchone(self):
+        return self.result[0]
+
+    def fetchall(self):
+        return self.result
+
+    def close(self):
+        pass
+
+
+class FakeConn:
+    def __init__(self, cur):
+        self.cur = cur
+
+    def cursor(self):
+        return self.cur
+
+    def commit(self):
+        pass
+
+
+def test_archive_month_writes_then_deletes_and_history_merges_it(store, monkeypatch):
+    t = [archive.to_micros(JAN + timedelta(days=2, minutes=m)) for m in range(3)]
+    rows = [('log', 11, t[0], 52.0, 13.0, 'gps'), ('history', 21, t[1], 52.001, 13.0, 'snapshot'),
+            ('log', 12, t[2], 52.002, 13.0, 'network')]
+    cur = FakeCursor(rows)
+    assert archive.archive_month(FakeConn(cur), store, JAN) == (1, 3)
+    assert cur.deleted == {'plugin_devicelog_log': [11, 12], 'location_history': [21]}
+    store.set_archived_before(FEB)
+
+    # /history for a window reaching into January: archived points first, then what is still in Postgres
+    monkeypatch.setattr(sh, 'history_archive', store)
+    device = {'id': 5, 'number': 'D5', 'description': 'Van 5'}
+    live = [{'lat': 52.01, 'lon': 13.0, 'time': '2024-02-03T00:00:00', 'type': 'history', 'provider': 'history'}]
+    payload = sh.history_result(device, live, JAN)
+    assert [(p['time'], p['provider']) for p in payload['history']] == [
+        ('2024-01-03T00:00:00', 'gps'), ('2024-01-03T00:01:00', 'snapshot'), ('2024-01-03T00:02:00', 'network'),
+        ('2024-02-03T00:00:00', 'history')]
+    assert payload['total_points'] == 4
+
+
+class ExportConn:
+    """export.iter_points' statements: devices for the archive, then the live location_history rows."""
+
+    def __init__(self, history):
+        self.history = history
+
+    def cursor(self, name=None):
+        conn = self
+
+        class Cursor(list):
+            itersize = None
+
+            def execute(self, sql, params=None):
+                if sql.lstrip().startswith('SELECT d.id, d.number'):
+                    self[:] = [(5, 'D5')]
+                elif name == 'export_history':
+                    self[:] = conn.history
+
+            def fetchall(self):
+                return list(self)
+
+            def close(self):
+                pass
+
+        return Cursor()
+
+
+def test_export_merges_archived_months_before_the_live_rows(store):
+    store.write_month(5, JAN, _records(store, [(JAN + timedelta(days=1), 52.0, 13.0, 'gps'),
+                                               (JAN + timedelta(days=2), 52.1, 13.0, 'snapshot')]))
+    store.set_archived_before(FEB)
+    live = [(5, 'D5', FEB + timedelta(days=1), 52.2, 13.0, 'history')]
+    points = list(export.iter_points(ExportConn(live), JAN, FEB + timedelta(days=3), logs=False, store=store))
+    assert [(p[1], p[5]) for p in points] == [(JAN + timedelta(days=2), 'snapshot'),
+                                             (FEB + timedelta(days=1), 'history')]
+    assert points[0][2] == 'D5' and points[0][3] == pytest.approx(52.1)
+
+
+def test_export_csv_quotes_every_field_that_needs_it():
+    points = [(5, JAN, 'Van "5", north', 52.0, 13.0, 'custom,source')]
+    text = ''.join(export.render('csv', points))
+    assert list(csv.reader(io.StringIO(text))) == [
+        ['device', 'time', 'lat', 'lon', 'source'],
+        ['Van "5", north', JAN.isoformat(), '52.000000', '13.000000', 'custom,source']]
@@ -0,0 +1,184 @@
+import threading
+import time
+
+import psycopg2
+import pytest
+from psycopg2 import extensions
+from psycopg2.pool import PoolError
+
+import db
+
+
+class FakeConn:
+    """Just enough of a psycopg2 connection for the pool's bookkeeping and db.connection()."""
+
+    def __init__(self, lag=0.0):
+        self.closed = 0
+        self.replica = None
+        self.lag = lag
+        self.dead = False           # the server went away while the connection sat idle
+        self.info = self
+        self.transaction_status = extensions.TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = 1
+
+    def poll(self):
+        if self.dead:
+            self.closed = 2
+            raise psycopg2.OperationalError('server closed the connection unexpectedly')
+        return extensions.POLL_OK
+
+    def cursor(self):
+        conn = self
+
+        class Cur:
+            def execute(self, sql, params=None):
+                pass
+
+            def fetchone(self):
+                return (conn.lag,)
+
+            def close(self):
+                pass
+        return Cur()
+
+    def rollback(self):
+        pass
+
+    def get_transaction_status(self):
+        return extensions.TRANSACTION_STATUS_IDLE
+
+
+class FakePool(db.BlockingPool):
+    lag = 0.0                       # replay lag its connections report
+
+    def _connect(self, key=None):
+        conn = FakeConn(self.lag)
+        if key is not None:
+            self._used[key] = conn
+            self._rused[id(conn)] = key
+        else:
+            self._pool.append(conn)
+        return conn
+
+
+def test_getconn_waits_for_a_returned_connection():
+    pool = FakePool(0, 1)
+    first = pool.getconn()
+    threading.Timer(0.1, pool.putconn, (first,)).start()
+    start = time.monotonic()
+    second = pool.getconn(timeout=5)
+    assert second is not None
+    assert time.monotonic() - start >= 0.05
+    pool.putconn(second)
+
+
+def test_returned_connections_are_kept_up_to_maxconn():
+    pool = FakePool(1, 3)
+    conns = [pool.getconn() for _ in range(3)]
+    for conn in conns:
+        pool.putconn(conn)
+    assert not any(conn.closed for conn in conns)
+    assert len(pool._pool) == 3
+    assert {id(pool.getconn()) for _ in range(3)} == {id(conn) for conn in conns}
+
+
+def test_getconn_times_out_when_pool_stays_exhausted():
+    pool = FakePool(0, 1)
+    pool.getconn()
+    with pytest.raises(PoolError):
+        pool.getconn(timeout=0.05)
+    assert pool.waiting == 0
+
+
+def test_zero_timeout_fails_fast():
+    pool = FakePool(0, 1)
+    pool.getconn()
+    start = time.monotonic()
+    with pytest.raises(PoolError):
+        pool.getconn(timeout=0)
+    assert time.monotonic() - start < 0.05
+
+
+def test_failed_connect_frees_its_slot():
+    class Broken(FakePool):
+        def _connect(self, key=None):
+            raise RuntimeError('connection refused')
+
+    pool = Broken(0, 1)
+    for _ in range(3):
+        with pytest.raises(RuntimeError):
+            pool.getconn(timeout=0)
+
+
+def test_more_callers_than_connections_all_get_served():
+    pool = FakePool(0, 2)
+    served = []
+
+    def request():
+        conn = pool.getconn(timeout=5)
+        time.sleep(0.02)
+        served.append(conn)
+        pool.putconn(conn)
+
+    threads = [threading.Thread(target=request) for _ in range(10)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(served) == 10
+
+
+@pytest.fixture
+def replica(monkeypatch):
+    """db configured with a primary and one replica, both fake pools of this process."""
+    primary, rep = FakePool(1, 2), FakePool(1, 2, lazy=True)
+    monkeypatch.setattr(db, '_replicas', {'replica:5432': {}})
+    monkeypatch.setattr(db, '_replica_state', {'replica:5432': db._ReplicaState()})
+    monkeypatch.setattr(db, '_pools', {'primary': primary, 'replica:5432': rep})
+    monkeypatch.setattr(db, '_pool_pid', db.os.getpid())
+    return primary, rep
+
+
+def test_reads_go_to_an_in_sync_replica(replica):
+    with db.connection(readonly=True) as conn:
+        assert conn.replica == 'replica:5432'
+
+
+def test_stale_replica_connection_falls_back_to_the_primary(replica):
+    primary, rep = replica
+    with db.connection(readonly=True) as conn:
+        assert conn.replica == 'replica:5432'
+    # The replica restarts: every idle connection to it is dead
+    for conn in rep._pool:
+        conn.dead = True
+    idle = list(rep._pool)
+    with db.connection(readonly=True) as conn:
+        assert conn.replica is None
+        assert conn in primary._used.values()
+    assert all(c.closed for c in idle) and rep._pool == []
+    assert db.replica_stats()['replica:5432'] == {'lag': None, 'up': False}
+    # Skipped until DB_REPLICA_RETRY_S passes, then fresh connections are opened
+    db._replica_state['replica:5432'].down_until = 0
+    with db.connection(readonly=True) as conn:
+        assert conn.replica == 'replica:5432' and not conn.dead
+
+
+def test_lagging_replica_falls_back_to_the_primary(replica):
+    primary, rep = replica
+    rep.lag = db.REPLICA_MAX_LAG_S + 5
+    with db.connection(readonly=True) as conn:
+        assert conn.replica is None
+    assert db.replica_stats()['replica:5432'] == {'lag': db.REPLICA_MAX_LAG_S + 5, 'up': True}
+
+
+def test_connection_lost_mid_request_marks_the_replica_down(replica):
+    with pytest.raises(psycopg2.OperationalError):
+        with db.connection(readonly=True) as conn:
+            assert conn.replica == 'replica:5432'
+            conn.closed = 2
+            raise psycopg2.OperationalError('server closed the connection unexpectedly')
+    assert db.replica_stats()['replica:5432']['up'] is False
+    with db.connection(readonly=True) as conn:
+        assert conn.replica is None
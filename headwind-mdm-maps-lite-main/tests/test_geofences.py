@@ -0,0 +1,113 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import geofences
+
+T0 = datetime(2024, 5, 1, 8, 0)
+FENCE = {'id': 1, 'name': 'Depot', 'kind': 'circle', 'polygon': None,
+         'center_lat': 52.0, 'center_lon': 13.0, 'radius_m': 200.0,
+         'created_at': T0, 'updated_at': T0}
+
+
+class FakeDB:
+    """The few statements run_job sends, over in-memory location_history and state."""
+
+    def __init__(self, now):
+        self.now = now
+        self.history = []           # (device_id, lat, lon, recorded_at) in commit order
+        self.settled_until = None
+        self.states = {}
+        self.events = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        pass
+
+
+class FakeCursor:
+    def __init__(self, db):
+        self.db = db
+        self.rows = []
+        self.description = None
+
+    def execute(self, sql, params=None):
+        db = self.db
+        if sql == geofences.SETTLED_UNTIL_SQL:
+            self.rows = [(db.now - timedelta(seconds=params[0]),)]
+        elif sql == geofences.FENCES_VERSION_SQL:
+            self.rows = [(1, T0)]
+        elif sql == geofences.FENCES_SQL:
+            self.description = [(k,) for k in FENCE]
+            self.rows = [tuple(FENCE.values())]
+        elif 'INSERT INTO geofence_job_state' in sql:
+            if db.settled_until is None:
+                db.settled_until = params[0]
+        elif sql.startswith('SELECT settled_until'):
+            self.rows = [(db.settled_until,)]
+        elif sql.startswith('UPDATE geofence_job_state SET settled_until = %s, updated_at'):
+            db.settled_until = params[0]
+        elif sql == geofences.NEW_POINTS_SQL:
+            since, until = params
+            self.rows = sorted((p for p in db.history if since < p[3] <= until), key=lambda p: (p[0], p[3]))
+        elif 'FROM geofence_device_state' in sql:
+            self.rows = [(d, inside, last_at) for d, (inside, last_at) in db.states.items() if d in params[0]]
+        else:
+            self.rows = []
+
+    def fetchone(self):
+        return self.rows[0]
+
+    def fetchall(self):
+        return list(self.rows)
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def db(monkeypatch):
+    db = FakeDB(T0)
+
+    def execute_values(cur, sql, rows, **kwargs):
+        if 'geofence_events' in sql:
+            db.events.extend(rows)
+        else:
+            db.states.update({d: (inside, last_at) for d, inside, last_at in rows})
+
+    monkeypatch.setattr(geofences, 'execute_values', execute_values)
+    monkeypatch.setattr(geofences, 'ensure_schema', lambda cur: None)
+    monkeypatch.setitem(geofences._index, 'version', None)
+    return db
+
+
+def test_first_run_starts_at_the_settle_bound(db):
+    db.history.append((7, 52.0, 13.0, T0 - timedelta(hours=1)))
+    assert geofences.run_job(db) == 0
+    assert db.settled_until == T0 - timedelta(seconds=geofences.SETTLE_S)
+
+
+def test_late_commit_within_settle_time_is_evaluated(db):
+    geofences.run_job(db)
+    # Committed after a newer point, but before its recorded_at settled
+    db.history.append((7, 52.05, 13.0, T0 + timedelta(seconds=20)))
+    db.history.append((7, 52.0, 13.0, T0 + timedelta(seconds=10)))
+    db.now = T0 + timedelta(seconds=30)
+    assert geofences.run_job(db) == 0          # neither point has settled yet
+    db.now = T0 + timedelta(seconds=30 + geofences.SETTLE_S)
+    assert geofences.run_job(db) == 2
+    assert [(e[1], e[2], e[3]) for e in db.events] == [
+        (1, 'enter', T0 + timedelta(seconds=10)), (1, 'exit', T0 + timedelta(seconds=20))]
+
+
+def test_catch_up_advances_in_batches(db, monkeypatch):
+    monkeypatch.setattr(geofences, 'BATCH_S', 600)
+    geofences.run_job(db)
+    start = db.settled_until
+    db.history.extend((7, 52.0, 13.0, start + timedelta(minutes=m)) for m in (5, 25, 55))
+    db.now += timedelta(hours=1)
+    assert geofences.run_job(db) == 1
+    assert db.settled_until == start + timedelta(hours=1)
+    assert db.states[7] == ([1], start + timedelta(minutes=55))
@@ -0,0 +1,50 @@
+import json
+import os
+import re
+import shutil
+import subprocess
+
+import pytest
+
+HTML = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'index-history.html')
+NODE = shutil.which('node')
+
+pytestmark = pytest.mark.skipif(NODE is None, reason='node is not installed')
+
+MINUTE = 60000
+
+
+def pick_marks(track):
+    """Run the history worker's pickMarks over [(lat, lon, ms)] with node; returns [(kind, i)]."""
+    with open(HTML, encoding='utf-8') as f:
+        worker = re.search(r'<script id="historyWorker" type="text/js-worker">(.*?)</script>', f.read(), re.S).group(1)
+    script = 'const self = {};\n' + worker + """
+        const track = JSON.parse(require('fs').readFileSync(0, 'utf8'));
+        const coords = new Float64Array(track.length * 2);
+        track.forEach(([lat, lon], i) => { coords[2 * i] = lat; coords[2 * i + 1] = lon; });
+        const times = track.map(p => new Date(p[2]).toISOString());
+        const marks = pickMarks(coords, times, track.length);
+        process.stdout.write(JSON.stringify(marks.map(m => [m.kind, m.i])));
+    """
+    out = subprocess.run([NODE, '-e', script], input=json.dumps(track), capture_output=True, text=True,
+                         timeout=30, check=True)
+    return [tuple(m) for m in json.loads(out.stdout)]
+
+
+def test_stops_at_the_window_edges_are_marked():
+    # Parked 10 minutes, drives 10 points ~1 km apart, parked 10 minutes
+    track = [(52.0, 13.0, m * MINUTE) for m in range(11)]
+    track += [(52.0 + 0.01 * k, 13.0, (10 + k) * MINUTE) for k in range(1, 11)]
+    track += [(52.1, 13.0, (20 + m) * MINUTE) for m in range(1, 11)]
+    stops = [m for m in pick_marks(track) if m[0] == 'stop']
+    assert stops == [('stop', 0), ('stop', 20)]
+
+
+def test_long_non_stop_stays_are_linear():
+    # 200k fixes a millisecond apart in one spot: never a stop, and the old
+    # rescan from every point would have taken ~2e10 distance checks
+    track = [(52.0, 13.0, i) for i in range(200000)] + [(52.01, 13.0, 200000)]
+    marks = pick_marks(track)
+    assert [m for m in marks if m[0] == 'stop'] == []
+    assert marks[0] == ('start', 0) and marks[-1] == ('end', 200000)
+    assert [m for m in marks if m[0] == 'point'] == [('point', k * 20001) for k in range(1, 10)]
@@ -0,0 +1,75 @@
+import threading
+
+import pytest
+
+import passwords
+import server_history as sh
+import shared_cache
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(request, tmp_path):
+    if request.param == 'memory':
+        return shared_cache.MemoryCache()
+    return shared_cache.SQLiteCache(str(tmp_path / 'cache.db'))
+
+
+def test_failures_from_concurrent_workers_all_count(store):
+    throttle = passwords.LoginThrottle(store)
+    threads = [threading.Thread(target=throttle.failed, args=('alice', '10.0.0.1')) for _ in range(20)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert store.get('login_fail:user:alice').value == 20
+    assert store.get('login_fail:ip:10.0.0.1').value == 20
+
+
+def test_throttled_after_max_failures(store):
+    throttle = passwords.LoginThrottle(store)
+    for _ in range(passwords.MAX_FAILURES_PER_USER):
+        throttle.check('Bob', '10.0.0.2')
+        throttle.failed('Bob', '10.0.0.2')
+    with pytest.raises(passwords.Throttled):
+        throttle.check('bob', '10.0.0.3')
+    throttle.succeeded('bob', '10.0.0.2')
+    throttle.check('bob', '10.0.0.2')
+
+
+def test_expired_counter_starts_over(store):
+    store.incr('n', 60)
+    store.incr('n', -1)     # already expired
+    assert store.incr('n', 60) == 1
+
+
+def test_unknown_user_still_checks_a_hash(monkeypatch):
+    monkeypatch.setattr(passwords, 'ROUNDS', 4)
+    calls = []
+    real_run = passwords._run
+    monkeypatch.setattr(passwords, '_run', lambda fn, *args: calls.append(fn) or real_run(fn, *args))
+    assert passwords.check_password('secret', None) is False
+    assert calls, 'no bcrypt check for an unknown user'
+
+
+def _ip(remote_addr, forwarded=None):
+    headers = {'X-Forwarded-For': forwarded} if forwarded else {}
+    with sh.app.test_request_context('/login', environ_base={'REMOTE_ADDR': remote_addr}, headers=headers):
+        return sh.client_ip()
+
+
+def test_forwarded_for_ignored_from_untrusted_peer():
+    assert _ip('203.0.113.9', '1.2.3.4') == '203.0.113.9'
+
+
+def test_forwarded_for_from_trusted_proxy():
+    assert _ip('127.0.0.1', '198.51.100.7') == '198.51.100.7'
+
+
+def test_spoofed_hops_before_the_proxy_are_ignored():
+    # The client sent "X-Forwarded-For: 1.2.3.4"; the proxy appended the real address
+    assert _ip('127.0.0.1', '1.2.3.4, 198.51.100.7') == '198.51.100.7'
+
+
+def test_chained_trusted_proxies(monkeypatch):
+    monkeypatch.setattr(sh, 'TRUSTED_PROXIES', sh.TRUSTED_PROXIES + [sh.ipaddress.ip_network('10.0.0.0/8')])
+    assert _ip('127.0.0.1', '1.2.3.4, 198.51.100.7, 10.1.2.3') == '198.51.100.7'
@@ -0,0 +1,125 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+import archive
+import rollups
+import server_history as sh
+
+T0 = datetime(2024, 1, 31, 22, 30)
+DEVICE = {'id': 7, 'number': 'D7', 'description': 'Van 7', 'info': None}
+
+
+def _raw(points):
+    """(device, raw points) as history_from_rows shapes the 'history' rows after the boundary."""
+    device, raw, _ = sh.history_from_rows(_tail(points), datetime.min)
+    return device, raw
+
+
+def _tail(points):
+    """'history' rows: the device row, then points [(lat, lon, at)]."""
+    return [DEVICE] + [{'lat': lat, 'lon': lon, 'at': at, 'type': 'log', 'provider': 'gps'}
+                       for lat, lon, at in points]
+
+
+def _bucket(start, lat, lon):
+    return {'bucket_start': start, 'first_at': start, 'first_lat': lat, 'first_lon': lon,
+            'last_at': start + timedelta(minutes=50), 'last_lat': lat, 'last_lon': lon,
+            'lat': lat, 'lon': lon, 'point_count': 10, 'distance_m': 0.0}
+
+
+@pytest.fixture
+def history_archive(tmp_path, monkeypatch):
+    store = archive.Archive(str(tmp_path))
+    monkeypatch.setattr(sh, 'history_archive', store)
+    return store
+
+
+def _archive_points(store, points):
+    records = np.empty(len(points), dtype=archive.POINT_DTYPE)
+    for i, (lat, lon, at) in enumerate(points):
+        records[i] = (archive.to_micros(at), round(lat * 1e6), round(lon * 1e6), 0)
+    store.write_month(DEVICE['id'], archive.month_start(points[0][2]), records)
+
+
+def test_period_for_window_length():
+    assert rollups.period_for(3) is None
+    assert rollups.period_for(14) == 'hour'
+    assert rollups.period_for(90) == 'day'
+
+
+def test_window_behind_the_watermark_is_served_raw(history_archive):
+    points = [(52.0, 13.0, T0), (52.001, 13.0, T0 + timedelta(minutes=5))]
+    payload = sh.rollup_result(*_raw(points), [], 'hour', T0 - timedelta(days=14))
+    assert payload['resolution'] == 'raw'
+    assert [p['time'] for p in payload['history']] == [at.isoformat() for _, _, at in points]
+
+
+def test_buckets_then_raw_tail_after_the_watermark(history_archive):
+    boundary = datetime(2024, 2, 1, 10)
+    rows = [_bucket(boundary - timedelta(hours=2), 52.0, 13.0), _bucket(boundary - timedelta(hours=1), 52.1, 13.1)]
+    payload = sh.rollup_result(*_raw([(52.2, 13.2, boundary + timedelta(minutes=3))]), rows, 'hour',
+                               boundary - timedelta(days=14))
+    assert payload['resolution'] == 'hour'
+    assert [p['type'] for p in payload['history']] == ['rollup', 'rollup', 'log']
+    assert payload['total_points'] == 3
+
+
+def test_archived_months_are_bucketed_from_the_archive(history_archive):
+    # Three points around midnight, 30 minutes apart
+    _archive_points(history_archive, [(52.0, 13.0, T0), (52.001, 13.0, T0 + timedelta(minutes=30)),
+                                      (52.002, 13.0, T0 + timedelta(minutes=60))])
+    history_archive.set_archived_before(datetime(2024, 2, 1))
+    hours = history_archive.rollup_rows(DEVICE['id'], T0 - timedelta(days=1), datetime(2024, 2, 1), 'hour')
+    assert [r['bucket_start'] for r in hours] == [datetime(2024, 1, 31, 22), datetime(2024, 1, 31, 23)]
+    assert [r['point_count'] for r in hours] == [1, 2]
+    assert hours[0]['distance_m'] == 0.0
+    assert hours[1]['distance_m'] == pytest.approx(222.4, abs=0.5)
+    assert hours[1]['last_at'] == T0 + timedelta(minutes=60)
+
+    days = history_archive.rollup_rows(DEVICE['id'], T0 - timedelta(days=1), datetime(2024, 2, 1), 'day')
+    assert len(days) == 1 and days[0]['point_count'] == 3 and days[0]['lat'] == pytest.approx(52.001)
+
+    payload = sh.rollup_result(*_raw([]), [], 'hour', T0 - timedelta(days=1))
+    assert payload['resolution'] == 'hour'
+    assert [p['bucket'] for p in payload['history']] == ['2024-01-31T22:00:00', '2024-01-31T23:00:00']
+
+
+class RecordingCursor:
+    def __init__(self, result=(0, 0)):
+        self.calls = []
+        self.result = result
+
+    def execute(self, sql, params=None):
+        self.calls.append((sql, params))
+
+    def fetchone(self):
+        return self.result
+
+
+def test_roll_up_rebuilds_every_day_the_hours_touch():
+    cur = RecordingCursor()
+    rollups.roll_up(cur, datetime(2024, 2, 1, 23), datetime(2024, 2, 2, 1))
+    days = [params for sql, params in cur.calls if sql == rollups.DELETE_SQL and params['period'] == 'day']
+    assert days == [{'period': 'day', 'start': datetime(2024, 2, 1), 'end': datetime(2024, 2, 3)}]
+    rebuilt = [params for sql, params in cur.calls if sql == rollups.DAY_ROLLUP_SQL]
+    assert rebuilt == [{'day_start': datetime(2024, 2, 1), 'day_end': datetime(2024, 2, 3)}]
+
+
+def test_rows_added_behind_the_watermark_pull_it_back():
+    rolled_until = datetime(2024, 2, 1, 10)
+    cur = RecordingCursor((datetime(2024, 1, 20, 6), 120))
+    assert rollups.rewind(cur, rolled_until, 100) == datetime(2024, 1, 20, 6)
+    assert cur.calls[-1][1] == (datetime(2024, 1, 20, 6), 120)
+
+    # New rows ahead of the watermark only move the seen id
+    cur = RecordingCursor((datetime(2024, 2, 1, 11), 130))
+    assert rollups.rewind(cur, rolled_until, 120) == rolled_until
+    assert cur.calls[-1][1] == (rolled_until, 130)
+
+
+def test_first_run_only_records_the_seen_id():
+    cur = RecordingCursor((500,))
+    assert rollups.rewind(cur, datetime(2024, 2, 1, 10), None) == datetime(2024, 2, 1, 10)
+    assert cur.calls[-1][1] == (datetime(2024, 2, 1, 10), 500)
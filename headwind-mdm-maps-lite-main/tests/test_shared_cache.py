@@ -0,0 +1,72 @@
+import time
+
+import pytest
+
+import shared_cache
+
+
+@pytest.fixture
+def workers(tmp_path):
+    """Two SQLiteCache instances on one file, like two gunicorn workers."""
+    path = str(tmp_path / 'cache.db')
+    return shared_cache.SQLiteCache(path), shared_cache.SQLiteCache(path)
+
+
+def test_reader_sees_value_set_after_delete(workers):
+    a, b = workers
+    a.set('k', ['old'], 60)
+    assert b.get('k').value == ['old']
+    a.delete('k')
+    a.set('k', ['new'], 60)
+    assert b.get('k').value == ['new']
+
+
+def test_reader_sees_value_set_after_expiry_purge(workers):
+    a, b = workers
+    a.set('k', ['old'], 0.05)
+    assert b.get('k').value == ['old']
+    time.sleep(0.1)
+    a._connect().execute("DELETE FROM cache WHERE expires_at <= ?", (time.time(),))
+    a.set('k', ['new'], 60)
+    assert b.get('k').value == ['new']
+
+
+def test_versions_never_repeat(workers):
+    a, b = workers
+    seen = {a.set('k', 1, 60)}
+    a.delete('k')
+    seen.add(b.set('k', 2, 60))
+    a.clear()
+    seen.add(a.set('other', 3, 60))
+    seen.add(shared_cache.SQLiteCache(a.path).set('k', 4, 60))
+    assert len(seen) == 4
+
+
+def test_unchanged_version_reuses_decoded_value(workers):
+    a, b = workers
+    a.set('k', {'x': 1}, 60)
+    first = b.get('k').value
+    assert b.get('k').value is first
+
+
+def test_decoded_values_are_bounded(tmp_path, monkeypatch):
+    monkeypatch.setenv('CACHE_DECODED_MAX', '3')
+    cache = shared_cache.SQLiteCache(str(tmp_path / 'cache.db'))
+    for i in range(10):
+        cache.set(f'k{i}', i, 60)
+    assert len(cache._decoded) == 3
+    assert cache.get('k0').value == 0
+
+
+def test_decoded_values_expire():
+    decoded = shared_cache._Decoded(size=10)
+    decoded.put('k', 1, 'v', time.time() - 1)
+    assert decoded.get('k', 1) is None
+    assert len(decoded) == 0
+
+
+def test_memory_cache_versions_survive_delete():
+    cache = shared_cache.MemoryCache()
+    v1 = cache.set('k', 'old', 60)
+    cache.delete('k')
+    assert cache.set('k', 'new', 60) > v1
@@ -0,0 +1,112 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import asgi_server
+import server_history as sh
+import shared_cache
+
+
+@pytest.fixture(autouse=True)
+def fresh_cache(monkeypatch):
+    monkeypatch.setattr(sh, 'cache', shared_cache.MemoryCache())
+
+
+def _slow(result, calls, release):
+    def compute():
+        calls.append(1)
+        release.wait(5)
+        if isinstance(result, Exception):
+            raise result
+        return result
+    return compute
+
+
+def _concurrently(n, fn):
+    results, errors = [None] * n, [None] * n
+
+    def run(i):
+        try:
+            results[i] = fn()
+        except Exception as e:
+            errors[i] = e
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(n)]
+    for t in threads:
+        t.start()
+    return threads, results, errors
+
+
+def _wait_for_followers(key):
+    """Let the other threads queue up behind the leader."""
+    time.sleep(0.1)
+    assert key in sh._flights
+
+
+def test_concurrent_misses_compute_once():
+    calls, release = [], threading.Event()
+    threads, results, errors = _concurrently(8, lambda: sh.cached('k:1', 60, _slow({'v': 1}, calls, release)))
+    _wait_for_followers('k:1')
+    release.set()
+    for t in threads:
+        t.join()
+    assert calls == [1]
+    assert results == [{'v': 1}] * 8 and errors == [None] * 8
+    assert sh.cache.get('k:1').value == {'v': 1}
+    assert 'k:1' not in sh._flights
+
+
+def test_followers_get_the_leaders_exception_and_the_next_miss_retries():
+    calls, release = [], threading.Event()
+    threads, results, errors = _concurrently(4, lambda: sh.cached('k:2', 60, _slow(ValueError('db down'), calls, release)))
+    _wait_for_followers('k:2')
+    release.set()
+    for t in threads:
+        t.join()
+    assert calls == [1]
+    assert all(isinstance(e, ValueError) for e in errors)
+    assert sh.cached('k:2', 60, lambda: 'recovered') == 'recovered'
+
+
+def test_none_is_shared_but_not_cached():
+    calls, release = [], threading.Event()
+    threads, results, errors = _concurrently(3, lambda: sh.cached('k:3', 60, _slow(None, calls, release)))
+    _wait_for_followers('k:3')
+    release.set()
+    for t in threads:
+        t.join()
+    assert calls == [1] and results == [None] * 3
+    assert sh.cache.get('k:3') is None
+
+
+def test_follower_computes_itself_after_the_timeout():
+    release = threading.Event()
+    leader = threading.Thread(target=sh.single_flight, args=('k:4', lambda: release.wait(5) and 'leader'))
+    leader.start()
+    time.sleep(0.05)
+    try:
+        started = time.monotonic()
+        assert sh.single_flight('k:4', lambda: 'own', timeout=0.1) == 'own'
+        assert time.monotonic() - started < 1
+    finally:
+        release.set()
+        leader.join()
+
+
+def test_asgi_concurrent_misses_compute_once():
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return {'v': 2}
+
+    async def main():
+        return await asyncio.gather(*(asgi_server.cached('k:5', 60, compute) for _ in range(8)))
+
+    assert asyncio.run(main()) == [{'v': 2}] * 8
+    assert calls == [1]
+    assert asgi_server._flights == {}
+    assert sh.cache.get('k:5').value == {'v': 2}
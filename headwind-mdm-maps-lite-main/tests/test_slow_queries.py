@@ -0,0 +1,69 @@
+import pytest
+from psycopg2 import extensions
+
+import log_points
+import slow_queries
+
+
+class FakeConn:
+    def __init__(self, status, fail_on=None):
+        self.status = status
+        self.fail_on = fail_on
+        self.executed = []
+
+    def get_transaction_status(self):
+        return self.status
+
+    def cursor(self, cursor_factory=None):
+        return FakeCursor(self)
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.connection = conn
+
+    def execute(self, sql, params=None):
+        self.connection.executed.append(sql)
+        if self.connection.fail_on and sql.startswith(self.connection.fail_on):
+            raise RuntimeError('canceling statement due to statement timeout')
+
+    def fetchall(self):
+        return [('Seq Scan on devices',)]
+
+    def close(self):
+        pass
+
+
+def test_explain_in_transaction_runs_under_a_savepoint():
+    conn = FakeConn(extensions.TRANSACTION_STATUS_INTRANS)
+    plan = slow_queries.SlowQueryLog(explain=True)._explain('SELECT 1', None, FakeCursor(conn))
+    assert plan == 'Seq Scan on devices'
+    assert conn.executed == ['SAVEPOINT slow_query_explain', 'EXPLAIN (ANALYZE, BUFFERS) SELECT 1',
+                             'ROLLBACK TO SAVEPOINT slow_query_explain', 'RELEASE SAVEPOINT slow_query_explain']
+
+
+def test_failed_explain_rolls_back_to_the_savepoint():
+    conn = FakeConn(extensions.TRANSACTION_STATUS_INTRANS, fail_on='EXPLAIN')
+    plan = slow_queries.SlowQueryLog(explain=True)._explain('SELECT 1', None, FakeCursor(conn))
+    assert plan.startswith('EXPLAIN failed')
+    assert conn.executed[-2:] == ['ROLLBACK TO SAVEPOINT slow_query_explain', 'RELEASE SAVEPOINT slow_query_explain']
+
+
+def test_explain_outside_a_transaction_needs_no_savepoint():
+    conn = FakeConn(extensions.TRANSACTION_STATUS_IDLE)
+    slow_queries.SlowQueryLog(explain=True)._explain('SELECT 1', None, FakeCursor(conn))
+    assert conn.executed == ['EXPLAIN (ANALYZE, BUFFERS) SELECT 1']
+
+
+@pytest.mark.parametrize('sql, explain', [
+    ('SELECT 1', True),
+    ('WITH d AS (SELECT id FROM devices) SELECT * FROM d', True),
+    (f"WITH l AS (SELECT * FROM plugin_devicelog_log l WHERE {log_points.MESSAGE_FILTER}) SELECT * FROM l", True),
+    ('WITH gone AS (DELETE FROM location_history WHERE id < 5 RETURNING id) SELECT count(*) FROM gone', False),
+    ('WITH s AS (SELECT 1) UPDATE location_backfill_staging st SET device_id = 1', False),
+    ('with x as (insert into device_trips (device_id) values (1) returning id) select * from x', False),
+    ('INSERT INTO location_history (device_id) VALUES (1)', False),
+])
+def test_only_statements_without_writes_are_explained(sql, explain):
+    cursor = FakeCursor(FakeConn(extensions.TRANSACTION_STATUS_IDLE))
+    assert slow_queries.SlowQueryLog(explain=True)._should_explain(slow_queries.normalize(sql), cursor) is explain
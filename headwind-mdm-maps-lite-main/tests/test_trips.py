@@ -0,0 +1,54 @@
+from datetime import datetime, timedelta
+
+import trips
+
+T0 = datetime(2024, 5, 1, 8, 0)
+# ~111 m per 0.001 degree of latitude
+HOME = (52.0, 13.0)
+
+
+def _track(spec):
+    """[(minutes, lat, lon)] -> [(lat, lon, datetime)]"""
+    return [(lat, lon, T0 + timedelta(minutes=m)) for m, lat, lon in spec]
+
+
+def _segments(points, batches=1):
+    seg = trips.Segmenter()
+    size = -(-len(points) // batches)
+    out = []
+    for i in range(0, len(points), size):
+        seg = trips.segment_points(seg, points[i:i + size])
+        out.extend(seg.closed)
+        seg = trips.Segmenter.from_state(seg.state())
+    return [(s['kind'], s['started_at'], s['ended_at']) for s in out] + \
+           ([(seg.open['kind'], seg.open['started_at'], seg.open['ended_at'])] if seg.open else [])
+
+
+def test_parked_device_is_one_stop():
+    points = _track([(m, HOME[0], HOME[1]) for m in range(0, 30)])
+    assert _segments(points) == [('stop', T0, T0 + timedelta(minutes=29))]
+
+
+def test_drive_then_park_then_drive():
+    drive = [(m, HOME[0] + 0.005 * m, HOME[1]) for m in range(0, 10)]
+    park_lat = HOME[0] + 0.05
+    park = [(m, park_lat, HOME[1]) for m in range(10, 25)]
+    away = [(m, park_lat + 0.005 * (m - 24), HOME[1]) for m in range(25, 30)]
+    kinds = [k for k, _, _ in _segments(_track(drive + park + away))]
+    assert kinds == ['trip', 'stop', 'trip']
+
+
+def test_short_halt_is_not_a_stop():
+    drive = [(m, HOME[0] + 0.005 * m, HOME[1]) for m in range(0, 10)]
+    halt = [(m, HOME[0] + 0.045, HOME[1]) for m in range(10, 13)]
+    more = [(m, HOME[0] + 0.005 * (m - 4), HOME[1]) for m in range(13, 20)]
+    assert [k for k, _, _ in _segments(_track(drive + halt + more))] == ['trip']
+
+
+def test_incremental_batches_match_one_pass():
+    drive = [(m, HOME[0] + 0.005 * m, HOME[1]) for m in range(0, 10)]
+    park = [(m, HOME[0] + 0.05, HOME[1]) for m in range(10, 25)]
+    away = [(m, HOME[0] + 0.05 + 0.005 * (m - 24), HOME[1]) for m in range(25, 30)]
+    points = _track(drive + park + away)
+    assert _segments(points, batches=4) == _segments(points)
+
@@ -0,0 +1,102 @@
+from datetime import datetime
+
+import pytest
+
+import update_frequency
+
+NOW_MS = 1_714_550_400_000          # 2024-05-01 08:00 UTC
+
+
+class FakeDB:
+    """run_job's statements over an in-memory log (deviceid, createtime) and state."""
+
+    def __init__(self, now_ms):
+        self.now_ms = now_ms
+        self.log = []               # (device_id, createtime) in commit order
+        self.counted_until_ms = None
+        self.buckets = {}           # (device_id, period, bucket) -> updates
+        self.batches = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        pass
+
+
+class FakeCursor:
+    def __init__(self, db):
+        self.db = db
+        self.row = None
+
+    def execute(self, sql, params=None):
+        db = self.db
+        if sql == update_frequency.SETTLED_MS_SQL:
+            self.row = (db.now_ms - int(params[0] * 1000),)
+        elif sql.startswith('SELECT counted_until_ms'):
+            self.row = (db.counted_until_ms,)
+        elif sql == update_frequency.BUCKET_SQL:
+            db.batches.append((params['since'], params['until']))
+            for device_id, at in db.log:
+                if params['since'] <= at < params['until']:
+                    key = (device_id, params['period'], at // params['width'])
+                    db.buckets[key] = db.buckets.get(key, 0) + 1
+        elif sql.startswith('UPDATE gps_update_state'):
+            db.counted_until_ms = max(db.counted_until_ms or 0, params[0])
+
+    def fetchone(self):
+        return self.row
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def db(monkeypatch):
+    monkeypatch.setattr(update_frequency, 'ensure_schema', lambda cur: None)
+    return FakeDB(NOW_MS)
+
+
+def _minute_updates(db):
+    return sum(n for (_, period, _), n in db.buckets.items() if period == 'minute')
+
+
+def test_first_run_starts_a_day_before_the_settle_bound(db):
+    settled = NOW_MS - int(update_frequency.SETTLE_S * 1000)
+    db.log += [(7, settled - update_frequency.DAY_MS - 1000), (7, settled - 60000)]
+    assert update_frequency.run_job(db) == 86400
+    assert db.batches[0][0] == settled - update_frequency.DAY_MS
+    assert db.counted_until_ms == settled
+    assert _minute_updates(db) == 1
+
+
+def test_late_commit_within_settle_time_is_counted(db):
+    update_frequency.run_job(db)
+    # Committed after a newer row, but before its createtime settled
+    db.log.append((7, NOW_MS + 20000))
+    db.log.append((7, NOW_MS + 10000))
+    db.now_ms = NOW_MS + 30000
+    update_frequency.run_job(db)
+    assert _minute_updates(db) == 0            # neither row has settled yet
+    db.now_ms = NOW_MS + 30000 + int(update_frequency.SETTLE_S * 1000)
+    update_frequency.run_job(db)
+    assert _minute_updates(db) == 2
+
+
+def test_catch_up_runs_in_batches(db, monkeypatch):
+    monkeypatch.setattr(update_frequency, 'BATCH_MS', 600000)
+    update_frequency.run_job(db)
+    start = db.counted_until_ms
+    db.batches.clear()
+    db.now_ms += 3600000
+    assert update_frequency.run_job(db) == 3600
+    assert len(db.batches) == 2 * 6
+    assert db.counted_until_ms == start + 3600000
+
+
+@pytest.mark.parametrize('age_s, stale', [(12.0, False), (update_frequency.MAX_LAG_S + 1, True), (None, True)])
+def test_report_flags_stale_counters(age_s, stale):
+    state = {'computed_at': datetime(2024, 5, 1, 8), 'age_s': age_s} if age_s is not None else None
+    payload = update_frequency.report([], state)
+    assert payload['stale'] is stale
+    assert payload['age_s'] == age_s
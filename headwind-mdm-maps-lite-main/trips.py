@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+"""
+Trip / stop segmentation over location_history.
+
+Each device's points are cut into alternating segments kept in device_trips:
+  • stop  the device stayed within STOP_RADIUS_M of where it halted for at
+          least STOP_MIN_SECONDS (lat/lon = centroid of the stop's points)
+  • trip  everything in between (distance = sum of hops between points)
+
+Segmentation is incremental and runs only in this job. device_trip_state
+remembers, per device, the recorded_at of the last point consumed (last_at)
+and the candidate stop being tracked; new points only extend (or close) the
+device's single open segment. A run consumes points up to TRIPS_SETTLE_S
+before the database's now(), so a point committed late (ids are handed out
+before commit, and the poller, snapshot_all, /history and backfill all insert
+concurrently) is still picked up as long as it lands within that window.
+trip_job_state keeps how far the last run got.
+
+    python trips.py --schema --once      # create tables, catch up every device
+    python trips.py --interval 60        # keep up with new points
+    python trips.py --rebuild            # recompute from scratch after tuning
+"""
+import argparse
+import json
+import math
+import os
+import time
+from datetime import datetime
+
+import psycopg2
+from dotenv import load_dotenv
+
+STOP_RADIUS_M = float(os.getenv('STOP_RADIUS_M', 150))
+STOP_MIN_SECONDS = float(os.getenv('STOP_MIN_SECONDS', 300))
+SETTLE_S = float(os.getenv('TRIPS_SETTLE_S', 120))
+
+SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS device_trips (
+    id          BIGSERIAL PRIMARY KEY,
+    device_id   INT NOT NULL,
+    kind        VARCHAR(8) NOT NULL,            -- 'trip' | 'stop'
+    started_at  TIMESTAMP NOT NULL,
+    ended_at    TIMESTAMP NOT NULL,
+    duration_s  INT NOT NULL,
+    distance_m  DOUBLE PRECISION NOT NULL DEFAULT 0,
+    point_count INT NOT NULL,
+    lat         DOUBLE PRECISION,               -- stop centroid
+    lon         DOUBLE PRECISION,
+    start_lat   DOUBLE PRECISION NOT NULL,
+    start_lon   DOUBLE PRECISION NOT NULL,
+    end_lat     DOUBLE PRECISION NOT NULL,
+    end_lon     DOUBLE PRECISION NOT NULL,
+    is_open     BOOLEAN NOT NULL DEFAULT TRUE
+);
+CREATE INDEX IF NOT EXISTS device_trips_device_time ON device_trips (device_id, started_at);
+
+CREATE TABLE IF NOT EXISTS device_trip_state (
+    device_id       INT PRIMARY KEY,
+    last_at         TIMESTAMP,
+    state           TEXT
+);
+-- Earlier versions kept an id watermark, with the job's in a device_id 0 row
+ALTER TABLE device_trip_state DROP COLUMN IF EXISTS last_history_id;
+DELETE FROM device_trip_state WHERE device_id = 0;
+
+CREATE TABLE IF NOT EXISTS trip_job_state (
+    id              INT PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+    settled_until   TIMESTAMP,
+    updated_at      TIMESTAMP
+);
+"""
+
+SETTLED_UNTIL_SQL = "SELECT (now() - make_interval(secs => %s))::timestamp"
+
+# Devices with points after their last_at, up to the settle bound
+PENDING_DEVICES_SQL = """
+    SELECT d.id
+    FROM devices d
+    LEFT JOIN device_trip_state s ON s.device_id = d.id
+    WHERE EXISTS (
+        SELECT 1 FROM location_history h
+        WHERE h.device_id = d.id
+          AND h.recorded_at > COALESCE(s.last_at, '-infinity'::timestamp)
+          AND h.recorded_at <= %s
+    )
+"""
+
+NEW_POINTS_SQL = """
+    SELECT lat, lon, recorded_at
+    FROM location_history
+    WHERE device_id = %s AND recorded_at > COALESCE(%s, '-infinity'::timestamp) AND recorded_at <= %s
+    ORDER BY recorded_at, id
+"""
+
+JOB_STATE_SQL = "SELECT settled_until FROM trip_job_state WHERE id = 1"
+
+TRIPS_SQL = """
+    SELECT id, kind, started_at, ended_at, duration_s, distance_m, point_count,
+           lat, lon, start_lat, start_lon, end_lat, end_lon, is_open
+    FROM device_trips
+    WHERE device_id = %s AND ended_at >= %s AND started_at < %s
+    ORDER BY started_at
+"""
+
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    dp, dl = p2 - p1, math.radians(lon2 - lon1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * 6371000.0 * math.asin(math.sqrt(min(1.0, a)))
+
+
+def _new_segment(kind, at, lat, lon):
+    return {'id': None, 'kind': kind, 'started_at': at, 'ended_at': at, 'distance_m': 0.0,
+            'point_count': 1, 'sum_lat': lat, 'sum_lon': lon,
+            'start_lat': lat, 'start_lon': lon, 'end_lat': lat, 'end_lon': lon}
+
+
+class Segmenter:
+    """
+    Stay-point state machine for one device.
+
+    While on a trip, `candidate` follows the latest run of points that stay
+    within STOP_RADIUS_M of its first point; once that run lasts
+    STOP_MIN_SECONDS the trip is cut where the run began and the run becomes
+    the open stop. A stop ends at the first point outside the radius of its
+    centroid.
+    """
+
+    def __init__(self, open_segment=None, candidate=None):
+        self.open = open_segment
+        self.candidate = candidate
+        self.closed = []
+
+    def add(self, lat, lon, at):
+        seg = self.open
+        if seg is None:
+            self.open = _new_segment('trip', at, lat, lon)
+            self.candidate = self._candidate(lat, lon, at)
+            return
+
+        if seg['kind'] == 'stop':
+            clat, clon = seg['sum_lat'] / seg['point_count'], seg['sum_lon'] / seg['point_count']
+            if haversine_m(clat, clon, lat, lon) <= STOP_RADIUS_M:
+                self._extend(seg, lat, lon, at, hop=0.0)
+                return
+            # Leaving: the trip starts where the stop's last point was
+            self._close(seg)
+            trip = _new_segment('trip', seg['ended_at'], seg['end_lat'], seg['end_lon'])
+            self.open = trip
+            self._extend(trip, lat, lon, at, hop=haversine_m(seg['end_lat'], seg['end_lon'], lat, lon))
+            self.candidate = self._candidate(lat, lon, at, distance_before=trip['distance_m'])
+            return
+
+        # On a trip
+        self._extend(seg, lat, lon, at, hop=haversine_m(seg['end_lat'], seg['end_lon'], lat, lon))
+        cand = self.candidate
+        if cand is None or haversine_m(cand['lat'], cand['lon'], lat, lon) > STOP_RADIUS_M:
+            self.candidate = self._candidate(lat, lon, at, distance_before=seg['distance_m'])
+            return
+        cand['count'] += 1
+        cand['sum_lat'] += lat
+        cand['sum_lon'] += lon
+        cand['last_at'] = at
+        if (at - cand['started_at']).total_seconds() >= STOP_MIN_SECONDS:
+            self._split(seg, cand)
+
+    def _candidate(self, lat, lon, at, distance_before=0.0):
+        return {'lat': lat, 'lon': lon, 'started_at': at, 'last_at': at, 'count': 1,
+                'sum_lat': lat, 'sum_lon': lon, 'distance_before': distance_before}
+
+    def _extend(self, seg, lat, lon, at, hop):
+        seg['ended_at'] = at
+        seg['distance_m'] += hop
+        seg['point_count'] += 1
+        seg['sum_lat'] += lat
+        seg['sum_lon'] += lon
+        seg['end_lat'], seg['end_lon'] = lat, lon
+
+    def _split(self, trip, cand):
+        stop = {'id': None, 'kind': 'stop', 'started_at': cand['started_at'], 'ended_at': cand['last_at'],
+                'distance_m': 0.0, 'point_count': cand['count'],
+                'sum_lat': cand['sum_lat'], 'sum_lon': cand['sum_lon'],
+                'start_lat': cand['lat'], 'start_lon': cand['lon'], 'end_lat': trip['end_lat'],
+                'end_lon': trip['end_lon']}
+        if trip['started_at'] < cand['started_at']:
+            trip['ended_at'] = cand['started_at']
+            trip['distance_m'] = cand['distance_before']
+            trip['point_count'] = max(1, trip['point_count'] - cand['count'] + 1)
+            trip['end_lat'], trip['end_lon'] = cand['lat'], cand['lon']
+            self._close(trip)
+        else:
+            # The whole open trip is the stop (device parked since it appeared)
+            stop['id'] = trip['id']
+        self.open = stop
+        self.candidate = None
+
+    def _close(self, seg):
+        self.closed.append(seg)
+
+    def state(self):
+        def enc(d):
+            return {k: (v.isoformat() if isinstance(v, datetime) else v) for k, v in d.items()}
+        return json.dumps({'open': enc(self.open) if self.open else None,
+                           'candidate': enc(self.candidate) if self.candidate else None})
+
+    @classmethod
+    def from_state(cls, text):
+        if not text:
+            return cls()
+        data = json.loads(text)
+
+        def dec(d):
+            if d is None:
+                return None
+            return {k: (datetime.fromisoformat(v) if k in ('started_at', 'ended_at', 'last_at') else v)
+                    for k, v in d.items()}
+        return cls(dec(data['open']), dec(data['candidate']))
+
+
+def _write_segment(cur, device_id, seg, is_open):
+    duration = int((seg['ended_at'] - seg['started_at']).total_seconds())
+    centroid = ((seg['sum_lat'] / seg['point_count'], seg['sum_lon'] / seg['point_count'])
+                if seg['kind'] == 'stop' else (None, None))
+    values = (seg['kind'], seg['started_at'], seg['ended_at'], duration, seg['distance_m'], seg['point_count'],
+              centroid[0], centroid[1], seg['start_lat'], seg['start_lon'], seg['end_lat'], seg['end_lon'], is_open)
+    if seg['id']:
+        cur.execute("""
+            UPDATE device_trips SET kind=%s, started_at=%s, ended_at=%s, duration_s=%s, distance_m=%s,
+                   point_count=%s, lat=%s, lon=%s, start_lat=%s, start_lon=%s, end_lat=%s, end_lon=%s, is_open=%s
+            WHERE id = %s
+        """, values + (seg['id'],))
+    else:
+        cur.execute("""
+            INSERT INTO device_trips (kind, started_at, ended_at, duration_s, distance_m, point_count,
+                                      lat, lon, start_lat, start_lon, end_lat, end_lon, is_open, device_id)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            RETURNING id
+        """, values + (device_id,))
+        seg['id'] = cur.fetchone()[0]
+
+
+def update_device(cur, device_id, settled_until):
+    """
+    Feed a device's points recorded after its last_at and up to settled_until
+    into its segments. Points recorded before last_at that commit later are
+    ignored: segments before last_at are final. Runs in the caller's
+    transaction; returns the number of points consumed.
+    """
+    cur.execute("INSERT INTO device_trip_state (device_id) VALUES (%s) ON CONFLICT DO NOTHING", (device_id,))
+    # Row lock: two job runs never segment the same device twice
+    cur.execute("SELECT last_at, state FROM device_trip_state WHERE device_id = %s FOR UPDATE", (device_id,))
+    last_at, state = cur.fetchone()
+
+    cur.execute(NEW_POINTS_SQL, (device_id, last_at, settled_until))
+    points = cur.fetchall()
+    if not points:
+        return 0
+
+    seg = segment_points(Segmenter.from_state(state), points)
+    for closed in seg.closed:
+        _write_segment(cur, device_id, closed, is_open=False)
+    if seg.open:
+        _write_segment(cur, device_id, seg.open, is_open=True)
+    cur.execute("UPDATE device_trip_state SET last_at=%s, state=%s WHERE device_id=%s",
+                (points[-1][2], seg.state(), device_id))
+    return len(points)
+
+
+def segment_points(seg, points):
+    """Feed [(lat, lon, recorded_at)] in time order into a Segmenter; returns it."""
+    for lat, lon, at in points:
+        seg.add(float(lat), float(lon), at)
+    return seg
+
+
+def trips_payload(device, rows, day_start, day_end, settled_until=None):
+    segments, summary = [], {'trips': 0, 'stops': 0, 'distance_km': 0.0, 'moving_minutes': 0.0, 'stopped_minutes': 0.0}
+    for r in rows:
+        minutes = r['duration_s'] / 60.0
+        if r['kind'] == 'trip':
+            summary['trips'] += 1
+            summary['distance_km'] += r['distance_m'] / 1000.0
+            summary['moving_minutes'] += minutes
+        else:
+            summary['stops'] += 1
+            summary['stopped_minutes'] += minutes
+        segments.append({
+            'kind': r['kind'],
+            'start': r['started_at'].isoformat(),
+            'end': r['ended_at'].isoformat(),
+            'duration_minutes': round(minutes, 1),
+            'distance_km': round(r['distance_m'] / 1000.0, 3),
+            'points': r['point_count'],
+            'lat': r['lat'], 'lon': r['lon'],
+            'from': {'lat': r['start_lat'], 'lon': r['start_lon']},
+            'to': {'lat': r['end_lat'], 'lon': r['end_lon']},
+            'open': r['is_open'],
+        })
+    summary = {k: round(v, 1) if isinstance(v, float) else v for k, v in summary.items()}
+    return {
+        'device': {'id': device['id'], 'number': device['number'], 'description': device['description']},
+        'from': day_start.isoformat(),
+        'to': day_end.isoformat(),
+        # Points after this are not segmented yet
+        'segmented_until': settled_until.isoformat() if settled_until else None,
+        'summary': summary,
+        'segments': segments,
+    }
+
+
+def ensure_schema(cur):
+    cur.execute(SCHEMA_SQL)
+
+
+def run_job(conn, rebuild=False):
+    """Bring every device with settled new points up to date; returns points consumed."""
+    cur = conn.cursor()
+    ensure_schema(cur)
+    if rebuild:
+        cur.execute("TRUNCATE device_trips, device_trip_state")
+    conn.commit()
+
+    cur.execute(SETTLED_UNTIL_SQL, (SETTLE_S,))
+    settled_until = cur.fetchone()[0]
+    cur.execute(PENDING_DEVICES_SQL, (settled_until,))
+    device_ids = [r[0] for r in cur.fetchall()]
+
+    consumed = 0
+    for device_id in device_ids:
+        consumed += update_device(cur, device_id, settled_until)
+        conn.commit()  # one device per transaction: short row locks
+    cur.execute("""
+        INSERT INTO trip_job_state (id, settled_until, updated_at) VALUES (1, %s, now())
+        ON CONFLICT (id) DO UPDATE SET settled_until = excluded.settled_until, updated_at = excluded.updated_at
+    """, (settled_until,))
+    conn.commit()
+    cur.close()
+    return consumed
+
+
+def main():
+    load_dotenv()
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--schema', action='store_true', help='create device_trips tables and exit unless --once')
+    ap.add_argument('--once', action='store_true', help='catch up once and exit')
+    ap.add_argument('--rebuild', action='store_true', help='drop all segments and recompute')
+    ap.add_argument('--interval', type=float, default=60.0, help='seconds between runs')
+    args = ap.parse_args()
+
+    conn = psycopg2.connect(
+        host=os.getenv('DB_HOST', 'localhost'),
+        port=int(os.getenv('DB_PORT', 5432)),
+        database=os.getenv('DB_NAME', 'hmdm'),
+        user=os.getenv('DB_USER', 'hmdm'),
+        password=os.getenv('DB_PASSWORD', 'topsecret'),
+    )
+    if args.schema:
+        with conn.cursor() as cur:
+            ensure_schema(cur)
+        conn.commit()
+        if not (args.once or args.rebuild):
+            return
+
+    rebuild = args.rebuild
+    while True:
+        started = time.time()
+        consumed = run_job(conn, rebuild=rebuild)
+        rebuild = False
+        print(f"{datetime.now()}: segmented {consumed} points in {time.time() - started:.1f}s")
+        if args.once or args.rebuild:
+            return
+        time.sleep(args.interval)
+
+
+if __name__ == '__main__':
+    main()
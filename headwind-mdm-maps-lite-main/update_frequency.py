@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+"""
+Per-device GPS update counters over sliding windows (10 min, 1 h, 24 h).
+
+Each run folds the plugin_devicelog_log rows with createtime between the
+watermark (gps_update_state.counted_until_ms) and GPS_COUNTERS_SETTLE_S
+before the database's now() into per-device buckets (epoch minutes, kept for
+an hour, and epoch hours, kept for a day), prunes expired buckets and
+rewrites gps_update_counters from them. The settle time lets rows committed a
+little late land before their createtime is counted. A watermark more than a
+day behind (first run, or the job was down) first skips ahead to a day ago.
+Readers only touch gps_update_counters; the log is read one (deviceid,
+createtime) index range per device. The 24 h window is whole hours, so it
+covers between 23 and 24 hours.
+
+Counters are only updated here (the mdm-maps-update-frequency compose
+service); GET /api/stats/update-frequency reports how old they are.
+Replaces monitor-gps-updates.sh.
+
+    python update_frequency.py --schema --once      # create or upgrade tables, count once
+    python update_frequency.py --interval 60
+"""
+import argparse
+import os
+import time
+from datetime import datetime
+
+import psycopg2
+from dotenv import load_dotenv
+
+# Same messages monitor-gps-updates.sh counted
+UPDATE_FILTER = "message ILIKE '%%GPS location update%%'"
+EXPECTED_INTERVAL_S = float(os.getenv('GPS_EXPECTED_INTERVAL_S', 600))
+# More than this many times the expected rate over the last hour
+TOO_FREQUENT_FACTOR = float(os.getenv('GPS_TOO_FREQUENT_FACTOR', 2))
+SILENT_AFTER_S = float(os.getenv('GPS_SILENT_AFTER_S', 3 * EXPECTED_INTERVAL_S))
+# The endpoint flags counters older than this as stale
+MAX_LAG_S = float(os.getenv('GPS_COUNTERS_MAX_LAG_S', 180))
+LOCK_ID = 0x6770_7366  # pg advisory lock: one run at a time
+SETTLE_S = float(os.getenv('GPS_COUNTERS_SETTLE_S', 30))
+# Log time folded per statement while catching up
+BATCH_MS = int(float(os.getenv('GPS_COUNTERS_BATCH_S', 3600)) * 1000)
+DAY_MS = 86400 * 1000
+
+SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS gps_update_buckets (
+    device_id       INT NOT NULL,
+    period          VARCHAR(6) NOT NULL,        -- 'minute' | 'hour'
+    bucket          BIGINT NOT NULL,            -- createtime / 60000 or / 3600000
+    updates         INT NOT NULL,
+    last_update_ms  BIGINT NOT NULL,
+    PRIMARY KEY (device_id, period, bucket)
+);
+
+CREATE TABLE IF NOT EXISTS gps_update_counters (
+    device_id       INT PRIMARY KEY,
+    updates_10m     INT NOT NULL DEFAULT 0,
+    updates_1h      INT NOT NULL DEFAULT 0,
+    updates_24h     INT NOT NULL DEFAULT 0,
+    last_update_ms  BIGINT,
+    computed_at     TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS gps_update_state (
+    id                  INT PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+    counted_until_ms    BIGINT,                 -- rows with an earlier createtime are counted
+    computed_at         TIMESTAMP
+);
+"""
+
+# Upgrades from earlier versions; run by --schema only, since ALTER TABLE
+# takes an ACCESS EXCLUSIVE lock. Earlier versions advanced by log id: start
+# over from a day ago
+MIGRATE_SQL = """
+ALTER TABLE gps_update_state ADD COLUMN IF NOT EXISTS counted_until_ms BIGINT;
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM information_schema.columns
+               WHERE table_name = 'gps_update_state' AND column_name = 'last_log_id') THEN
+        ALTER TABLE gps_update_state DROP COLUMN last_log_id;
+        TRUNCATE gps_update_buckets, gps_update_state;
+    END IF;
+END $$;
+"""
+
+# Last createtime that may be counted, by the database clock
+SETTLED_MS_SQL = "SELECT ((EXTRACT(EPOCH FROM now()) - %s) * 1000)::bigint"
+
+BUCKET_SQL = """
+    INSERT INTO gps_update_buckets (device_id, period, bucket, updates, last_update_ms)
+    SELECT d.id, %(period)s, l.createtime / %(width)s, COUNT(*), MAX(l.createtime)
+    FROM devices d
+    CROSS JOIN LATERAL (
+        SELECT createtime FROM plugin_devicelog_log
+        WHERE deviceid = d.id AND createtime >= %(since)s AND createtime < %(until)s
+          AND """ + UPDATE_FILTER + """
+    ) l
+    GROUP BY d.id, l.createtime / %(width)s
+    ON CONFLICT (device_id, period, bucket) DO UPDATE SET
+        updates = gps_update_buckets.updates + EXCLUDED.updates,
+        last_update_ms = GREATEST(gps_update_buckets.last_update_ms, EXCLUDED.last_update_ms)
+"""
+
+PRUNE_SQL = """
+    DELETE FROM gps_update_buckets
+    WHERE (period = 'minute' AND bucket < %(now_ms)s / 60000 - 60)
+       OR (period = 'hour' AND bucket < %(now_ms)s / 3600000 - 24)
+"""
+
+# Devices with a location (as the shell script listed) get a row even when
+# silent; last_update_ms survives after the device's buckets expired
+COUNTERS_SQL = """
+    WITH agg AS (
+        SELECT device_id,
+               SUM(updates) FILTER (WHERE period = 'minute' AND bucket > %(now_ms)s / 60000 - 10) AS u10m,
+               SUM(updates) FILTER (WHERE period = 'minute' AND bucket > %(now_ms)s / 60000 - 60) AS u1h,
+               SUM(updates) FILTER (WHERE period = 'hour' AND bucket > %(now_ms)s / 3600000 - 24) AS u24h,
+               MAX(last_update_ms) AS last_ms
+        FROM gps_update_buckets
+        GROUP BY device_id
+    )
+    INSERT INTO gps_update_counters (device_id, updates_10m, updates_1h, updates_24h, last_update_ms, computed_at)
+    SELECT d.id, COALESCE(a.u10m, 0), COALESCE(a.u1h, 0), COALESCE(a.u24h, 0),
+           GREATEST(a.last_ms, c.last_update_ms), NOW()
+    FROM devices d
+    LEFT JOIN agg a ON a.device_id = d.id
+    LEFT JOIN gps_update_counters c ON c.device_id = d.id
+    WHERE d.info IS NOT NULL OR a.device_id IS NOT NULL
+    ON CONFLICT (device_id) DO UPDATE SET
+        updates_10m = EXCLUDED.updates_10m, updates_1h = EXCLUDED.updates_1h,
+        updates_24h = EXCLUDED.updates_24h, last_update_ms = EXCLUDED.last_update_ms,
+        computed_at = EXCLUDED.computed_at
+"""
+
+# How old the counters are, by the database clock
+STATE_SQL = """
+    SELECT computed_at, EXTRACT(EPOCH FROM NOW() - computed_at)::float8 AS age_s
+    FROM gps_update_state
+    WHERE id = 1
+"""
+
+REPORT_SQL = """
+    SELECT d.number, d.description, c.updates_10m, c.updates_1h, c.updates_24h, c.last_update_ms, c.computed_at
+    FROM gps_update_counters c
+    JOIN devices d ON d.id = c.device_id
+    ORDER BY c.updates_10m DESC, d.number
+"""
+
+
+def ensure_schema(cur):
+    cur.execute(SCHEMA_SQL)
+
+
+def migrate(cur):
+    cur.execute(SCHEMA_SQL)
+    cur.execute(MIGRATE_SQL)
+
+
+def run_job(conn):
+    """Fold settled log rows into the buckets and recompute the counters; returns the seconds of log covered."""
+    cur = conn.cursor()
+    ensure_schema(cur)
+    cur.execute("SELECT pg_advisory_xact_lock(%s)", (LOCK_ID,))
+    cur.execute("INSERT INTO gps_update_state (id) VALUES (1) ON CONFLICT DO NOTHING")
+    cur.execute("SELECT counted_until_ms FROM gps_update_state WHERE id = 1")
+    since = cur.fetchone()[0]
+    cur.execute(SETTLED_MS_SQL, (SETTLE_S,))
+    until = cur.fetchone()[0]
+    # Only the last day matters: don't fold older rows just to prune them
+    since = max(since or 0, until - DAY_MS)
+
+    covered = max(until - since, 0)
+    while since < until:
+        batch_until = min(until, since + BATCH_MS)
+        for period, width in (('minute', 60000), ('hour', 3600000)):
+            cur.execute(BUCKET_SQL, {'period': period, 'width': width, 'since': since, 'until': batch_until})
+        since = batch_until
+
+    now_ms = int(time.time() * 1000)
+    cur.execute(PRUNE_SQL, {'now_ms': now_ms})
+    cur.execute(COUNTERS_SQL, {'now_ms': now_ms})
+    cur.execute("UPDATE gps_update_state SET counted_until_ms = GREATEST(counted_until_ms, %s), computed_at = NOW() "
+                "WHERE id = 1", (until,))
+    conn.commit()
+    cur.close()
+    return covered / 1000.0
+
+
+def classify(updates_1h, last_update_ms, now_ms):
+    """'silent', 'too_frequent' or 'ok' for one device's counters."""
+    if last_update_ms is None or now_ms - last_update_ms > SILENT_AFTER_S * 1000:
+        return 'silent'
+    if updates_1h > 3600.0 / EXPECTED_INTERVAL_S * TOO_FREQUENT_FACTOR:
+        return 'too_frequent'
+    return 'ok'
+
+
+def report(rows, state=None, now_ms=None):
+    """/api/stats/update-frequency payload from REPORT_SQL rows and the STATE_SQL row."""
+    now_ms = now_ms if now_ms is not None else int(time.time() * 1000)
+    devices, summary = [], {'ok': 0, 'too_frequent': 0, 'silent': 0}
+    for r in rows:
+        status = classify(r['updates_1h'], r['last_update_ms'], now_ms)
+        summary[status] += 1
+        devices.append({
+            'number': r['number'],
+            'description': r['description'],
+            'updates_10m': r['updates_10m'],
+            'updates_1h': r['updates_1h'],
+            'updates_24h': r['updates_24h'],
+            'last_update': (datetime.fromtimestamp(r['last_update_ms'] / 1000.0).isoformat()
+                            if r['last_update_ms'] else None),
+            'status': status,
+        })
+    computed_at = state['computed_at'] if state else None
+    age_s = state['age_s'] if state else None
+    return {
+        'computed_at': computed_at.isoformat() if computed_at else None,
+        'age_s': round(age_s, 1) if age_s is not None else None,
+        'stale': age_s is None or age_s > MAX_LAG_S,
+        'thresholds': {
+            'expected_interval_s': EXPECTED_INTERVAL_S,
+            'too_frequent_per_hour': round(3600.0 / EXPECTED_INTERVAL_S * TOO_FREQUENT_FACTOR, 1),
+            'silent_after_s': SILENT_AFTER_S,
+        },
+        'summary': summary,
+        'devices': devices,
+    }
+
+
+def main():
+    load_dotenv()
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--schema', action='store_true', help='create or upgrade counter tables and exit unless --once')
+    ap.add_argument('--once', action='store_true', help='update once and exit')
+    ap.add_argument('--interval', type=float, default=60.0, help='seconds between runs')
+    args = ap.parse_args()
+
+    conn = psycopg2.connect(
+        host=os.getenv('DB_HOST', 'localhost'),
+        port=int(os.getenv('DB_PORT', 5432)),
+        database=os.getenv('DB_NAME', 'hmdm'),
+        user=os.getenv('DB_USER', 'hmdm'),
+        password=os.getenv('DB_PASSWORD', 'topsecret'),
+    )
+    if args.schema:
+        with conn.cursor() as cur:
+            migrate(cur)
+        conn.commit()
+        if not args.once:
+            return
+
+    while True:
+        started = time.time()
+        covered = run_job(conn)
+        print(f"{datetime.now()}: counted {covered:.0f}s of log in {time.time() - started:.1f}s")
+        if args.once:
+            return
+        time.sleep(args.interval)
+
+
+if __name__ == '__main__':
+    main()